@@ -0,0 +1,202 @@
+"""
+Latency/jitter benchmark of the headless real-time engine (realtime_engine.py RealtimeVCEngine).
+
+The source file is cut into blocks which are fed to process_block() at real-time pace, as an audio device would:
+block i becomes available one block duration after block i-1. A block is late when its conversion is not finished
+by the time the next block arrives, which on a live stream is an audible dropout. Per-block compute times are
+reported against the block duration together with the arrival-to-output delay of every block.
+
+With --threaded the engine runs behind ThreadedRealtimeVC instead: the replay loop plays the audio callback, pushing
+each block and pulling one converted block, and the jitter buffer's underrun/overrun counters are reported.
+
+    python benchmark_realtime.py --source examples/source/yae_0.wav --target examples/reference/dingzhen_0.wav
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+
+from modules.commons import str2bool
+from realtime_engine import RealtimeVCEngine, ThreadedRealtimeVC, load_models
+
+if torch.cuda.is_available():
+    device = torch.device("cuda")
+elif torch.backends.mps.is_available():
+    device = torch.device("mps")
+else:
+    device = torch.device("cpu")
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else 0.0
+
+
+def replay(engine, source, pace):
+    """Feed source block by block, returns (output, compute seconds per block, delay seconds per block)"""
+    block_frame = engine.block_frame
+    block_duration = block_frame / engine.samplerate
+    num_blocks = int(np.ceil(source.shape[0] / block_frame))
+    source = np.pad(source, (0, num_blocks * block_frame - source.shape[0]))
+
+    outputs, compute, delay = [], [], []
+    stream_start = time.perf_counter()
+    for i in range(num_blocks):
+        # the device hands out block i once its last sample has been captured
+        arrival = stream_start + (i + 1) * block_duration if pace else time.perf_counter()
+        now = time.perf_counter()
+        if now < arrival:
+            time.sleep(arrival - now)
+        start = time.perf_counter()
+        outputs.append(engine.process_block(source[i * block_frame:(i + 1) * block_frame]))
+        end = time.perf_counter()
+        compute.append(end - start)
+        delay.append(end - arrival)
+    return np.concatenate(outputs), np.array(compute), np.array(delay)
+
+
+def replay_threaded(engine, source, args):
+    """Play the audio callback of a ThreadedRealtimeVC, returns (output, compute seconds per block, stats)"""
+    block_frame = engine.block_frame
+    block_duration = block_frame / engine.samplerate
+    num_blocks = int(np.ceil(source.shape[0] / block_frame))
+    source = np.pad(source, (0, num_blocks * block_frame - source.shape[0]))
+
+    compute = []
+    process_block = engine.process_block
+
+    def timed_process_block(pcm):
+        start = time.perf_counter()
+        output = process_block(pcm)
+        compute.append(time.perf_counter() - start)
+        return output
+
+    engine.process_block = timed_process_block
+    worker = ThreadedRealtimeVC(engine, min_depth=args.min_depth, max_depth=args.max_depth)
+    outputs = []
+    stream_start = time.perf_counter()
+    try:
+        for i in range(num_blocks):
+            arrival = stream_start + (i + 1) * block_duration
+            now = time.perf_counter()
+            if now < arrival:
+                time.sleep(arrival - now)
+            worker.push(source[i * block_frame:(i + 1) * block_frame])
+            outputs.append(worker.pull())
+        stats = worker.stats()
+        stats["latency_ms"] = worker.latency * 1000
+    finally:
+        worker.close()
+        engine.process_block = process_block
+    return np.concatenate(outputs), np.array(compute), stats
+
+
+def main(args):
+    model_set = load_models(args, device)
+    sr = model_set[-1]["sampling_rate"]
+    reference_wav, _ = librosa.load(args.target, sr=sr)
+    vad_model = None
+    if args.vad:
+        from funasr import AutoModel
+        vad_model = AutoModel(model="fsmn-vad", model_revision="v2.0.4")
+    engine = RealtimeVCEngine(
+        model_set,
+        reference_wav,
+        device,
+        samplerate=args.samplerate or sr,
+        block_time=args.block_time,
+        crossfade_time=args.crossfade_time,
+        extra_time_ce=args.extra_time_ce,
+        extra_time=args.extra_time,
+        extra_time_right=args.extra_time_right,
+        diffusion_steps=args.diffusion_steps,
+        inference_cfg_rate=args.inference_cfg_rate,
+        max_prompt_length=args.max_prompt_length,
+        fp16=args.fp16,
+        vad_model=vad_model,
+        silence_threshold_db=args.silence_threshold_db,
+        content_recompute_time=args.content_recompute_time,
+        content_margin_time=args.content_margin_time,
+        measure_content_divergence=args.measure_content_divergence,
+    )
+    source, _ = librosa.load(args.source, sr=engine.samplerate)
+
+    # warm up kernels and allocator with the silence fast path off, then start the measured stream from scratch
+    vad_model, silence_threshold_db = engine.vad_model, engine.silence_threshold_db
+    engine.vad_model, engine.silence_threshold_db = None, None
+    engine.reset()
+    for _ in range(args.warmup_blocks):
+        engine.process_block(np.zeros(engine.block_frame, dtype=np.float32))
+    engine.vad_model, engine.silence_threshold_db = vad_model, silence_threshold_db
+    engine.reset()
+
+    block_duration = engine.block_frame / engine.samplerate
+    if args.threaded:
+        output, compute, stats = replay_threaded(engine, source, args)
+        rows = [("compute (ms)", compute)]
+    else:
+        output, compute, delay = replay(engine, source, args.pace)
+        rows = [("compute (ms)", compute), ("delay (ms)", delay)]
+    late = compute > block_duration
+
+    print(f"block: {block_duration * 1000:.0f} ms, blocks: {len(compute)}, "
+          f"algorithmic latency: {engine.latency * 1000:.0f} ms")
+    print(f"{'':<16}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name, values in rows:
+        values = values * 1000
+        print(f"{name:<16}{values.mean():>10.1f}{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}"
+              f"{percentile(values, 99):>10.1f}{values.max():>10.1f}")
+    print(f"jitter (std of compute): {compute.std() * 1000:.1f} ms")
+    print(f"real-time factor: {compute.mean() / block_duration:.3f}")
+    print(f"late blocks: {late.sum()} ({late.mean() * 100:.1f}%)")
+    print(f"silent blocks (inference skipped): {engine.silent_blocks} ({engine.silent_blocks / len(compute) * 100:.1f}%)")
+    if engine.content_encoder is not None and engine.content_encoder.divergences:
+        relative_l1 = np.array([d["relative_l1"] for d in engine.content_encoder.divergences])
+        min_cosine = np.array([d["min_cosine"] for d in engine.content_encoder.divergences])
+        print(f"content features vs full recomputation: relative L1 mean {relative_l1.mean():.4f} "
+              f"max {relative_l1.max():.4f}, min cosine similarity {min_cosine.min():.4f}")
+    if args.threaded:
+        print(f"underruns: {stats['underruns']}, overruns: {stats['overruns']}, "
+              f"final buffer target: {stats['target_depth']} blocks, total latency: {stats['latency_ms']:.0f} ms")
+
+    if args.output is not None:
+        sf.write(args.output, output, engine.samplerate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", type=str, required=True, help="Source audio file replayed as the input stream")
+    parser.add_argument("--target", type=str, required=True, help="Reference voice audio file")
+    parser.add_argument("--output", type=str, default=None, help="Optionally write the converted stream here")
+    parser.add_argument("--checkpoint-path", type=str, default=None, help="Path to the model checkpoint")
+    parser.add_argument("--config-path", type=str, default=None, help="Path to the model config")
+    parser.add_argument("--fp16", type=str2bool, nargs="?", const=True, help="Whether to use fp16", default=True)
+    parser.add_argument("--samplerate", type=int, default=None, help="Stream sampling rate, defaults to the model's")
+    parser.add_argument("--block-time", type=float, default=0.25)
+    parser.add_argument("--crossfade-time", type=float, default=0.05)
+    parser.add_argument("--extra-time-ce", type=float, default=2.5)
+    parser.add_argument("--extra-time", type=float, default=0.5)
+    parser.add_argument("--extra-time-right", type=float, default=2.0)
+    parser.add_argument("--diffusion-steps", type=int, default=10)
+    parser.add_argument("--inference-cfg-rate", type=float, default=0.7)
+    parser.add_argument("--max-prompt-length", type=float, default=3.0)
+    parser.add_argument("--content-recompute-time", type=float, default=None,
+                        help="Seconds at the end of the window the content encoder recomputes, default: all of it")
+    parser.add_argument("--content-margin-time", type=float, default=1.0,
+                        help="Left context in seconds encoded along with the recomputed part")
+    parser.add_argument("--measure-content-divergence", action="store_true",
+                        help="Also run the full content encoder and report the difference (slower)")
+    parser.add_argument("--warmup-blocks", type=int, default=3)
+    parser.add_argument("--vad", action="store_true", help="Skip inference outside speech detected by FunASR VAD")
+    parser.add_argument("--silence-threshold-db", type=float, default=None,
+                        help="Skip inference for blocks whose audio stays below this level (dBFS)")
+    parser.add_argument("--pace", type=str2bool, nargs="?", const=True, default=True,
+                        help="Release blocks at real-time pace, disable to measure raw throughput")
+    parser.add_argument("--threaded", action="store_true",
+                        help="Run inference on a worker thread behind the adaptive jitter buffer")
+    parser.add_argument("--min-depth", type=int, default=1, help="Minimum jitter buffer depth in blocks")
+    parser.add_argument("--max-depth", type=int, default=8, help="Maximum jitter buffer depth in blocks")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,115 @@
+"""
+Speed/quality benchmark of the v2 DiT step cache (modules/v2/dit_wrapper.py StepCacheConfig)
+against the full computation.
+
+Every configuration converts the same source window from the same initial noise, so differences in the
+generated mel are due to the cache alone. Quality is reported as the mean absolute log-mel difference to
+the full run, next to the CFM wall time and speedup.
+
+    python benchmark_step_cache.py --source examples/source/yae_0.wav --target examples/reference/dingzhen_0.wav
+"""
+import argparse
+import time
+
+import torch
+import yaml
+from hydra.utils import instantiate
+from omegaconf import DictConfig
+
+from modules.v2.dit_wrapper import StepCacheConfig
+
+if torch.cuda.is_available():
+    device = torch.device("cuda")
+elif torch.backends.mps.is_available():
+    device = torch.device("mps")
+else:
+    device = torch.device("cpu")
+
+dtype = torch.float16
+
+
+def load_v2_models(args):
+    cfg = DictConfig(yaml.safe_load(open("configs/v2/vc_wrapper.yaml", "r")))
+    vc_wrapper = instantiate(cfg)
+    vc_wrapper.load_checkpoints(cfm_checkpoint_path=args.cfm_checkpoint_path)
+    vc_wrapper.to(device)
+    vc_wrapper.eval()
+    return vc_wrapper
+
+
+def synchronize():
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+@torch.inference_mode()
+def run_cfm(vc_wrapper, cat_condition, reference, args, step_cache):
+    """Generate one window, returns (mel, seconds); the noise is reseeded so every run starts alike"""
+    torch.manual_seed(args.seed)
+    synchronize()
+    start = time.perf_counter()
+    with torch.autocast(device_type=device.type, dtype=torch.float32):
+        vc_mel = vc_wrapper.cfm.inference(
+            cat_condition,
+            torch.LongTensor([cat_condition.size(1)]).to(device),
+            reference.target_mel, reference.target_style, args.diffusion_steps,
+            inference_cfg_rate=[args.intelligibility_cfg_rate, args.similarity_cfg_rate],
+            solver=args.solver,
+            step_cache=step_cache,
+        )
+    synchronize()
+    return vc_mel[:, :, reference.target_mel.size(2):], time.perf_counter() - start
+
+
+def main(args):
+    vc_wrapper = load_v2_models(args)
+    reference = vc_wrapper.prepare_reference(args.target, device=device, dtype=dtype, compute_narrow=False)
+    cond = vc_wrapper._prepare_source_condition(args.source, device, dtype)
+
+    # a single DiT window, the same one convert_voice_with_streaming would generate first
+    max_source_window = vc_wrapper.sr // vc_wrapper.hop_size * vc_wrapper.dit_max_context_len - reference.target_mel.size(2)
+    cat_condition = torch.cat([reference.prompt_condition, cond[:, :max_source_window]], dim=1)
+
+    configs = [("full", None)]
+    for interval in args.intervals:
+        for shallow_layers in args.shallow_layers:
+            config = StepCacheConfig(interval=interval, shallow_layers=shallow_layers, full_first=args.full_first)
+            configs.append((f"interval={interval} shallow={shallow_layers}", config))
+
+    # warm up kernels and allocator so the first configuration is not penalized
+    run_cfm(vc_wrapper, cat_condition, reference, args, None)
+
+    reference_mel = None
+    full_time = None
+    print(f"{'configuration':<28}{'CFM time (s)':>14}{'speedup':>10}{'mel L1 vs full':>16}")
+    for name, config in configs:
+        times = []
+        for _ in range(args.repeats):
+            vc_mel, seconds = run_cfm(vc_wrapper, cat_condition, reference, args, config)
+            times.append(seconds)
+        seconds = min(times)
+        if config is None:
+            reference_mel, full_time = vc_mel, seconds
+        mel_l1 = (vc_mel - reference_mel).abs().mean().item()
+        print(f"{name:<28}{seconds:>14.3f}{full_time / seconds:>9.2f}x{mel_l1:>16.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", type=str, required=True, help="Source audio file")
+    parser.add_argument("--target", type=str, required=True, help="Reference voice audio file")
+    parser.add_argument("--diffusion-steps", type=int, default=30)
+    parser.add_argument("--solver", type=str, default="euler", help="CFM solver, see CFM.SOLVERS")
+    parser.add_argument("--intelligibility-cfg-rate", type=float, default=0.7)
+    parser.add_argument("--similarity-cfg-rate", type=float, default=0.7)
+    parser.add_argument("--intervals", type=int, nargs="+", default=[2, 3, 4],
+                        help="Step cache refresh intervals to try")
+    parser.add_argument("--shallow-layers", type=int, nargs="+", default=[2, 3, 4],
+                        help="Numbers of always-recomputed shallow blocks to try")
+    parser.add_argument("--full-first", type=int, default=2, help="Leading estimator calls computed in full")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per configuration, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--cfm-checkpoint-path", type=str, default=None,
+                        help="Path to custom checkpoint file")
+    args = parser.parse_args()
+    main(args)
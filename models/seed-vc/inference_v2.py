@@ -102,7 +102,8 @@ def convert_voice(
             anonymization_only=anonymization_only,
             device=device,
             dtype=dtype,
-            stream_output=True
+            stream_output=True,
+            output_format="none",
         )
         
         full_audio = None
@@ -156,6 +156,25 @@ def sequence_mask(length, max_length=None):
     return x.unsqueeze(0) < length.unsqueeze(1)
 
 
+def grouped_scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=0.0):
+    """
+    scaled_dot_product_attention where q (B, H, L, D) has a multiple of the heads of k, v (B, H_kv, S, D) and
+    query head h attends to kv head h // (H // H_kv), the layout repeat_interleave on k, v used to produce.
+    The query heads of each group are folded into the query length instead of copying K/V once per query head.
+    """
+    n_head, n_kv_head = q.size(1), k.size(1)
+    if n_head == n_kv_head:
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    bsz, _, q_len, head_dim = q.shape
+    group = n_head // n_kv_head
+    q = q.reshape(bsz, n_kv_head, group * q_len, head_dim)
+    if attn_mask is not None:
+        attn_mask = attn_mask.expand(attn_mask.size(0), n_head, q_len, attn_mask.size(-1))
+        attn_mask = attn_mask.reshape(attn_mask.size(0), n_kv_head, group * q_len, attn_mask.size(-1))
+    y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+    return y.reshape(bsz, n_head, q_len, head_dim)
+
+
 def avg_with_mask(x, mask):
     assert mask.dtype == torch.float, "Mask should be float"
 
@@ -4,7 +4,7 @@ import math
 
 # from modules.torchscript_modules.gpt_fast_model import ModelArgs, Transformer
 from modules.wavenet import WN
-from modules.commons import sequence_mask
+from modules.commons import sequence_mask, grouped_scaled_dot_product_attention
 
 from torch.nn.utils import weight_norm
 
@@ -250,9 +250,7 @@ class Attention(nn.Module):
         if self.kv_cache is not None:
             k, v = self.kv_cache.update(input_pos, k, v)
 
-        k = k.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        v = v.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
+        y = grouped_scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
 
         y = y.transpose(1, 2).contiguous().view(bsz, seqlen, self.head_dim * self.n_head)
 
@@ -15,6 +15,8 @@ from torch import Tensor
 from torch.nn import functional as F
 from torch.utils.checkpoint import checkpoint
 
+from modules.commons import grouped_scaled_dot_product_attention
+
 
 def find_multiple(n: int, k: int) -> int:
     if n % k == 0:
@@ -82,14 +84,107 @@ class KVCache(nn.Module):
         self.register_buffer("v_cache", torch.zeros(cache_shape, dtype=dtype))
 
     def update(self, input_pos, k_val, v_val):
-        # input_pos: [S], k_val: [B, H, S, D]
-        assert input_pos.shape[0] == k_val.shape[2]
+        # input_pos: [S] shared by all rows or [B, S] per row, k_val: [B, H, S, D]
+        assert input_pos.shape[-1] == k_val.shape[2]
+
+        bsz = k_val.shape[0]
+        k_out = self.k_cache[:bsz]
+        v_out = self.v_cache[:bsz]
+        if input_pos.dim() == 1:
+            k_out[:, :, input_pos] = k_val
+            v_out[:, :, input_pos] = v_val
+        else:
+            rows = torch.arange(bsz, device=input_pos.device)[:, None]
+            k_out[rows, :, input_pos] = k_val.transpose(1, 2)
+            v_out[rows, :, input_pos] = v_val.transpose(1, 2)
+
+        return k_out, v_out
+
+
+class PageAllocator:
+    """
+    Hands out the fixed-size pages of the PagedKVCache pools to batch rows as their sequences grow.
+    The same page id is used in every layer's pool, so one page table per row serves all layers.
+    Page 0 is never handed out: unallocated page table entries and released rows point to it, their writes
+    land in scratch space and their reads are masked.
+    """
+
+    def __init__(self, num_pages, page_size, max_batch_size, max_pages_per_seq, device):
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.page_table = torch.zeros(max_batch_size, max_pages_per_seq, dtype=torch.long, device=device)
+        self.free_pages = list(range(num_pages, 0, -1))
+        self.row_pages = [[] for _ in range(max_batch_size)]
+        # page table columns gathered for attention, the longest row rounded up to a power of two
+        # so a compiled decode step only sees a few distinct shapes
+        self.width = 1
+
+    def reserve(self, row: int, length: int):
+        """Back positions [0, length) of a row with pages"""
+        pages = self.row_pages[row]
+        needed = -(-length // self.page_size)
+        if needed <= len(pages):
+            return
+        if needed > self.page_table.size(1):
+            raise ValueError(f"Sequence of {length} positions exceeds the KV cache max_seq_len "
+                             f"{self.page_table.size(1) * self.page_size}")
+        while len(pages) < needed:
+            if not self.free_pages:
+                raise RuntimeError(f"KV page pool exhausted, all {self.num_pages} pages of {self.page_size} "
+                                   f"positions are in use")
+            page = self.free_pages.pop()
+            self.page_table[row, len(pages)] = page
+            pages.append(page)
+        self._update_width()
+
+    def release(self, row: int):
+        """Return the pages of a row to the pool"""
+        if not self.row_pages[row]:
+            return
+        self.free_pages.extend(reversed(self.row_pages[row]))
+        self.row_pages[row] = []
+        self.page_table[row].zero_()
+        self._update_width()
+
+    def _update_width(self):
+        used = max(len(pages) for pages in self.row_pages)
+        width = 1
+        while width < used:
+            width *= 2
+        self.width = min(width, self.page_table.size(1))
+
+
+class PagedKVCache(nn.Module):
+    """
+    KV cache of one layer stored in a pool of (page_size, head_dim) pages per head, addressed through
+    the PageAllocator page tables. update() returns the keys and values of the first allocator.width
+    pages of every row as contiguous tensors, attention masks the positions past each row's length.
+    """
 
-        k_out = self.k_cache
-        v_out = self.v_cache
-        k_out[:, :, input_pos] = k_val
-        v_out[:, :, input_pos] = v_val
+    def __init__(self, allocator: PageAllocator, n_heads, head_dim, dtype=torch.bfloat16):
+        super().__init__()
+        self.allocator = allocator
+        # zero-initialized: masked slots still enter the attention matmul and must stay finite
+        pool_shape = (allocator.num_pages + 1, n_heads, allocator.page_size, head_dim)
+        self.register_buffer("k_pages", torch.zeros(pool_shape, dtype=dtype))
+        self.register_buffer("v_pages", torch.zeros(pool_shape, dtype=dtype))
 
+    def update(self, input_pos, k_val, v_val):
+        # input_pos: [S] shared by all rows or [B, S] per row, k_val: [B, H, S, D]
+        bsz, n_heads, _, head_dim = k_val.shape
+        if input_pos.dim() == 1:
+            input_pos = input_pos.expand(bsz, -1)
+        page_size = self.allocator.page_size
+        page_table = self.allocator.page_table[:bsz]
+
+        pages = torch.gather(page_table, 1, input_pos // page_size)
+        offsets = input_pos % page_size
+        self.k_pages[pages, :, offsets] = k_val.transpose(1, 2)
+        self.v_pages[pages, :, offsets] = v_val.transpose(1, 2)
+
+        table = page_table[:, :self.allocator.width]
+        k_out = self.k_pages[table].transpose(1, 2).reshape(bsz, n_heads, -1, head_dim)
+        v_out = self.v_pages[table].transpose(1, 2).reshape(bsz, n_heads, -1, head_dim)
         return k_out, v_out
 
 
@@ -161,30 +256,66 @@ class BaseTransformer(nn.Module):
         # For kv cache
         self.max_batch_size = -1
         self.max_seq_len = -1
+        self.page_size = None
+        self.page_allocator = None
 
         if init_weights:
             self.apply(self._init_weights)
 
     def setup_caches(
-        self, max_batch_size: int, max_seq_len: int, dtype: torch.dtype = torch.bfloat16, device: torch.device = "cuda"
+        self, max_batch_size: int, max_seq_len: int, dtype: torch.dtype = torch.bfloat16, device: torch.device = "cuda",
+        page_size: Optional[int] = None, num_pages: Optional[int] = None,
     ):
-        if self.max_seq_len >= max_seq_len and self.max_batch_size >= max_batch_size:
+        """
+        Allocate the KV caches of forward_generate.
+        By default every layer gets a dense (max_batch_size, heads, max_seq_len, head_dim) cache. With page_size,
+        the layers share a pool of num_pages pages of page_size positions instead (PagedKVCache), taken by
+        sequences as they grow and returned at eos, so memory is bounded by the pool rather than by
+        max_batch_size x max_seq_len.
+        """
+        if (self.max_seq_len >= max_seq_len and self.max_batch_size >= max_batch_size
+                and self.page_size == page_size):
             return
+        if page_size is not None and not num_pages:
+            raise ValueError("A paged KV cache needs num_pages")
 
         head_dim = self.config.dim // self.config.n_head
-        max_seq_len = find_multiple(max_seq_len, 8)
+        max_seq_len = find_multiple(max_seq_len, page_size or 8)
         self.max_seq_len = max_seq_len
         self.max_batch_size = max_batch_size
+        self.page_size = page_size
+
+        if page_size is None:
+            self.page_allocator = None
+            for b in self.layers:
+                b.attention.kv_cache = KVCache(
+                    max_batch_size,
+                    max_seq_len,
+                    self.config.n_local_heads,
+                    head_dim,
+                    dtype=dtype,
+                ).to(device)
+            return
 
+        self.page_allocator = PageAllocator(num_pages, page_size, max_batch_size, max_seq_len // page_size, device)
         for b in self.layers:
-            b.attention.kv_cache = KVCache(
-                max_batch_size,
-                max_seq_len,
+            b.attention.kv_cache = PagedKVCache(
+                self.page_allocator,
                 self.config.n_local_heads,
                 head_dim,
                 dtype=dtype,
             ).to(device)
 
+    def reserve_kv(self, row: int, length: int):
+        """Back KV positions [0, length) of a batch row with cache pages, no-op for dense caches"""
+        if self.page_allocator is not None:
+            self.page_allocator.reserve(row, length)
+
+    def release_kv(self, row: int):
+        """Return the cache pages of a finished batch row, no-op for dense caches"""
+        if self.page_allocator is not None:
+            self.page_allocator.release(row)
+
     def embed_base(self, x: Tensor, x_lens: Tensor) -> Tensor:
         for bib in range(x.size(0)):
             x[bib, x_lens[bib]:] = self.config.vocab_size - 1
@@ -248,13 +379,18 @@ class BaseTransformer(nn.Module):
         x = inp
         max_seq_len = self.max_seq_len
 
-        mask = self.causal_mask[None, None, kv_pos, :max_seq_len]  # (B, N, Q, K)
+        if kv_pos.dim() == 1:
+            mask = self.causal_mask[None, None, kv_pos, :max_seq_len]  # (B, N, Q, K)
+        else:
+            # per-row positions, (B, S) -> (B, 1, S, K)
+            mask = self.causal_mask[kv_pos][:, None, :, :max_seq_len]
         freqs_cis = self.freqs_cis[input_pos]
 
         for layer in self.layers:
             x = layer(x, freqs_cis, mask, input_pos=kv_pos)
 
-        x = x[:, -1:]
+        if not return_all:
+            x = x[:, -1:]
 
         # We got slow_out here
         slow_out = self.norm(x)
@@ -323,8 +459,9 @@ class NaiveTransformer(BaseTransformer):
         input_pos: Optional[Tensor] = None,
         kv_pos: Optional[Tensor] = None,
         vq_masks: Optional[Tensor] = None,
+        return_all: bool = False,
     ) -> TransformerForwardResult:
-        x = super().forward_generate(x, input_pos, kv_pos, vq_masks)
+        x = super().forward_generate(x, input_pos, kv_pos, return_all=return_all)
         return x
 
 class NaiveWrapper(nn.Module):
@@ -333,8 +470,11 @@ class NaiveWrapper(nn.Module):
         self.model = model
         self.sep_token_emb = nn.Parameter(torch.randn(model.config.dim))
 
-    def setup_caches(self, max_batch_size: int, max_seq_len: int, dtype: torch.dtype = torch.bfloat16, device: torch.device = "cuda"):
-        self.model.setup_caches(max_batch_size, max_seq_len, dtype, device)
+    def setup_caches(
+        self, max_batch_size: int, max_seq_len: int, dtype: torch.dtype = torch.bfloat16, device: torch.device = "cuda",
+        page_size: Optional[int] = None, num_pages: Optional[int] = None,
+    ):
+        self.model.setup_caches(max_batch_size, max_seq_len, dtype, device, page_size=page_size, num_pages=num_pages)
 
     def forward(self, cond: Tensor, cond_lens: Tensor, x: Tensor, x_lens: Tensor) -> torch.Tensor:
         # style_emb = self.style_in(style).unsqueeze(1)  #  [B, 1, D]
@@ -384,69 +524,199 @@ class NaiveWrapper(nn.Module):
             prompt_text,
             prompt_target,
             compiled_decode_fn = None,
+            max_new_tokens: int = 4000,
+            num_draft_tokens: int = 0,
             **sampling_kwargs,
     ):
-        sep_token_emb = self.sep_token_emb.expand(1, 1, -1)
-        emb_seq = torch.cat([sep_token_emb, prompt_text, sep_token_emb], dim=1)
-        input_pos = torch.arange(prompt_text.size(1) + 1, device=emb_seq.device)
-        input_pos = torch.cat([input_pos, torch.LongTensor([0]).to(emb_seq.device)])
-        prompt_target_emb = self.model.embed_base(prompt_target,torch.LongTensor([prompt_target.size(1)]).to(prompt_target.device))[1]
-        emb_seq = torch.cat([emb_seq, prompt_target_emb], dim=1)
-        input_pos = torch.cat([input_pos, torch.arange(prompt_target_emb.size(1)).to(input_pos.device) + 1])
+        """
+        Sample content tokens after [sep, prompt_text, sep, prompt_target] until eos or max_new_tokens.
+        With num_draft_tokens > 0 decoding is speculative, see generate_speculative.
 
-        pred_codes = []
-        kv_pos = torch.arange(emb_seq.size(1), device=emb_seq.device)
-        next_tokens = self.decode_one_token_ar(emb_seq, input_pos, kv_pos, suppress_tokens=[self.model.config.vocab_size - 1], **sampling_kwargs)
-        pred_base = next_tokens[0]
-        pred_codes.append(pred_base)
-        new_emb = self.model.embed_base(pred_base.unsqueeze(0), torch.LongTensor([1]).to(pred_base.device))[1]
-        emb_seq = torch.cat([emb_seq, new_emb], dim=1)
-        for _ in tqdm(range(4000)):
-            suppress_eos = len(pred_codes) < 10
-            input_pos = input_pos[-1:] + 1
-            kv_pos = kv_pos[-1:] + 1
-            next_tokens = self.decode_one_token_ar(
-                emb_seq[:, -1:].reshape(1, 1, -1),
-                input_pos.reshape(1),
-                kv_pos.reshape(1),
-                previous_tokens=torch.cat(pred_codes),
-                suppress_tokens=[self.model.config.vocab_size - 1] if suppress_eos else None,
-                compiled_decode_fn=compiled_decode_fn,
-                **sampling_kwargs)
-            pred_base = next_tokens[0]
-            if pred_base == self.model.config.vocab_size - 1:
-                break
-            pred_codes.append(pred_base.clone())
-            new_emb = self.model.embed_base(pred_base.unsqueeze(0), torch.LongTensor([1]).to(pred_base.device))[1]
-            emb_seq = torch.cat([emb_seq, new_emb], dim=1)
-        return torch.stack(pred_codes, dim=-1)
+        Returns:
+            (1, T) long tensor of generated tokens, eos excluded
+        """
+        return self.generate_batch([prompt_text], [prompt_target], compiled_decode_fn=compiled_decode_fn,
+                                   max_new_tokens=max_new_tokens, num_draft_tokens=num_draft_tokens,
+                                   **sampling_kwargs)[0]
 
-    def decode_one_token_ar(
+    @torch.no_grad()
+    def generate_batch(
             self,
-            x: torch.Tensor,
-            input_pos: torch.Tensor,
-            kv_pos: torch.Tensor,
-            previous_tokens: torch.Tensor = None,
+            prompt_texts: List[Tensor],
+            prompt_targets: List[Tensor],
             compiled_decode_fn = None,
+            max_new_tokens: int = 4000,
+            num_draft_tokens: int = 0,
             **sampling_kwargs,
-    ) -> torch.Tensor:
-        if compiled_decode_fn is not None:
-            x = compiled_decode_fn(x, input_pos, kv_pos)
-        else:
-            x = self.model.forward_generate(x, input_pos, kv_pos)
-
-        sampling_kwargs_main = sampling_kwargs.copy()
-        codebooks = [
-            sample(
-                x.logits,
-                previous_tokens=(
-                    previous_tokens[0] if previous_tokens is not None else None
-                ),
-                **sampling_kwargs_main,
-            )[0]
-        ]
-        codebooks = torch.stack(codebooks, dim=0)
-        return codebooks
+    ) -> List[Tensor]:
+        """
+        Decode several prompts together, one KV cache row each.
+        Prompts may have different lengths, every row keeps its own rope and KV positions and stops growing once
+        it samples eos; decoding ends when all rows are finished or after max_new_tokens.
+        The tokens, the next input embeddings, the positions and the sampler state are allocated once up front
+        and updated in place, so the decode loop does not grow or rebuild anything per token.
+
+        Args:
+            prompt_texts: (1, T_i, D) conditions, at most the max_batch_size given to setup_caches
+            prompt_targets: (1, T'_i) target token prompts, may be empty
+            num_draft_tokens: Decode a single prompt speculatively with drafts of this many tokens, 0 disables
+
+        Returns:
+            List of (1, T_out_i) long tensors of generated tokens, eos excluded
+        """
+        batch_size = len(prompt_texts)
+        if batch_size > self.model.max_batch_size:
+            raise ValueError(f"Cannot decode {batch_size} prompts together, the AR KV cache was set up for "
+                             f"{self.model.max_batch_size}, see setup_caches")
+        if num_draft_tokens > 0 and batch_size == 1:
+            return [self.generate_speculative(prompt_texts[0], prompt_targets[0], num_draft_tokens,
+                                              max_new_tokens=max_new_tokens, **sampling_kwargs)]
+        device = prompt_texts[0].device
+        eos_token = self.model.config.vocab_size - 1
+
+        emb_seqs = []
+        rope_pos = []
+        for prompt_text, prompt_target in zip(prompt_texts, prompt_targets):
+            emb, pos = self._prompt_embedding(prompt_text, prompt_target)
+            emb_seqs.append(emb)
+            rope_pos.append(pos)
+        prompt_len_list = [emb.size(0) for emb in emb_seqs]
+        prompt_lens = torch.LongTensor(prompt_len_list).to(device)
+        # ragged prompts are right-padded, a row overwrites its padded KV slots with its own tokens
+        # before the causal mask lets it attend to them
+        emb_seq = nn.utils.rnn.pad_sequence(emb_seqs, batch_first=True)
+        input_pos = nn.utils.rnn.pad_sequence(rope_pos, batch_first=True)
+        kv_pos = torch.arange(emb_seq.size(1), device=device).expand(batch_size, -1)
+
+        sampler = NucleusSampler(self.model.config.vocab_size, batch_size, device, suppress_tokens=[eos_token],
+                                 **sampling_kwargs)
+        tokens = torch.empty(max_new_tokens + 1, batch_size, dtype=torch.long, device=device)
+        token_emb = torch.empty(batch_size, 1, self.model.config.dim, dtype=self.model.embeddings.weight.dtype, device=device)
+        lengths = torch.ones(batch_size, dtype=torch.long, device=device)
+        active = torch.ones(batch_size, dtype=torch.bool, device=device)
+        not_eos = torch.empty(batch_size, dtype=torch.bool, device=device)
+
+        # with a paged KV cache, rows take pages as they grow and give them back at eos
+        paged = self.model.page_allocator is not None
+        live_rows = list(range(batch_size))
+        try:
+            # prefill the KV cache with the whole prompts, eager since their lengths vary per call
+            for b in live_rows:
+                self.model.reserve_kv(b, prompt_len_list[b])
+            rows = torch.arange(batch_size, device=device)
+            logits = self.model.forward_generate(emb_seq, input_pos, kv_pos, return_all=True).logits
+            tokens[0] = sampler.sample(logits[rows, prompt_lens - 1][:, None], suppress=True)
+            input_pos = input_pos[rows, prompt_lens - 1][:, None] + 1
+            kv_pos = prompt_lens[:, None].clone()
+            decode_fn = compiled_decode_fn if compiled_decode_fn is not None else self.model.forward_generate
+
+            num_tokens = 1
+            for _ in tqdm(range(max_new_tokens)):
+                for b in live_rows:
+                    self.model.reserve_kv(b, prompt_len_list[b] + num_tokens)
+                torch.index_select(self.model.embeddings.weight, 0, tokens[num_tokens - 1], out=token_emb.view(batch_size, -1))
+                logits = decode_fn(token_emb, input_pos, kv_pos).logits
+                tokens[num_tokens] = sampler.sample(logits, suppress=num_tokens < 10)
+                torch.ne(tokens[num_tokens], eos_token, out=not_eos)
+                active.logical_and_(not_eos)
+                if paged:
+                    row_active = active.tolist()
+                    for b in live_rows:
+                        if not row_active[b]:
+                            self.model.release_kv(b)
+                    live_rows = [b for b in live_rows if row_active[b]]
+                    if not live_rows:
+                        break
+                elif not active.any():
+                    break
+                lengths.add_(active)
+                num_tokens += 1
+                input_pos.add_(1)
+                kv_pos.add_(1)
+        finally:
+            for b in range(batch_size):
+                self.model.release_kv(b)
+        return [tokens[:length, b][None] for b, length in enumerate(lengths.tolist())]
+
+    def _prompt_embedding(self, prompt_text: Tensor, prompt_target: Tensor) -> Tuple[Tensor, Tensor]:
+        """Embeddings (L, D) and rope positions (L,) of [sep, prompt_text, sep, prompt_target]"""
+        device = prompt_text.device
+        sep_token_emb = self.sep_token_emb.expand(1, 1, -1)
+        prompt_target_emb = self.model.embed_base(prompt_target, torch.LongTensor([prompt_target.size(1)]).to(device))[1]
+        emb_seq = torch.cat([sep_token_emb, prompt_text, sep_token_emb, prompt_target_emb], dim=1)[0]
+        rope_pos = torch.cat([
+            torch.arange(prompt_text.size(1) + 1, device=device),
+            torch.arange(prompt_target_emb.size(1) + 1, device=device),
+        ])
+        return emb_seq, rope_pos
+
+    @torch.no_grad()
+    def generate_speculative(
+            self,
+            prompt_text: Tensor,
+            prompt_target: Tensor,
+            num_draft_tokens: int = 4,
+            max_new_tokens: int = 4000,
+            max_ngram: int = 3,
+            **sampling_kwargs,
+    ) -> Tensor:
+        """
+        Speculative version of generate for a single prompt.
+        A PromptLookupDrafter proposes up to num_draft_tokens tokens, the model scores the last token and the draft
+        in one forward_generate call and NucleusSampler.verify accepts a prefix of the draft. The output follows the
+        same distribution as generate, every call yields at least one token and up to num_draft_tokens + 1.
+        Rejected drafts need no KV cleanup, their slots lie past the next position and are masked until overwritten.
+        Verification calls vary in length, so this runs the eager model.
+
+        Returns:
+            (1, T) long tensor of generated tokens, eos excluded
+        """
+        device = prompt_text.device
+        eos_token = self.model.config.vocab_size - 1
+        emb_seq, rope_pos = self._prompt_embedding(prompt_text, prompt_target)
+        prompt_len = emb_seq.size(0)
+        sampler = NucleusSampler(self.model.config.vocab_size, 1, device, suppress_tokens=[eos_token], **sampling_kwargs)
+
+        try:
+            self.model.reserve_kv(0, prompt_len)
+            logits = self.model.forward_generate(emb_seq[None], rope_pos[None],
+                                                 torch.arange(prompt_len, device=device)[None]).logits
+            generated = [int(sampler.sample(logits, suppress=True))]
+            drafter = PromptLookupDrafter(prompt_target[0].tolist() + generated, max_ngram=max_ngram)
+            next_rope_pos = int(rope_pos[-1]) + 1
+            next_kv_pos = prompt_len
+            offsets = torch.arange(num_draft_tokens + 1, device=device)
+
+            while len(generated) <= max_new_tokens:
+                draft = drafter.draft(num_draft_tokens)
+                step_tokens = torch.LongTensor([generated[-1]] + draft).to(device)
+                seq_len = step_tokens.size(0)
+                self.model.reserve_kv(0, next_kv_pos + seq_len)
+                logits = self.model.forward_generate(
+                    self.model.embeddings(step_tokens)[None],
+                    (next_rope_pos + offsets[:seq_len])[None],
+                    (next_kv_pos + offsets[:seq_len])[None],
+                    return_all=True,
+                ).logits
+                # logits[:, j] is the distribution after step_tokens[j]: it verifies draft[j], the last one is a free token
+                for j in range(seq_len):
+                    suppress = len(generated) < 10
+                    if j < len(draft):
+                        token, accepted = sampler.verify(logits[:, j:j + 1], draft[j], suppress=suppress)
+                    else:
+                        token, accepted = sampler.sample(logits[:, j:j + 1], suppress=suppress), False
+                    token = int(token)
+                    if token == eos_token:
+                        return torch.LongTensor(generated).to(device)[None]
+                    generated.append(token)
+                    drafter.append(token)
+                    if not accepted or len(generated) > max_new_tokens:
+                        break
+                next_rope_pos += j + 1
+                next_kv_pos += j + 1
+            return torch.LongTensor(generated).to(device)[None]
+        finally:
+            self.model.release_kv(0)
 
 class TransformerBlock(nn.Module):
     def __init__(self, config: BaseModelArgs, use_sdpa: bool = True) -> None:
@@ -531,12 +801,24 @@ class Attention(nn.Module):
 
         if self.kv_cache is not None:
             k, v = self.kv_cache.update(input_pos, k, v)
+            if mask is not None and mask.size(-1) > k.size(2):
+                # a paged cache only returns the pages in use
+                mask = mask[..., :k.size(2)]
 
-        k = k.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        v = v.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
+        if self.use_sdpa and mask is not None:
+            # generation and padded batches: K/V stay at n_local_heads, no per-query-head copy of the cache
+            y = grouped_scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=mask,
+                dropout_p=self.dropout if self.training else 0.0,
+            )
+        else:
+            k = k.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
+            v = v.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
 
-        if self.use_sdpa:
-            if mask is None:
+            if self.use_sdpa:
                 y = F.scaled_dot_product_attention(
                     q,
                     k,
@@ -546,21 +828,13 @@ class Attention(nn.Module):
                     # No third party attn_mask here to use flash_attention
                 )
             else:
-                y = F.scaled_dot_product_attention(
+                y = self.eq_scaled_dot_product_attention(
                     q,
                     k,
                     v,
                     attn_mask=mask,
                     dropout_p=self.dropout if self.training else 0.0,
                 )
-        else:
-            y = self.eq_scaled_dot_product_attention(
-                q,
-                k,
-                v,
-                attn_mask=mask,
-                dropout_p=self.dropout if self.training else 0.0,
-            )
 
         y = y.transpose(1, 2).contiguous().view(bsz, seqlen, self.dim)
 
@@ -761,3 +1035,137 @@ def logits_to_probs(
 
     probs = torch.nn.functional.softmax(logits, dim=-1)
     return probs
+
+
+class NucleusSampler:
+    """
+    Sampling of one token per row and decode step with the same semantics as logits_to_probs +
+    multinomial_sample_one_no_sync: a repetition penalty on every token the row sampled so far, then top-p
+    filtering and temperature.
+
+    Top-p only considers the top_k most likely tokens, so a single topk replaces the full-vocabulary sort. The
+    cumulative probabilities are still normalized over the whole vocabulary, the result is exact whenever the
+    nucleus fits into top_k tokens. The penalty factors are kept up to date as tokens are sampled instead of
+    being gathered from the token history, and all buffers are allocated once per generation.
+    """
+
+    def __init__(
+            self,
+            vocab_size: int,
+            batch_size: int,
+            device: torch.device,
+            suppress_tokens: Optional[List[int]] = None,
+            top_k: int = 64,
+            top_p: float = 0.7,
+            temperature: float = 0.7,
+            repetition_penalty: float = 1.5,
+    ):
+        self.top_k = min(top_k, vocab_size)
+        self.top_p = top_p
+        self.inv_temperature = 1.0 / max(temperature, 1e-5)
+        self.repetition_penalty = repetition_penalty
+        self.suppress_index = torch.tensor(suppress_tokens or [], dtype=torch.long, device=device)
+
+        # per-token multipliers of negative and positive logits, 1 until the token is sampled, then
+        # repetition_penalty and 1 / repetition_penalty
+        self.negative_factor = torch.ones(batch_size, vocab_size, device=device)
+        self.positive_factor = torch.ones(batch_size, vocab_size, device=device)
+        self.factor = torch.empty(batch_size, vocab_size, device=device)
+        self.negative = torch.empty(batch_size, vocab_size, dtype=torch.bool, device=device)
+        self.logits = torch.empty(batch_size, vocab_size, device=device)
+
+        self.values = torch.empty(batch_size, self.top_k, device=device)
+        self.indices = torch.empty(batch_size, self.top_k, dtype=torch.long, device=device)
+        self.cum_probs = torch.empty(batch_size, self.top_k, device=device)
+        self.remove = torch.empty(batch_size, self.top_k, dtype=torch.bool, device=device)
+        self.scores = torch.empty(batch_size, self.top_k, device=device)
+        self.noise = torch.empty(batch_size, self.top_k, device=device)
+        self.log_normalizer = torch.empty(batch_size, 1, device=device)
+        self.choice = torch.empty(batch_size, 1, dtype=torch.long, device=device)
+        self.sampled = torch.empty(batch_size, 1, dtype=torch.long, device=device)
+
+    def _filter(self, logits: Tensor, suppress: bool):
+        """Fill self.scores with the tempered log-probabilities (up to a constant) of the top-p candidates"""
+        logits_ = self.logits
+        logits_.copy_(logits[:, -1])
+
+        # repetition penalty
+        torch.lt(logits_, 0, out=self.negative)
+        torch.where(self.negative, self.negative_factor, self.positive_factor, out=self.factor)
+        logits_.mul_(self.factor)
+        if suppress:
+            logits_.index_fill_(1, self.suppress_index, -float("Inf"))
+
+        # top-p within the top-k candidates, probabilities normalized over the full vocabulary
+        torch.topk(logits_, self.top_k, dim=-1, out=(self.values, self.indices))
+        torch.logsumexp(logits_, dim=-1, keepdim=True, out=self.log_normalizer)
+        torch.sub(self.values, self.log_normalizer, out=self.cum_probs)
+        self.cum_probs.exp_()
+        self.cum_probs.cumsum_(dim=-1)
+        torch.gt(self.cum_probs, self.top_p, out=self.remove)
+        self.remove[:, 0] = False  # keep at least one option
+
+        torch.mul(self.values, self.inv_temperature, out=self.scores)
+        self.scores.masked_fill_(self.remove, -float("Inf"))
+
+    def _pick(self) -> Tensor:
+        # argmax(log p + Gumbel noise), the log-space form of multinomial_sample_one_no_sync
+        self.noise.exponential_(1).log_().neg_()
+        self.noise.add_(self.scores)
+        torch.argmax(self.noise, dim=-1, keepdim=True, out=self.choice)
+        torch.gather(self.indices, 1, self.choice, out=self.sampled)
+        return self._commit()
+
+    def _commit(self) -> Tensor:
+        self.negative_factor.scatter_(1, self.sampled, self.repetition_penalty)
+        self.positive_factor.scatter_(1, self.sampled, 1.0 / self.repetition_penalty)
+        return self.sampled[:, 0]
+
+    def sample(self, logits: Tensor, suppress: bool = False) -> Tensor:
+        """Sample one token per row from the last position of logits (B, S, V), returns a (B,) view of an internal buffer"""
+        self._filter(logits, suppress)
+        return self._pick()
+
+    def verify(self, logits: Tensor, draft: int, suppress: bool = False) -> Tuple[Tensor, bool]:
+        """
+        Speculative sampling against a deterministic draft token, single row.
+        The draft is kept with its probability p(draft), otherwise the token is sampled from p with the draft removed,
+        so the result is distributed exactly like sample(). Returns (token, whether the draft was accepted).
+        """
+        self._filter(logits, suppress)
+        draft_hit = self.indices == draft
+        draft_prob = torch.softmax(self.scores, dim=-1)[draft_hit].sum().item()
+        if torch.rand(()).item() < draft_prob:
+            self.sampled.fill_(draft)
+            return self._commit(), True
+        self.scores.masked_fill_(draft_hit, -float("Inf"))
+        return self._pick(), False
+
+
+class PromptLookupDrafter:
+    """
+    Drafts the tokens that followed the most recent earlier occurrence of the current suffix n-gram
+    (prompt lookup decoding) in the target prompt and the tokens generated so far.
+    Content tokens repeat a lot, so the drafts are accepted often and cost no model call.
+    """
+
+    def __init__(self, tokens: List[int], max_ngram: int = 3):
+        self.max_ngram = max_ngram
+        self.tokens = []
+        # n-gram -> index of the token that followed its latest occurrence
+        self.continuations = {}
+        for token in tokens:
+            self.append(token)
+
+    def append(self, token: int):
+        for n in range(1, min(self.max_ngram, len(self.tokens)) + 1):
+            self.continuations[tuple(self.tokens[-n:])] = len(self.tokens)
+        self.tokens.append(token)
+
+    def draft(self, num_tokens: int) -> List[int]:
+        """Up to num_tokens tokens, longest matching n-gram first, empty if nothing matches"""
+        for n in range(min(self.max_ngram, len(self.tokens)), 0, -1):
+            start = self.continuations.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start:start + num_tokens]
+        return []
@@ -0,0 +1,192 @@
+import struct
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from modules.v2 import metrics
+
+
+def float_to_int16(wave: np.ndarray) -> np.ndarray:
+    """Convert a float waveform in [-1, 1] to little-endian int16 samples."""
+    return (np.clip(wave, -1.0, 1.0) * 32767.0).astype("<i2")
+
+
+class StreamEncoder:
+    """
+    Turns successive float waveform chunks into the bytes of one continuous audio stream.
+    The concatenation of header(), every encode() and close() is a complete file in `media_type`.
+    """
+    media_type = "application/octet-stream"
+
+    def __init__(self, sr: int):
+        self.sr = sr
+        self.closed = False
+
+    def header(self) -> bytes:
+        return b""
+
+    def encode(self, wave: np.ndarray) -> bytes:
+        raise NotImplementedError
+
+    def close(self) -> bytes:
+        self.closed = True
+        return b""
+
+
+class PCMStreamEncoder(StreamEncoder):
+    """Headerless 16-bit little-endian mono PCM."""
+    media_type = "audio/L16"
+
+    def encode(self, wave: np.ndarray) -> bytes:
+        return float_to_int16(wave).tobytes()
+
+
+class Float32PCMStreamEncoder(StreamEncoder):
+    """Headerless 32-bit float little-endian mono PCM."""
+
+    def encode(self, wave: np.ndarray) -> bytes:
+        return np.asarray(wave, dtype="<f4").tobytes()
+
+
+class WavStreamEncoder(PCMStreamEncoder):
+    """
+    16-bit PCM WAV whose header is sent before the length is known.
+    RIFF and data sizes are set to 0xFFFFFFFF, the usual convention for streamed WAV.
+    """
+    media_type = "audio/wav"
+
+    def header(self) -> bytes:
+        return struct.pack(
+            "<4sI4s4sIHHIIHH4sI",
+            b"RIFF", 0xFFFFFFFF, b"WAVE",
+            b"fmt ", 16, 1, 1, self.sr, self.sr * 2, 2, 16,
+            b"data", 0xFFFFFFFF,
+        )
+
+
+class FFmpegStreamEncoder(StreamEncoder):
+    """
+    Encodes through one long-lived ffmpeg process fed with PCM on stdin, so the codec state
+    carries over between chunks and the output is a single valid stream.
+    encode() returns whatever ffmpeg has produced so far, the remainder is flushed by close().
+    """
+    codec_args = []
+
+    def __init__(self, sr: int):
+        super().__init__(sr)
+        self._output = bytearray()
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error", "-f", "s16le", "-ar", str(sr), "-ac", "1", "-i", "pipe:0",
+             *self.codec_args, "pipe:1"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self._reader = threading.Thread(target=self._read_output, daemon=True)
+        self._reader.start()
+
+    def _read_output(self):
+        for data in iter(lambda: self._process.stdout.read1(1 << 16), b""):
+            with self._lock:
+                self._output += data
+
+    def _drain(self) -> bytes:
+        with self._lock:
+            data = bytes(self._output)
+            self._output.clear()
+        return data
+
+    def encode(self, wave: np.ndarray) -> bytes:
+        self._process.stdin.write(float_to_int16(wave).tobytes())
+        self._process.stdin.flush()
+        return self._drain()
+
+    def close(self) -> bytes:
+        if self.closed:
+            return b""
+        self.closed = True
+        self._process.stdin.close()
+        self._reader.join()
+        self._process.wait()
+        return self._drain()
+
+
+class OpusStreamEncoder(FFmpegStreamEncoder):
+    """Ogg/Opus, ffmpeg resamples to 48 kHz internally as Opus requires."""
+    media_type = "audio/ogg"
+    codec_args = ["-c:a", "libopus", "-b:a", "64k", "-f", "ogg"]
+
+
+class Mp3StreamEncoder(FFmpegStreamEncoder):
+    """MP3 at 320 kbps, the bitrate the v2 wrapper always used for its streamed chunks."""
+    media_type = "audio/mpeg"
+    codec_args = ["-c:a", "libmp3lame", "-b:a", "320k", "-f", "mp3"]
+
+
+STREAM_ENCODERS = {
+    "pcm": PCMStreamEncoder,
+    "pcm_s16le": PCMStreamEncoder,
+    "pcm_f32le": Float32PCMStreamEncoder,
+    "wav": WavStreamEncoder,
+    "opus": OpusStreamEncoder,
+    "mp3": Mp3StreamEncoder,
+}
+
+
+def get_stream_encoder(stream_format: str, sr: int) -> StreamEncoder:
+    if stream_format not in STREAM_ENCODERS:
+        raise ValueError(f"Unknown stream format: {stream_format}, expected one of {list(STREAM_ENCODERS)}")
+    return STREAM_ENCODERS[stream_format](sr)
+
+
+class BackgroundStreamEncoder:
+    """
+    Runs a StreamEncoder on its own worker thread so encoding a chunk overlaps with generating the next.
+    Chunks are encoded strictly in submission order, the first output carries the encoder header.
+    """
+
+    def __init__(self, encoder: StreamEncoder):
+        self.encoder = encoder
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stream-encoder")
+        self._pending = deque()
+        self._header_sent = False
+        self._done = False
+
+    def _encode(self, wave: np.ndarray, with_header: bool) -> bytes:
+        with metrics.stage("encode"):
+            data = self.encoder.encode(wave)
+        return self.encoder.header() + data if with_header else data
+
+    def submit(self, wave: np.ndarray):
+        self._pending.append(self._pool.submit(self._encode, wave, not self._header_sent))
+        self._header_sent = True
+
+    def ready(self) -> list:
+        """Outputs of the chunks that have finished encoding, without blocking; empty outputs are dropped."""
+        outputs = []
+        while self._pending and self._pending[0].done():
+            outputs.append(self._pending.popleft().result())
+        return [data for data in outputs if data]
+
+    def finish(self) -> list:
+        """Wait for every pending chunk and flush the encoder, the last element is the (possibly empty) tail."""
+        outputs = [future.result() for future in self._pending]
+        self._pending.clear()
+        self._done = True
+        tail = self._pool.submit(self.encoder.close).result()
+        self._pool.shutdown()
+        return [data for data in outputs if data] + [tail]
+
+    def close(self):
+        """Abandon the stream, safe to call after finish()."""
+        if self._done:
+            return
+        self._done = True
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._pool.submit(self.encoder.close)
+        self._pool.shutdown(wait=False)
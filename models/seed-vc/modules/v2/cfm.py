@@ -1,5 +1,7 @@
 import torch
 from tqdm import tqdm
+from modules.commons import sequence_mask
+from modules.v2 import metrics
 
 class CFM(torch.nn.Module):
     def __init__(
@@ -12,6 +14,9 @@ class CFM(torch.nn.Module):
         self.in_channels = estimator.in_channels
         self.criterion = torch.nn.L1Loss()
 
+    # ODE solvers accepted by inference, see solve
+    SOLVERS = ("euler", "heun", "midpoint", "multistep", "adaptive")
+
     @torch.inference_mode()
     def inference(self,
                   mu: torch.Tensor,
@@ -22,6 +27,11 @@ class CFM(torch.nn.Module):
                   temperature=1.0,
                   inference_cfg_rate=[0.5, 0.5],
                   random_voice=False,
+                  prompt_lens=None,
+                  solver="euler",
+                  rtol=0.05,
+                  atol=0.05,
+                  step_cache=None,
                   ):
         """Forward diffusion
 
@@ -34,20 +44,32 @@ class CFM(torch.nn.Module):
                 shape: (batch_size, n_feats, prompt_len)
             style (torch.Tensor): style
                 shape: (batch_size, style_dim)
-            n_timesteps (int): number of diffusion steps
+            n_timesteps (int): number of diffusion steps, the initial step size for the adaptive solver
             temperature (float, optional): temperature for scaling noise. Defaults to 1.0.
             inference_cfg_rate (float, optional): Classifier-Free Guidance inference introduced in VoiceBox. Defaults to 0.5.
+            prompt_lens (torch.Tensor, optional): per-sequence prompt length for batches whose prompts
+                differ in length, prompt is then zero padded to the longest one. Defaults to prompt.size(-1) for all.
+                shape: (batch_size,)
+            solver (str, optional): one of SOLVERS, see solve. Defaults to "euler".
+            rtol (float, optional): relative tolerance of the adaptive solver. Defaults to 0.05.
+            atol (float, optional): absolute tolerance of the adaptive solver. Defaults to 0.05.
+            step_cache (StepCacheConfig, optional): reuse deep DiT features across estimator calls,
+                see modules.v2.dit_wrapper.StepCacheConfig. Defaults to None, every call runs in full.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
+        if solver not in self.SOLVERS:
+            raise ValueError(f"Unknown solver: {solver}, expected one of {self.SOLVERS}")
         B, T = mu.size(0), mu.size(1)
         z = torch.randn([B, self.in_channels, T], device=mu.device) * temperature
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device)
         t_span = t_span + (-1) * (torch.cos(torch.pi / 2 * t_span) - 1 + t_span)
-        return self.solve_euler(z, x_lens, prompt, mu, style, t_span, inference_cfg_rate, random_voice)
-    def solve_euler(self, x, x_lens, prompt, mu, style, t_span, inference_cfg_rate=[0.5, 0.5], random_voice=False,):
+        return self.solve(z, x_lens, prompt, mu, style, t_span, inference_cfg_rate, random_voice, prompt_lens,
+                          solver=solver, rtol=rtol, atol=atol, step_cache=step_cache)
+
+    def solve_euler(self, x, x_lens, prompt, mu, style, t_span, inference_cfg_rate=[0.5, 0.5], random_voice=False, prompt_lens=None):
         """
         Fixed euler solver for ODEs.
         Args:
@@ -63,74 +85,132 @@ class CFM(torch.nn.Module):
             style (torch.Tensor): style
                 shape: (batch_size, style_dim)
             inference_cfg_rate (float, optional): Classifier-Free Guidance inference introduced in VoiceBox. Defaults to 0.5.
-            sway_sampling (bool, optional): Sway sampling. Defaults to False.
-            amo_sampling (bool, optional): AMO sampling. Defaults to False.
+            random_voice (bool, optional): drop prompt and style to sample a random speaker. Defaults to False.
+            prompt_lens (torch.Tensor, optional): per-sequence prompt length. Defaults to prompt.size(-1) for all.
+                shape: (batch_size,)
+        """
+        return self.solve(x, x_lens, prompt, mu, style, t_span, inference_cfg_rate, random_voice, prompt_lens,
+                          solver="euler")
+
+    def solve(self, x, x_lens, prompt, mu, style, t_span, inference_cfg_rate=[0.5, 0.5], random_voice=False,
+              prompt_lens=None, solver="euler", rtol=0.05, atol=0.05, step_cache=None):
+        """
+        Integrate the flow from noise (t=0) to mel (t=1), arguments as in solve_euler.
+
+        Solvers, by estimator calls per step of t_span:
+            euler: first order, 1 call
+            heun: second order trapezoidal predictor-corrector, 2 calls
+            midpoint: second order Runge-Kutta, 2 calls
+            multistep: second order Adams-Bashforth on the velocity (DPM-Solver-2M style), reuses the previous
+                step's velocity so it costs 1 call like euler, the first step is euler
+            adaptive: embedded Heun/Euler pair with step size control against rtol/atol, 2 calls per step;
+                t_span only sets the first step size
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
+        B = x.size(0)
 
         # apply prompt
-        prompt_len = prompt.size(-1)
+        if prompt_lens is None:
+            prompt_lens = torch.full([B], prompt.size(-1), dtype=torch.long, device=x.device)
+        prompt_mask = sequence_mask(prompt_lens, max_length=x.size(-1)).unsqueeze(1)  # (B, 1, T), True inside prompt
         prompt_x = torch.zeros_like(x)
-        prompt_x[..., :prompt_len] = prompt[..., :prompt_len]
-        x[..., :prompt_len] = 0
+        prompt_x[..., :prompt.size(-1)] = prompt
+        prompt_x = prompt_x.masked_fill(~prompt_mask, 0)
+        x = x.masked_fill(prompt_mask, 0)
+
+        # CFG branches as (prompt, style, content) per branch plus the weights that combine their outputs;
+        # only x and t change between steps, so the batched conditioning is built once here
+        zero_prompt, zero_style, zero_mu = torch.zeros_like(prompt_x), torch.zeros_like(style), torch.zeros_like(mu)
+        if random_voice:
+            branches = [(zero_prompt, zero_style, mu), (zero_prompt, zero_style, zero_mu)]
+            weights = [1.0 + inference_cfg_rate[0], -inference_cfg_rate[0]]
+        elif all(i == 0 for i in inference_cfg_rate):
+            branches = [(prompt_x, style, mu)]
+            weights = [1.0]
+        elif inference_cfg_rate[0] == 0:
+            # Classifier-Free Guidance inference introduced in VoiceBox
+            branches = [(prompt_x, style, mu), (zero_prompt, zero_style, mu)]
+            weights = [1.0 + inference_cfg_rate[1], -inference_cfg_rate[1]]
+        elif inference_cfg_rate[1] == 0:
+            branches = [(prompt_x, style, mu), (zero_prompt, zero_style, zero_mu)]
+            weights = [1.0 + inference_cfg_rate[0], -inference_cfg_rate[0]]
+        else:
+            # Multi-condition Classifier-Free Guidance inference introduced in MegaTTS3
+            branches = [(prompt_x, style, mu), (zero_prompt, zero_style, mu), (zero_prompt, zero_style, zero_mu)]
+            weights = [1.0 + inference_cfg_rate[0] + inference_cfg_rate[1], -inference_cfg_rate[1], -inference_cfg_rate[0]]
+        k = len(branches)
+        cfg_prompt_x = torch.cat([branch[0] for branch in branches], dim=0)
+        cfg_style = torch.cat([branch[1] for branch in branches], dim=0)
+        cfg_mu = torch.cat([branch[2] for branch in branches], dim=0)
+        cfg_x_lens = x_lens.repeat(k)
+        if hasattr(self.estimator, "prepare"):
+            prepared = self.estimator.prepare(cfg_prompt_x, cfg_x_lens, cfg_style, cfg_mu, step_cache=step_cache)
+        elif step_cache is not None:
+            raise ValueError(f"{type(self.estimator).__name__} does not support step caching")
+        else:
+            prepared = None
+        # per-step inputs are copied into these instead of being concatenated anew
+        cfg_x = torch.empty((k * B,) + tuple(x.shape[1:]), dtype=x.dtype, device=x.device)
+        cfg_t = torch.empty(k * B, dtype=t_span.dtype, device=x.device)
+
+        def velocity(x, t):
+            """CFG-combined dphi/dt at (x, t), zero inside the prompt so the prompt region stays zero"""
+            with metrics.stage("cfm_step"):
+                cfg_x.view((k,) + tuple(x.shape)).copy_(x.unsqueeze(0).expand((k,) + tuple(x.shape)))
+                cfg_t.copy_(t.expand(k * B))
+                if prepared is not None:
+                    cfg_dphi_dt = self.estimator.forward_prepared(cfg_x, cfg_t, prepared)
+                else:
+                    cfg_dphi_dt = self.estimator(cfg_x, cfg_prompt_x, cfg_x_lens, cfg_t, cfg_style, cfg_mu)
+                outputs = cfg_dphi_dt.chunk(k, dim=0)
+                dphi_dt = weights[0] * outputs[0]
+                for weight, output in zip(weights[1:], outputs[1:]):
+                    dphi_dt = dphi_dt + weight * output
+            return dphi_dt.masked_fill(prompt_mask, 0)
+
+        if solver == "adaptive":
+            return self._solve_adaptive(x, velocity, t_span, rtol, atol)
+
+        dphi_dt_prev, dt_prev = None, None
         for step in tqdm(range(1, len(t_span))):
-            if random_voice:
-                cfg_dphi_dt = self.estimator(
-                    torch.cat([x, x], dim=0),
-                    torch.cat([torch.zeros_like(prompt_x), torch.zeros_like(prompt_x)], dim=0),
-                    torch.cat([x_lens, x_lens], dim=0),
-                    torch.cat([t.unsqueeze(0), t.unsqueeze(0)], dim=0),
-                    torch.cat([torch.zeros_like(style), torch.zeros_like(style)], dim=0),
-                    torch.cat([mu, torch.zeros_like(mu)], dim=0),
-                )
-                cond_txt, uncond = cfg_dphi_dt[0:1], cfg_dphi_dt[1:2]
-                dphi_dt = ((1.0 + inference_cfg_rate[0]) * cond_txt - inference_cfg_rate[0] * uncond)
-            elif all(i == 0 for i in inference_cfg_rate):
-                dphi_dt = self.estimator(x, prompt_x, x_lens, t.unsqueeze(0), style, mu)
-            elif inference_cfg_rate[0] == 0:
-                # Classifier-Free Guidance inference introduced in VoiceBox
-                cfg_dphi_dt = self.estimator(
-                    torch.cat([x, x], dim=0),
-                    torch.cat([prompt_x, torch.zeros_like(prompt_x)], dim=0),
-                    torch.cat([x_lens, x_lens], dim=0),
-                    torch.cat([t.unsqueeze(0), t.unsqueeze(0)], dim=0),
-                    torch.cat([style, torch.zeros_like(style)], dim=0),
-                    torch.cat([mu, mu], dim=0),
-                )
-                cond_txt_spk, cond_txt = cfg_dphi_dt[0:1], cfg_dphi_dt[1:2]
-                dphi_dt = ((1.0 + inference_cfg_rate[1]) * cond_txt_spk - inference_cfg_rate[1] * cond_txt)
-            elif inference_cfg_rate[1] == 0:
-                cfg_dphi_dt = self.estimator(
-                    torch.cat([x, x], dim=0),
-                    torch.cat([prompt_x, torch.zeros_like(prompt_x)], dim=0),
-                    torch.cat([x_lens, x_lens], dim=0),
-                    torch.cat([t.unsqueeze(0), t.unsqueeze(0)], dim=0),
-                    torch.cat([style, torch.zeros_like(style)], dim=0),
-                    torch.cat([mu, torch.zeros_like(mu)], dim=0),
-                )
-                cond_txt_spk, uncond = cfg_dphi_dt[0:1], cfg_dphi_dt[1:2]
-                dphi_dt = ((1.0 + inference_cfg_rate[0]) * cond_txt_spk - inference_cfg_rate[0] * uncond)
+            t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+            dphi_dt = velocity(x, t)
+            if solver == "euler" or (solver == "multistep" and dphi_dt_prev is None):
+                x = x + dt * dphi_dt
+            elif solver == "heun":
+                x = x + dt / 2 * (dphi_dt + velocity(x + dt * dphi_dt, t + dt))
+            elif solver == "midpoint":
+                x = x + dt * velocity(x + dt / 2 * dphi_dt, t + dt / 2)
             else:
-                # Multi-condition Classifier-Free Guidance inference introduced in MegaTTS3
-                cfg_dphi_dt = self.estimator(
-                    torch.cat([x, x, x], dim=0),
-                    torch.cat([prompt_x, torch.zeros_like(prompt_x), torch.zeros_like(prompt_x)], dim=0),
-                    torch.cat([x_lens, x_lens, x_lens], dim=0),
-                    torch.cat([t.unsqueeze(0), t.unsqueeze(0), t.unsqueeze(0)], dim=0),
-                    torch.cat([style, torch.zeros_like(style), torch.zeros_like(style)], dim=0),
-                    torch.cat([mu, mu, torch.zeros_like(mu)], dim=0),
-                )
-                cond_txt_spk, cond_txt, uncond = cfg_dphi_dt[0:1], cfg_dphi_dt[1:2], cfg_dphi_dt[2:3]
-                dphi_dt = (1.0 + inference_cfg_rate[0] + inference_cfg_rate[1]) * cond_txt_spk - \
-                    inference_cfg_rate[0] * uncond - inference_cfg_rate[1] * cond_txt
-            x = x + dt * dphi_dt
-            t = t + dt
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-            x[:, :, :prompt_len] = 0
+                # variable-step AB2: extrapolate the velocity linearly from the last two steps
+                r = dt / dt_prev
+                x = x + dt * ((1 + r / 2) * dphi_dt - r / 2 * dphi_dt_prev)
+            dphi_dt_prev, dt_prev = dphi_dt, dt
 
         return x
 
+    @staticmethod
+    def _solve_adaptive(x, velocity, t_span, rtol, atol, min_dt=1e-3):
+        """
+        Heun steps with the Heun/Euler difference as local error estimate, rejected and retried with a
+        smaller step when the RMS error relative to atol + rtol * |x| exceeds 1.
+        """
+        t = t_span[0]
+        dt = float(t_span[1] - t_span[0])
+        dphi_dt = velocity(x, t)
+        while 1.0 - float(t) > 1e-6:
+            dt = min(dt, 1.0 - float(t))
+            x_euler = x + dt * dphi_dt
+            x_heun = x + dt / 2 * (dphi_dt + velocity(x_euler, t + dt))
+            scale = atol + rtol * torch.maximum(x.abs(), x_heun.abs())
+            error = float(((x_heun - x_euler) / scale).pow(2).mean().sqrt())
+            if error <= 1.0 or dt <= min_dt:
+                x, t = x_heun, t + dt
+                if 1.0 - float(t) > 1e-6:
+                    dphi_dt = velocity(x, t)
+            # standard controller for a first order error estimate, growth and shrinkage bounded
+            dt = max(min_dt, dt * min(5.0, max(0.2, 0.9 * (1.0 / max(error, 1e-10)) ** 0.5)))
+        return x
+
     def forward(self, x1, x_lens, prompt_lens, mu, style):
         """Computes diffusion loss
 
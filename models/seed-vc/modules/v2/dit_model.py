@@ -10,6 +10,8 @@ import torch
 import torch.nn as nn
 from torch import Tensor
 from torch.nn import functional as F
+
+from modules.commons import grouped_scaled_dot_product_attention
 import time
 
 def find_multiple(n: int, k: int) -> int:
@@ -119,6 +121,33 @@ class Transformer(nn.Module):
         x = self.norm(x, c)
         return x
 
+    def forward_cached(self,
+                       x: Tensor,
+                       c: Tensor,
+                       input_pos: Tensor,
+                       mask: Tensor,
+                       cache: dict,
+                       refresh: bool,
+                       shallow_layers: int,
+                       ) -> Tensor:
+        """
+        forward that always runs the first `shallow_layers` blocks but only runs the remaining deep blocks
+        when `refresh` is set, otherwise the residual they added on the last refresh (kept in `cache`) is reused.
+        """
+        mask = mask[..., input_pos]
+        freqs_cis = self.freqs_cis[input_pos]
+        for layer in self.layers[:shallow_layers]:
+            x = layer(x, c, freqs_cis, mask)
+        if refresh or "deep_residual" not in cache:
+            shallow_out = x
+            for layer in self.layers[shallow_layers:]:
+                x = layer(x, c, freqs_cis, mask)
+            cache["deep_residual"] = x - shallow_out
+        else:
+            x = x + cache["deep_residual"]
+        x = self.norm(x, c)
+        return x
+
 
 class TransformerBlock(nn.Module):
     def __init__(self, config: ModelArgs) -> None:
@@ -186,9 +215,7 @@ class Attention(nn.Module):
 
         q, k, v = map(lambda x: x.transpose(1, 2), (q, k, v))
 
-        k = k.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        v = v.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
+        y = grouped_scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
 
         y = y.transpose(1, 2).contiguous().view(bsz, seqlen, self.head_dim * self.n_head)
 
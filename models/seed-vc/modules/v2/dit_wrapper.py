@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 import math
+from dataclasses import dataclass
 
 from modules.v2.dit_model import ModelArgs, Transformer
 from modules.commons import sequence_mask
@@ -55,6 +56,30 @@ class TimestepEmbedder(nn.Module):
         return t_emb
 
 
+@dataclass
+class StepCacheConfig:
+    """
+    DeepCache/FORA-style feature reuse across flow steps: deep-block outputs change slowly between adjacent
+    steps, so on most estimator calls only the shallow blocks run and the deep blocks' last residual is reused.
+    """
+    interval: int = 2  # run every block on one estimator call out of `interval`
+    shallow_layers: int = 3  # blocks that are recomputed on every call
+    full_first: int = 2  # leading calls always computed in full, the early high-noise steps move fastest
+
+
+class StepCache:
+    """Per-chunk state of the step cache, created by DiT.prepare"""
+    def __init__(self, config: StepCacheConfig):
+        self.config = config
+        self.calls = 0
+        self.state = {}
+
+    def should_refresh(self) -> bool:
+        call = self.calls
+        self.calls += 1
+        return call < self.config.full_first or (call - self.config.full_first) % self.config.interval == 0
+
+
 class DiT(torch.nn.Module):
     def __init__(
         self,
@@ -150,3 +175,50 @@ class DiT(torch.nn.Module):
         x = self.final_mlp(x_res)
         x = x.transpose(1, 2)
         return x
+
+    def prepare(self, prompt_x, x_lens, style, cond, step_cache: StepCacheConfig = None):
+        """
+        Everything forward computes from the inputs that stay fixed across flow steps, for forward_prepared.
+        cond_x_merge_linear is split by input block, so the prompt and content parts are projected once
+        and each step only projects x. With `step_cache`, forward_prepared reuses deep-block features
+        across calls as configured there.
+        """
+        merge_weight = self.cond_x_merge_linear.weight
+        w_prompt = merge_weight[:, self.in_channels:self.in_channels * 2]
+        w_cond = merge_weight[:, self.in_channels * 2:]
+        cond = self.cond_projection(cond)
+        merge_static = torch.nn.functional.linear(prompt_x.transpose(1, 2), w_prompt) + \
+            torch.nn.functional.linear(cond, w_cond, self.cond_x_merge_linear.bias)  # (N, T, D)
+        seq_len = merge_static.size(1) + self.style_as_token + self.time_as_token
+        x_mask = sequence_mask(x_lens + self.style_as_token + self.time_as_token, max_length=seq_len).to(cond.device).unsqueeze(1)
+        return {
+            "merge_static": merge_static,
+            "style": self.style_in(style),
+            "input_pos": torch.arange(seq_len, device=cond.device),
+            "mask": x_mask[:, None, :].repeat(1, 1, seq_len, 1),
+            "step_cache": StepCache(step_cache) if step_cache is not None else None,
+        }
+
+    def forward_prepared(self, x, t, prepared):
+        """Inference forward on a prepare() result, same output as forward(x, prompt_x, x_lens, t, style, cond)"""
+        t1 = self.t_embedder(t)  # (N, D)
+        w_x = self.cond_x_merge_linear.weight[:, :self.in_channels]
+        x_in = torch.nn.functional.linear(x.transpose(1, 2), w_x) + prepared["merge_static"]  # (N, T, D)
+        if self.style_as_token:
+            x_in = torch.cat([prepared["style"].unsqueeze(1), x_in], dim=1)
+        if self.time_as_token:
+            x_in = torch.cat([t1.unsqueeze(1), x_in], dim=1)
+        step_cache = prepared["step_cache"]
+        if step_cache is None:
+            x_res = self.transformer(x_in, t1.unsqueeze(1), prepared["input_pos"], prepared["mask"])
+        else:
+            # the cached forward has its own control flow, it runs on the uncompiled module
+            transformer = getattr(self.transformer, "_orig_mod", self.transformer)
+            x_res = transformer.forward_cached(
+                x_in, t1.unsqueeze(1), prepared["input_pos"], prepared["mask"],
+                step_cache.state, step_cache.should_refresh(), step_cache.config.shallow_layers,
+            )
+        x_res = x_res[:, 1:] if self.time_as_token else x_res
+        x_res = x_res[:, 1:] if self.style_as_token else x_res
+        x = self.final_mlp(x_res)
+        return x.transpose(1, 2)
@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+# Latency buckets in seconds, from a single CFM step on GPU up to a full minute-long conversion on CPU
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Instrumentation is off unless a server turns it on, timing a stage then costs one attribute lookup
+enabled = False
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram of one labelled series."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """
+    Thread-safe store of histograms and gauges, rendered in the Prometheus text exposition format.
+    Series are created on first use, keyed by metric name and sorted label items.
+    When `forward` is set, observations are handed to it as (name, value, buckets, labels) instead of being
+    stored, e.g. by a model replica process that reports to the registry of its supervisor.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = OrderedDict()
+        self._gauges = OrderedDict()
+        self._help = {}
+        self.forward = None
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, buckets=DEFAULT_BUCKETS, **labels):
+        if self.forward is not None:
+            self.forward(name, value, buckets, labels)
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram(buckets)
+            self._histograms[key].observe(value)
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    @staticmethod
+    def _format_labels(labels, **extra) -> str:
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def render(self) -> str:
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            for (name, labels), hist in sorted(self._histograms.items()):
+                header(name, "histogram")
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append(f"{name}_bucket{self._format_labels(labels, le=bound)} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels, le='+Inf')} {hist.count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {hist.sum}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {hist.count}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                header(name, "gauge")
+                lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+REGISTRY.describe("seed_vc_stage_seconds", "Wall time of one pipeline stage invocation")
+REGISTRY.describe("seed_vc_ar_tokens_per_second", "AR content token generation throughput per call")
+
+_local = threading.local()
+_trace_lock = threading.Lock()
+
+
+class StageTimer:
+    seconds = None
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a pipeline stage into seed_vc_stage_seconds{stage=name} and the current thread's request trace.
+    CUDA work is synchronized on both ends so the time is spent in the stage, not in a later stage's sync.
+    """
+    timer = StageTimer()
+    if not enabled:
+        yield timer
+        return
+    sync = torch.cuda.is_available() and torch.cuda.is_initialized()
+    if sync:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        if sync:
+            torch.cuda.synchronize()
+        timer.seconds = time.perf_counter() - start
+        REGISTRY.observe("seed_vc_stage_seconds", timer.seconds, stage=name)
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            with _trace_lock:
+                trace[name] = trace.get(name, 0.0) + timer.seconds
+
+
+def record_throughput(name: str, count: int, timer: StageTimer):
+    """Record count / elapsed of a finished stage as seed_vc_{name}_per_second."""
+    if timer.seconds:
+        REGISTRY.observe(f"seed_vc_{name}_per_second", count / timer.seconds,
+                         buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+
+
+@contextmanager
+def request_trace():
+    """Collect the total seconds spent per stage by everything this thread runs inside the block."""
+    trace = OrderedDict()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = None
+
+
+def current_trace():
+    """The request trace this thread is collecting into, None outside of request_trace"""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def attach_trace(trace):
+    """Collect this thread's stages into a trace started on another thread, e.g. by a pipeline worker"""
+    previous = getattr(_local, "trace", None)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
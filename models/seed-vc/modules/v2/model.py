@@ -11,6 +11,8 @@ import torch.nn as nn
 from torch import Tensor
 from torch.nn import functional as F
 
+from modules.commons import grouped_scaled_dot_product_attention
+
 
 def find_multiple(n: int, k: int) -> int:
     if n % k == 0:
@@ -240,9 +242,7 @@ class Attention(nn.Module):
         if self.kv_cache is not None:
             k, v = self.kv_cache.update(input_pos, k, v)
 
-        k = k.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        v = v.repeat_interleave(self.n_head // self.n_local_heads, dim=1)
-        y = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
+        y = grouped_scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0)
 
         y = y.transpose(1, 2).contiguous().view(bsz, seqlen, self.head_dim * self.n_head)
 
@@ -0,0 +1,94 @@
+import queue
+import threading
+from typing import Callable, Iterable, List
+
+import torch
+
+from modules.v2 import metrics
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+class StagePipeline:
+    """
+    Runs the producing iterable and each stage function on a worker thread of its own, connected by bounded
+    queues, so stage k works on item i while stage k + 1 works on item i - 1. Items come out of the iterator in
+    the order the source produced them, an exception in any worker is re-raised by the iterator.
+
+    Inference mode and the metrics request trace are thread-local, the workers enter both on behalf of the
+    thread that built the pipeline. Autocast is thread-local too, stage functions have to set it themselves.
+    """
+
+    def __init__(self, source: Iterable, stages: List[Callable], queue_size: int = 1):
+        self._stop = threading.Event()
+        self._trace = metrics.current_trace()
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+        self._threads = [threading.Thread(target=self._run_source, args=(source, self._queues[0]), daemon=True)]
+        for stage, inputs, outputs in zip(stages, self._queues[:-1], self._queues[1:]):
+            self._threads.append(threading.Thread(target=self._run_stage, args=(stage, inputs, outputs), daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _put(self, output: queue.Queue, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, inputs: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return inputs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _run_source(self, source: Iterable, output: queue.Queue):
+        try:
+            with torch.inference_mode(), metrics.attach_trace(self._trace):
+                for item in source:
+                    if not self._put(output, item):
+                        return
+        except BaseException as e:
+            self._put(output, _Failure(e))
+            return
+        self._put(output, _DONE)
+
+    def _run_stage(self, stage: Callable, inputs: queue.Queue, output: queue.Queue):
+        with torch.inference_mode(), metrics.attach_trace(self._trace):
+            while True:
+                item = self._get(inputs)
+                if item is _DONE or isinstance(item, _Failure):
+                    self._put(output, item)
+                    return
+                try:
+                    result = stage(item)
+                except BaseException as e:
+                    self._put(output, _Failure(e))
+                    return
+                if not self._put(output, result):
+                    return
+
+    def __iter__(self):
+        while True:
+            item = self._get(self._queues[-1])
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def close(self):
+        """Stop the workers, items still in flight are dropped"""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
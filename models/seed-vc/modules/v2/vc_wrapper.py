@@ -1,9 +1,18 @@
+import io
+from dataclasses import dataclass, fields
+from typing import List, Optional, Union
+
 import torch
 import librosa
 import torchaudio
 import numpy as np
+import soundfile as sf
 from pydub import AudioSegment
 from hf_utils import load_custom_model_from_hf
+from modules.v2 import metrics
+from modules.v2.dit_wrapper import StepCacheConfig
+from modules.v2.audio_encoders import STREAM_ENCODERS, BackgroundStreamEncoder, get_stream_encoder
+from modules.v2.pipeline import StagePipeline
 
 DEFAULT_REPO_ID = "Plachta/Seed-VC"
 DEFAULT_CFM_CHECKPOINT = "v2/cfm_small.pth"
@@ -16,6 +25,31 @@ DEFAULT_CE_WIDE_CHECKPOINT = "bsq2048/bsq2048_light.pth"
 DEFAULT_SE_REPO_ID = "funasr/campplus"
 DEFAULT_SE_CHECKPOINT = "campplus_cn_common.bin"
 
+# output formats of convert_voice_with_streaming
+OUTPUT_FORMATS = ("none", "numpy", *STREAM_ENCODERS)
+
+
+@dataclass
+class ReferenceFeatures:
+    """
+    Everything the conversion needs from the target/reference voice.
+    None of it depends on the source audio, so it can be computed once per voice and reused.
+    """
+    target_mel: torch.Tensor  # (1, n_mels, T_mel)
+    target_content_indices: torch.Tensor  # (1, T_wide)
+    target_style: torch.Tensor  # (1, style_dim)
+    prompt_condition: torch.Tensor  # (1, T_mel, D)
+    target_narrow_indices: Optional[torch.Tensor] = None  # (1, T_narrow), only needed for convert_style
+
+    def to(self, device):
+        return ReferenceFeatures(**{
+            f.name: getattr(self, f.name).to(device) if getattr(self, f.name) is not None else None
+            for f in fields(self)
+        })
+
+    def state_dict(self):
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
 class VoiceConversionWrapper(torch.nn.Module):
     def __init__(
             self,
@@ -47,10 +81,21 @@ class VoiceConversionWrapper(torch.nn.Module):
         self.overlap_frame_len = 16
         self.bitrate = "320k"
         self.compiled_decode_fn = None
+        # draft length of speculative AR decoding (NaiveWrapper.generate_speculative), 0 decodes token by token
+        self.ar_draft_tokens = 0
         self.dit_compiled = False
         self.dit_max_context_len = 30  # in seconds
         self.ar_max_content_len = 1500  # in num of narrow tokens
         self.compile_len = 87 * self.dit_max_context_len
+        # sequence lengths (in mel frames) the compiled DiT is specialized for, each chunk is padded to the
+        # smallest one that fits instead of always to compile_len, so short inputs run a short forward
+        self.compile_buckets = [87 * seconds for seconds in (5, 10, 15, 20)] + [self.compile_len]
+        # 30 s windows of long sources run through the content extractors together, in batches of this size
+        self.content_batch_size = 8
+        # torchaudio resamplers keyed by (orig_sr, target_sr, device), their sinc kernels are built once
+        self._resamplers = {}
+        # checkpoint files load_checkpoints loaded, keyed by component
+        self.checkpoint_paths = {}
 
     def forward_cfm(self, content_indices_wide, content_lens, mels, mel_lens, style_vectors):
         device = content_indices_wide.device
@@ -102,25 +147,112 @@ class VoiceConversionWrapper(torch.nn.Module):
             loss_cfm = torch.tensor(0.0, device=waves_16k.device, dtype=waves_16k.dtype)
         return loss_ar, loss_cfm
 
-    def compile_ar(self):
+    def compile_ar(self, warmup_device: torch.device = None):
         """
-        Compile the AR model for inference.
+        Compile the AR decode step for inference, call after setup_ar_caches.
+        generate_batch decodes one token for each of 1..max_batch_size rows, and with a paged KV cache attends
+        over a page table width that doubles as the longest row grows, so there is one static graph per
+        (batch size, width) pair.
+
+        Args:
+            warmup_device: If set, compile the graph of every batch size right away on this device instead of on first use
         """
+        model = self.ar.model
+        batch_sizes = range(1, model.max_batch_size + 1)
+        if model.page_allocator is None:
+            num_widths = 1
+        else:
+            max_pages = model.page_allocator.page_table.size(1)
+            num_widths = len({min(2 ** i, max_pages) for i in range(max_pages.bit_length() + 1)})
+        # keep dynamo from giving up and falling back to eager
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 2 * len(batch_sizes) * num_widths
+        )
         self.compiled_decode_fn = torch.compile(
-            self.ar.model.forward_generate,
+            model.forward_generate,
             fullgraph=True,
-            backend="inductor" if torch.cuda.is_available() else "aot_eager",
+            backend="inductor",
             mode="reduce-overhead" if torch.cuda.is_available() else None,
         )
+        if warmup_device is not None:
+            self.warmup_ar(warmup_device, batch_sizes)
+
+    @torch.no_grad()
+    def warmup_ar(self, device: torch.device, batch_sizes=(1,)):
+        """Run one compiled decode step per batch size so compilation happens at startup, not on a request."""
+        model = self.ar.model
+        for batch_size in batch_sizes:
+            rows = range(batch_size)
+            try:
+                for b in rows:
+                    model.reserve_kv(b, 1)
+                positions = torch.zeros(batch_size, 1, dtype=torch.long, device=device)
+                token_emb = torch.zeros(batch_size, 1, model.config.dim, dtype=model.embeddings.weight.dtype,
+                                        device=device)
+                # only scratch KV slot 0 is written, the next prefill overwrites it
+                self.compiled_decode_fn(token_emb, positions, positions)
+            finally:
+                for b in rows:
+                    model.release_kv(b)
 
-    def compile_cfm(self):
+    def compile_cfm(self, warmup_device: torch.device = None, max_batch_size: int = 1, warmup_cfg_branches=(3,)):
+        """
+        Compile the DiT transformer with one static graph per length in self.compile_buckets and estimator batch size.
+        The estimator batch is k * B: B sequences converted together (at most max_batch_size) times the k = 1..3
+        CFG branches their cfg rates call for.
+
+        Args:
+            warmup_device: If set, compile right away on this device instead of on first use
+            max_batch_size: Most sequences a caller converts in one batch, e.g. the micro-batching executor's limit
+            warmup_cfg_branches: CFG branch counts to warm up for every B, 3 is both CFG rates set
+        """
+        batch_sizes = {k * b for k in (1, 2, 3) for b in range(1, max_batch_size + 1)}
+        # one graph per (bucket, batch size), keep dynamo from giving up and falling back to eager
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, 2 * len(self.compile_buckets) * len(batch_sizes)
+        )
         self.cfm.estimator.transformer = torch.compile(
             self.cfm.estimator.transformer,
             fullgraph=True,
-            backend="inductor" if torch.cuda.is_available() else "aot_eager",
+            dynamic=False,
+            backend="inductor",
             mode="reduce-overhead" if torch.cuda.is_available() else None,
         )
         self.dit_compiled = True
+        if warmup_device is not None:
+            warmup_batch_sizes = sorted({k * b for k in warmup_cfg_branches for b in range(1, max_batch_size + 1)})
+            self.warmup_cfm(warmup_device, warmup_batch_sizes)
+
+    @torch.inference_mode()
+    def warmup_cfm(self, device: torch.device, batch_sizes=(3,)):
+        """Run the estimator once per compile bucket so compilation happens at startup, not on a request."""
+        estimator = self.cfm.estimator
+        for length in self.compile_buckets:
+            for batch_size in batch_sizes:
+                x = torch.zeros(batch_size, estimator.in_channels, length, device=device)
+                with torch.autocast(device_type=device.type, dtype=torch.float32):
+                    estimator(
+                        x, torch.zeros_like(x),
+                        torch.full([batch_size], length, dtype=torch.long, device=device),
+                        torch.zeros(batch_size, device=device),
+                        torch.zeros(batch_size, estimator.style_in.in_features, device=device),
+                        torch.zeros(batch_size, length, estimator.content_dim, device=device),
+                    )
+
+    def compile_pad_len(self, length: int) -> int:
+        """Length a DiT input of `length` frames is padded to when the DiT is compiled."""
+        return next((bucket for bucket in self.compile_buckets if bucket >= length), length)
+
+    @staticmethod
+    def source_window_starts(length: int, window: int, overlap: int) -> List[int]:
+        """
+        Start frames of the windows covering `length` source frames, consecutive windows overlap by `overlap`
+        frames, the same advance _stream_wave_chunks applies. The last window is the first one reaching the end.
+        """
+        chunk_starts = [0]
+        while chunk_starts[-1] + window < length:
+            chunk_starts.append(chunk_starts[-1] + window - overlap)
+        return chunk_starts
 
     @staticmethod
     def strip_prefix(state_dict: dict, prefix: str = "module.") -> dict:
@@ -179,12 +311,13 @@ class VoiceConversionWrapper(torch.nn.Module):
             stream_output: Whether to stream the output
             
         Returns:
-            Tuple of (processed_frames, previous_chunk, should_break, mp3_bytes, full_audio)
+            Tuple of (processed_frames, previous_chunk, should_break, output_chunk, full_audio)
             where should_break indicates if processing should stop
-            mp3_bytes is the MP3 bytes if streaming, None otherwise
+            output_chunk is the crossfaded float32 waveform of this chunk if streaming, None otherwise,
+            encoding it is left to the output stage of convert_voice_with_streaming
             full_audio is the full audio if this is the last chunk, None otherwise
         """
-        mp3_bytes = None
+        output_chunk = None
         full_audio = None
         
         if processed_frames == 0:
@@ -193,16 +326,12 @@ class VoiceConversionWrapper(torch.nn.Module):
                 generated_wave_chunks.append(output_wave)
 
                 if stream_output:
-                    output_wave_int16 = (output_wave * 32768.0).astype(np.int16)
-                    mp3_bytes = AudioSegment(
-                        output_wave_int16.tobytes(), frame_rate=self.sr,
-                        sample_width=output_wave_int16.dtype.itemsize, channels=1
-                    ).export(format="mp3", bitrate=self.bitrate).read()
+                    output_chunk = output_wave.astype(np.float32, copy=False)
                     full_audio = (self.sr, np.concatenate(generated_wave_chunks))
                 else:
                     return processed_frames, previous_chunk, True, None, np.concatenate(generated_wave_chunks)
 
-                return processed_frames, previous_chunk, True, mp3_bytes, full_audio
+                return processed_frames, previous_chunk, True, output_chunk, full_audio
 
             output_wave = vc_wave[0, :-overlap_wave_len].cpu().numpy()
             generated_wave_chunks.append(output_wave)
@@ -210,11 +339,7 @@ class VoiceConversionWrapper(torch.nn.Module):
             processed_frames += vc_mel.size(2) - self.overlap_frame_len
 
             if stream_output:
-                output_wave_int16 = (output_wave * 32768.0).astype(np.int16)
-                mp3_bytes = AudioSegment(
-                    output_wave_int16.tobytes(), frame_rate=self.sr,
-                    sample_width=output_wave_int16.dtype.itemsize, channels=1
-                ).export(format="mp3", bitrate=self.bitrate).read()
+                output_chunk = output_wave.astype(np.float32, copy=False)
 
         elif is_last_chunk:
             output_wave = self.crossfade(previous_chunk.cpu().numpy(), vc_wave[0].cpu().numpy(), overlap_wave_len)
@@ -222,16 +347,12 @@ class VoiceConversionWrapper(torch.nn.Module):
             processed_frames += vc_mel.size(2) - self.overlap_frame_len
 
             if stream_output:
-                output_wave_int16 = (output_wave * 32768.0).astype(np.int16)
-                mp3_bytes = AudioSegment(
-                    output_wave_int16.tobytes(), frame_rate=self.sr,
-                    sample_width=output_wave_int16.dtype.itemsize, channels=1
-                ).export(format="mp3", bitrate=self.bitrate).read()
+                output_chunk = output_wave.astype(np.float32, copy=False)
                 full_audio = (self.sr, np.concatenate(generated_wave_chunks))
             else:
                 return processed_frames, previous_chunk, True, None, np.concatenate(generated_wave_chunks)
 
-            return processed_frames, previous_chunk, True, mp3_bytes, full_audio
+            return processed_frames, previous_chunk, True, output_chunk, full_audio
 
         else:
             output_wave = self.crossfade(previous_chunk.cpu().numpy(), vc_wave[0, :-overlap_wave_len].cpu().numpy(), overlap_wave_len)
@@ -240,13 +361,9 @@ class VoiceConversionWrapper(torch.nn.Module):
             processed_frames += vc_mel.size(2) - self.overlap_frame_len
 
             if stream_output:
-                output_wave_int16 = (output_wave * 32768.0).astype(np.int16)
-                mp3_bytes = AudioSegment(
-                    output_wave_int16.tobytes(), frame_rate=self.sr,
-                    sample_width=output_wave_int16.dtype.itemsize, channels=1
-                ).export(format="mp3", bitrate=self.bitrate).read()
+                output_chunk = output_wave.astype(np.float32, copy=False)
                 
-        return processed_frames, previous_chunk, False, mp3_bytes, full_audio
+        return processed_frames, previous_chunk, False, output_chunk, full_audio
 
     def load_checkpoints(
             self,
@@ -305,30 +422,45 @@ class VoiceConversionWrapper(torch.nn.Module):
         style_encoder_checkpoint = torch.load(style_encoder_checkpoint_path, map_location="cpu")
         self.style_encoder.load_state_dict(style_encoder_checkpoint, strict=False)
 
-    def setup_ar_caches(self, max_batch_size=1, max_seq_len=4096, dtype=torch.float32, device=torch.device("cpu")):
-        self.ar.setup_caches(max_batch_size=max_batch_size, max_seq_len=max_seq_len, dtype=dtype, device=device)
+        self.checkpoint_paths = {
+            "cfm": cfm_checkpoint_path,
+            "ar": ar_checkpoint_path,
+            "content_extractor_narrow": content_extractor_narrow_checkpoint_path,
+            "content_extractor_wide": content_extractor_wide_checkpoint_path,
+            "style_encoder": style_encoder_checkpoint_path,
+        }
+
+    def setup_ar_caches(self, max_batch_size=1, max_seq_len=4096, dtype=torch.float32, device=torch.device("cpu"),
+                        page_size=None, num_pages=None):
+        """
+        max_batch_size is also how many AR chunks of a convert_style conversion are decoded together.
+        With page_size the KV cache is a shared pool of num_pages pages instead of dense per-row buffers.
+        """
+        self.ar.setup_caches(max_batch_size=max_batch_size, max_seq_len=max_seq_len, dtype=dtype, device=device,
+                             page_size=page_size, num_pages=num_pages)
 
     @torch.no_grad()
     def compute_style(self, waves_16k: torch.Tensor, wave_lens_16k: torch.Tensor = None):
-        if wave_lens_16k is None:
-            wave_lens_16k = torch.tensor([waves_16k.size(-1)], dtype=torch.int32).to(waves_16k.device)
-        feat_list = []
-        for bib in range(waves_16k.size(0)):
-            feat = torchaudio.compliance.kaldi.fbank(waves_16k[bib:bib + 1, :wave_lens_16k[bib]],
-                               num_mel_bins=80,
-                               dither=0,
-                               sample_frequency=16000)
-            feat = feat - feat.mean(dim=0, keepdim=True)
-            feat_list.append(feat)
-        max_feat_len = max([feat.size(0) for feat in feat_list])
-        feat_lens = torch.tensor([feat.size(0) for feat in feat_list], dtype=torch.int32).to(waves_16k.device) // 2
-        feat_list = [
-            torch.nn.functional.pad(feat, (0, 0, 0, max_feat_len - feat.size(0)), value=float(feat.min().item()))
-            for feat in feat_list
-        ]
-        feat = torch.stack(feat_list, dim=0)
-        style = self.style_encoder(feat, feat_lens)
-        return style
+        with metrics.stage("style"):
+            if wave_lens_16k is None:
+                wave_lens_16k = torch.tensor([waves_16k.size(-1)], dtype=torch.int32).to(waves_16k.device)
+            feat_list = []
+            for bib in range(waves_16k.size(0)):
+                feat = torchaudio.compliance.kaldi.fbank(waves_16k[bib:bib + 1, :wave_lens_16k[bib]],
+                                   num_mel_bins=80,
+                                   dither=0,
+                                   sample_frequency=16000)
+                feat = feat - feat.mean(dim=0, keepdim=True)
+                feat_list.append(feat)
+            max_feat_len = max([feat.size(0) for feat in feat_list])
+            feat_lens = torch.tensor([feat.size(0) for feat in feat_list], dtype=torch.int32).to(waves_16k.device) // 2
+            feat_list = [
+                torch.nn.functional.pad(feat, (0, 0, 0, max_feat_len - feat.size(0)), value=float(feat.min().item()))
+                for feat in feat_list
+            ]
+            feat = torch.stack(feat_list, dim=0)
+            style = self.style_encoder(feat, feat_lens)
+            return style
 
     @torch.no_grad()
     @torch.inference_mode()
@@ -436,7 +568,8 @@ class VoiceConversionWrapper(torch.nn.Module):
 
             ar_cond = self.ar_length_regulator(torch.cat([tgt_narrow_reduced, src_narrow_reduced], dim=0)[None])[0]
 
-            ar_out = self.ar.generate(ar_cond, target_content_indices, top_p=top_p, temperature=temperature, repetition_penalty=repetition_penalty)
+            ar_out = self.ar.generate(ar_cond, target_content_indices, num_draft_tokens=self.ar_draft_tokens,
+                                      top_p=top_p, temperature=temperature, repetition_penalty=repetition_penalty)
             ar_out_mel_len = torch.LongTensor([int(source_mel_len / source_content_indices.size(-1) * ar_out.size(-1) * length_adjust)]).to(device)
             # compute style features
             target_style = self.compute_style(target_wave_16k_tensor)
@@ -461,41 +594,152 @@ class VoiceConversionWrapper(torch.nn.Module):
 
     def _process_content_features(self, audio_16k_tensor, is_narrow=False):
         """Process audio through Whisper model to extract features."""
-        content_extractor_fn = self.content_extractor_narrow if is_narrow else self.content_extractor_wide
-        if audio_16k_tensor.size(-1) <= 16000 * 30:
-            # Compute content features
-            _, content_indices, _ = content_extractor_fn(audio_16k_tensor, [audio_16k_tensor.size(-1)], ssl_model=self.content_extractor_wide.ssl_model)
-        else:
-            # Process long audio in chunks
-            overlapping_time = 5  # 5 seconds
-            features_list = []
-            buffer = None
-            traversed_time = 0
-            while traversed_time < audio_16k_tensor.size(-1):
-                if buffer is None:  # first chunk
-                    chunk = audio_16k_tensor[:, traversed_time:traversed_time + 16000 * 30]
-                else:
-                    chunk = torch.cat([
-                        buffer,
-                        audio_16k_tensor[:, traversed_time:traversed_time + 16000 * (30 - overlapping_time)]
-                    ], dim=-1)
-                _, chunk_content_indices, _ = content_extractor_fn(chunk, [chunk.size(-1)], ssl_model=self.content_extractor_wide.ssl_model)
-                if traversed_time == 0:
-                    features_list.append(chunk_content_indices)
-                else:
-                    features_list.append(chunk_content_indices[:, 50 * overlapping_time:])
-                buffer = chunk[:, -16000 * overlapping_time:]
-                traversed_time += 30 * 16000 if traversed_time == 0 else chunk.size(-1) - 16000 * overlapping_time
-            content_indices = torch.cat(features_list, dim=1)
+        with metrics.stage("content_narrow" if is_narrow else "content_wide"):
+            content_extractor_fn = self.content_extractor_narrow if is_narrow else self.content_extractor_wide
+            if audio_16k_tensor.size(-1) <= 16000 * 30:
+                # Compute content features
+                _, content_indices, _ = content_extractor_fn(audio_16k_tensor, [audio_16k_tensor.size(-1)], ssl_model=self.content_extractor_wide.ssl_model)
+            else:
+                # Process long audio in 30 s windows starting every 25 s, each window after the first keeps
+                # its leading 5 s only as context and drops their 50 Hz content frames
+                overlapping_time = 5  # 5 seconds
+                window_len = 16000 * 30
+                hop_len = 16000 * (30 - overlapping_time)
+                window_starts = range(0, audio_16k_tensor.size(-1) - 16000 * overlapping_time, hop_len)
+                windows = [audio_16k_tensor[0, start:start + window_len] for start in window_starts]
+                features_list = []
+                # windows are padded and stacked into batches, only the last one is usually shorter
+                for i in range(0, len(windows), self.content_batch_size):
+                    batch = windows[i:i + self.content_batch_size]
+                    batch_waves = torch.nn.utils.rnn.pad_sequence(batch, batch_first=True)
+                    _, batch_indices, batch_feature_lens = content_extractor_fn(
+                        batch_waves, [window.size(-1) for window in batch], ssl_model=self.content_extractor_wide.ssl_model)
+                    for b, feature_len in enumerate(batch_feature_lens.tolist()):
+                        chunk_content_indices = batch_indices[b:b + 1, :feature_len]
+                        if i + b == 0:
+                            features_list.append(chunk_content_indices)
+                        else:
+                            features_list.append(chunk_content_indices[:, 50 * overlapping_time:])
+                content_indices = torch.cat(features_list, dim=1)
+
+            return content_indices
+
+    @staticmethod
+    def _decode_audio(audio: Union[str, bytes, tuple]):
+        """
+        Decode audio to a mono float32 waveform at its native sample rate.
+
+        Args:
+            audio: Path to an audio file, the encoded bytes of one, or a (sample_rate, waveform) tuple
+
+        Returns:
+            Tuple of (waveform, sample_rate)
+        """
+        if isinstance(audio, tuple):
+            sr, wave = audio
+            wave = np.asarray(wave, dtype=np.float32)
+            return (wave.mean(axis=1) if wave.ndim > 1 else wave), sr
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            try:
+                wave, sr = sf.read(io.BytesIO(audio), dtype="float32", always_2d=True)
+                return wave.mean(axis=1), sr
+            except sf.LibsndfileError:
+                # formats libsndfile cannot parse (older mp3, m4a, ...) go through ffmpeg via pipes
+                segment = AudioSegment.from_file(io.BytesIO(audio)).set_channels(1)
+                wave = np.array(segment.get_array_of_samples(), dtype=np.float32)
+                return wave / float(1 << (8 * segment.sample_width - 1)), segment.frame_rate
+        return librosa.load(audio, sr=None, mono=True)
+
+    def _resample(self, wave: torch.Tensor, orig_sr: int, target_sr: int) -> torch.Tensor:
+        if orig_sr == target_sr:
+            return wave
+        key = (orig_sr, target_sr, wave.device)
+        if key not in self._resamplers:
+            self._resamplers[key] = torchaudio.transforms.Resample(orig_sr, target_sr).to(wave.device)
+        return self._resamplers[key](wave)
+
+    def _load_audio(self, audio: Union[str, bytes, tuple], device: torch.device, max_seconds: float = None):
+        """
+        Decode audio once and resample it to both the model rate and 16kHz.
+
+        Args:
+            audio: Path, encoded bytes or (sample_rate, waveform) tuple, see _decode_audio
+            device: Device to resample on
+            max_seconds: Truncate the audio to this duration (default: None)
 
-        return content_indices
+        Returns:
+            Tuple of (wave_tensor, wave_16k_tensor), both of shape (1, T) at self.sr and 16kHz
+        """
+        with metrics.stage("decode"):
+            wave, orig_sr = self._decode_audio(audio)
+        if max_seconds is not None:
+            wave = wave[:int(orig_sr * max_seconds)]
+        wave = torch.from_numpy(np.ascontiguousarray(wave)).unsqueeze(0).float().to(device)
+        with metrics.stage("resample"):
+            return self._resample(wave, orig_sr, self.sr), self._resample(wave, orig_sr, 16000)
+
+    def _load_source(self, source_audio: Union[str, bytes, tuple], device: torch.device):
+        """
+        Load source audio and resample it for feature extraction.
+
+        Returns:
+            Tuple of (source_wave_16k_tensor, source_mel_len)
+        """
+        source_wave_tensor, source_wave_16k_tensor = self._load_audio(source_audio, device)
+
+        # Compute mel spectrograms
+        with metrics.stage("mel"):
+            source_mel = self.mel_fn(source_wave_tensor)
+        return source_wave_16k_tensor, source_mel.size(2)
 
     @torch.no_grad()
     @torch.inference_mode()
+    def prepare_reference(
+            self,
+            target_audio_path: Union[str, bytes, tuple],
+            device: torch.device = torch.device("cuda"),
+            dtype: torch.dtype = torch.float16,
+            compute_narrow: bool = True,
+    ) -> ReferenceFeatures:
+        """
+        Precompute the reference-voice features used by convert_voice_with_streaming.
+
+        Args:
+            target_audio_path: Path to target audio file, its encoded bytes or a (sample_rate, waveform) tuple
+            device: Device to use (default: cuda)
+            dtype: Data type to use for autocast (default: float16)
+            compute_narrow: Whether to also extract narrow content indices, needed for convert_style (default: True)
+
+        Returns:
+            ReferenceFeatures bundle that can be passed as `reference` to convert_voice_with_streaming
+        """
+        # Limit target audio to 25 seconds
+        target_wave_tensor, target_wave_16k_tensor = self._load_audio(
+            target_audio_path, device, max_seconds=self.dit_max_context_len - 5
+        )
+
+        with metrics.stage("mel"):
+            target_mel = self.mel_fn(target_wave_tensor)
+        target_narrow_indices = None
+        with torch.autocast(device_type=device.type, dtype=dtype):
+            target_content_indices = self._process_content_features(target_wave_16k_tensor, is_narrow=False)
+            if compute_narrow:
+                target_narrow_indices = self._process_content_features(target_wave_16k_tensor, is_narrow=True)
+            target_style = self.compute_style(target_wave_16k_tensor)
+            prompt_condition, _, = self.cfm_length_regulator(target_content_indices,
+                                                             ylens=torch.LongTensor([target_mel.size(2)]).to(device))
+        return ReferenceFeatures(
+            target_mel=target_mel,
+            target_content_indices=target_content_indices,
+            target_style=target_style,
+            prompt_condition=prompt_condition,
+            target_narrow_indices=target_narrow_indices,
+        )
+
     def convert_voice_with_streaming(
             self,
-            source_audio_path: str,
-            target_audio_path: str,
+            source_audio_path: Union[str, bytes, tuple],
+            target_audio_path: Union[str, bytes, tuple] = None,
             diffusion_steps: int = 30,
             length_adjust: float = 1.0,
             intelligebility_cfg_rate: float = 0.7,
@@ -508,13 +752,18 @@ class VoiceConversionWrapper(torch.nn.Module):
             device: torch.device = torch.device("cuda"),
             dtype: torch.dtype = torch.float16,
             stream_output: bool = True,
+            reference: Optional[ReferenceFeatures] = None,
+            output_format: str = "mp3",
+            cfm_solver: str = "euler",
+            cfm_step_cache: Optional[StepCacheConfig] = None,
+            pipelined: bool = False,
     ):
         """
         Convert voice with streaming support for long audio files.
         
         Args:
-            source_audio_path: Path to source audio file
-            target_audio_path: Path to target audio file
+            source_audio_path: Path to source audio file, its encoded bytes or a (sample_rate, waveform) tuple
+            target_audio_path: Same as source_audio_path for the target, may be None if `reference` is given
             diffusion_steps: Number of diffusion steps (default: 30)
             length_adjust: Length adjustment factor (default: 1.0)
             intelligebility_cfg_rate: CFG rate for intelligibility (default: 0.7)
@@ -525,32 +774,90 @@ class VoiceConversionWrapper(torch.nn.Module):
             device: Device to use (default: cpu)
             dtype: Data type to use (default: float32)
             stream_output: Whether to stream the output (default: True)
+            reference: Precomputed features from prepare_reference, skips all target audio processing (default: None)
+            output_format: Format of the streamed chunks (default: mp3), one of
+                "none": nothing is streamed, only the final (None, full_audio) is yielded
+                "numpy": float32 waveforms
+                "pcm_s16le", "pcm_f32le", "wav", "opus", "mp3": bytes of one continuous stream in that format,
+                encoded on a background thread while the next chunk is generated
+            cfm_solver: ODE solver of the flow-matching sampler, one of CFM.SOLVERS (default: euler)
+            cfm_step_cache: Reuse deep DiT features across diffusion steps, see StepCacheConfig (default: None)
+            pipelined: Run AR / conditioning, CFM and the vocoder of consecutive chunks concurrently on worker
+                threads, see StagePipeline; output order is unchanged (default: False)
             
         Returns:
-            If stream_output is True, yields (mp3_bytes, full_audio) tuples
+            If stream_output is True, yields (output_chunk, full_audio) tuples, full_audio is only set on the last one
             If stream_output is False, returns the full audio as a numpy array
         """
-        # Load audio
-        source_wave = librosa.load(source_audio_path, sr=self.sr)[0]
-        target_wave = librosa.load(target_audio_path, sr=self.sr)[0]
-        
-        # Limit target audio to 25 seconds
-        target_wave = target_wave[:self.sr * (self.dit_max_context_len - 5)]
-        
-        source_wave_tensor = torch.tensor(source_wave).unsqueeze(0).float().to(device)
-        target_wave_tensor = torch.tensor(target_wave).unsqueeze(0).float().to(device)
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}, expected one of {OUTPUT_FORMATS}")
+        chunks = self._convert_voice_chunks(
+            source_audio_path, target_audio_path, diffusion_steps, length_adjust, intelligebility_cfg_rate,
+            similarity_cfg_rate, top_p, temperature, repetition_penalty, convert_style, anonymization_only,
+            device, dtype, stream_output, reference, cfm_solver, cfm_step_cache, pipelined,
+        )
+        if output_format in ("none", "numpy"):
+            for output_wave, full_audio in chunks:
+                if output_format == "numpy":
+                    yield output_wave, full_audio
+                elif full_audio is not None:
+                    yield None, full_audio
+            return
 
-        # Resample to 16kHz for feature extraction
-        source_wave_16k = librosa.resample(source_wave, orig_sr=self.sr, target_sr=16000)
-        target_wave_16k = librosa.resample(target_wave, orig_sr=self.sr, target_sr=16000)
-        source_wave_16k_tensor = torch.tensor(source_wave_16k).unsqueeze(0).to(device)
-        target_wave_16k_tensor = torch.tensor(target_wave_16k).unsqueeze(0).to(device)
+        encoder = BackgroundStreamEncoder(get_stream_encoder(output_format, self.sr))
+        try:
+            for output_wave, full_audio in chunks:
+                encoder.submit(output_wave)
+                if full_audio is None:
+                    # only what already finished encoding, the rest is picked up after the next chunk
+                    for output_chunk in encoder.ready():
+                        yield output_chunk, None
+                else:
+                    outputs = encoder.finish()
+                    for output_chunk in outputs[:-1]:
+                        yield output_chunk, None
+                    yield outputs[-1], full_audio
+        finally:
+            encoder.close()
 
-        # Compute mel spectrograms
-        source_mel = self.mel_fn(source_wave_tensor)
-        target_mel = self.mel_fn(target_wave_tensor)
-        source_mel_len = source_mel.size(2)
+    @torch.no_grad()
+    @torch.inference_mode()
+    def _convert_voice_chunks(
+            self,
+            source_audio_path: Union[str, bytes, tuple],
+            target_audio_path: Union[str, bytes, tuple],
+            diffusion_steps: int,
+            length_adjust: float,
+            intelligebility_cfg_rate: float,
+            similarity_cfg_rate: float,
+            top_p: float,
+            temperature: float,
+            repetition_penalty: float,
+            convert_style: bool,
+            anonymization_only: bool,
+            device: torch.device,
+            dtype: torch.dtype,
+            stream_output: bool,
+            reference: Optional[ReferenceFeatures],
+            cfm_solver: str,
+            cfm_step_cache: Optional[StepCacheConfig],
+            pipelined: bool,
+    ):
+        """Generator behind convert_voice_with_streaming, yields (float32 waveform chunk, full_audio) tuples"""
+        # Reference features do not depend on the source, reuse them if the caller precomputed them
+        if reference is None:
+            reference = self.prepare_reference(target_audio_path, device=device, dtype=dtype,
+                                               compute_narrow=convert_style)
+        elif convert_style and reference.target_narrow_indices is None:
+            raise ValueError("convert_style requires a reference prepared with compute_narrow=True")
+        target_mel = reference.target_mel
+        target_content_indices = reference.target_content_indices
+        target_style = reference.target_style
+        prompt_condition = reference.prompt_condition
         target_mel_len = target_mel.size(2)
+
+        # Load audio
+        source_wave_16k_tensor, source_mel_len = self._load_source(source_audio_path, device)
         
         # Set up chunk processing parameters
         max_context_window = self.sr // self.hop_size * self.dit_max_context_len
@@ -559,106 +866,296 @@ class VoiceConversionWrapper(torch.nn.Module):
         with torch.autocast(device_type=device.type, dtype=dtype):
             # Compute content features
             source_content_indices = self._process_content_features(source_wave_16k_tensor, is_narrow=False)
-            target_content_indices = self._process_content_features(target_wave_16k_tensor, is_narrow=False)
-            # Compute style features
-            target_style = self.compute_style(target_wave_16k_tensor)
-            prompt_condition, _, = self.cfm_length_regulator(target_content_indices,
-                                                             ylens=torch.LongTensor([target_mel_len]).to(device))
 
-        # prepare for streaming
-        generated_wave_chunks = []
-        processed_frames = 0
-        previous_chunk = None
-        if convert_style:
+        def style_chunk_conditions():
+            """Yields (cat_condition, is_last_chunk, CFM autocast dtype) for each chunk of AR-converted content"""
             with torch.autocast(device_type=device.type, dtype=dtype):
                 source_narrow_indices = self._process_content_features(source_wave_16k_tensor, is_narrow=True)
-                target_narrow_indices = self._process_content_features(target_wave_16k_tensor, is_narrow=True)
+            target_narrow_indices = reference.target_narrow_indices
             src_narrow_reduced, src_narrow_len = self.duration_reduction_func(source_narrow_indices[0], 1)
             tgt_narrow_reduced, tgt_narrow_len = self.duration_reduction_func(target_narrow_indices[0], 1)
             # Process src_narrow_reduced in chunks of max 1000 tokens
             max_chunk_size = self.ar_max_content_len - tgt_narrow_len
 
             # Process src_narrow_reduced in chunks
-            for i in range(0, len(src_narrow_reduced), max_chunk_size):
+            chunk_starts = list(range(0, len(src_narrow_reduced), max_chunk_size))
+            # chunks are decoded together, as many at once as the AR KV cache has rows (see setup_ar_caches),
+            # or one after another when speculative decoding is on
+            ar_batch_size = 1 if self.ar_draft_tokens > 0 else max(self.ar.model.max_batch_size, 1)
+            chunk_ar_outs = {}
+            for chunk_idx, i in enumerate(chunk_starts):
                 is_last_chunk = i + max_chunk_size >= len(src_narrow_reduced)
                 with torch.autocast(device_type=device.type, dtype=dtype):
-                    chunk = src_narrow_reduced[i:i + max_chunk_size]
-                    if anonymization_only:
-                        chunk_ar_cond = self.ar_length_regulator(chunk[None])[0]
-                        chunk_ar_out = self.ar.generate(chunk_ar_cond, torch.zeros([1, 0]).long().to(device),
-                                                        compiled_decode_fn=self.compiled_decode_fn,
-                                                      top_p=top_p, temperature=temperature,
-                                                      repetition_penalty=repetition_penalty)
-                    else:
-                        # For each chunk, we need to include tgt_narrow_reduced as context
-                        chunk_ar_cond = self.ar_length_regulator(torch.cat([tgt_narrow_reduced, chunk], dim=0)[None])[0]
-                        chunk_ar_out = self.ar.generate(chunk_ar_cond, target_content_indices, compiled_decode_fn=self.compiled_decode_fn,
-                                                      top_p=top_p, temperature=temperature,
-                                                      repetition_penalty=repetition_penalty)
+                    if chunk_idx not in chunk_ar_outs:
+                        group = range(chunk_idx, min(chunk_idx + ar_batch_size, len(chunk_starts)))
+                        chunk_ar_conds = []
+                        for j in group:
+                            chunk = src_narrow_reduced[chunk_starts[j]:chunk_starts[j] + max_chunk_size]
+                            if anonymization_only:
+                                chunk_ar_conds.append(self.ar_length_regulator(chunk[None])[0])
+                            else:
+                                # For each chunk, we need to include tgt_narrow_reduced as context
+                                chunk_ar_conds.append(self.ar_length_regulator(torch.cat([tgt_narrow_reduced, chunk], dim=0)[None])[0])
+                        prompt_target = torch.zeros([1, 0]).long().to(device) if anonymization_only else target_content_indices
+                        with metrics.stage("ar") as ar_timer:
+                            group_ar_outs = self.ar.generate_batch(chunk_ar_conds, [prompt_target] * len(group),
+                                                                   compiled_decode_fn=self.compiled_decode_fn,
+                                                                   num_draft_tokens=self.ar_draft_tokens,
+                                                                   top_p=top_p, temperature=temperature,
+                                                                   repetition_penalty=repetition_penalty)
+                        metrics.record_throughput("ar_tokens", sum(out.size(-1) for out in group_ar_outs), ar_timer)
+                        chunk_ar_outs.update(zip(group, group_ar_outs))
+                    chunk_ar_out = chunk_ar_outs.pop(chunk_idx)
                     chunkar_out_mel_len = torch.LongTensor([int(source_mel_len / source_content_indices.size(
                         -1) * chunk_ar_out.size(-1) * length_adjust)]).to(device)
                     # Length regulation
                     chunk_cond, _ = self.cfm_length_regulator(chunk_ar_out, ylens=torch.LongTensor([chunkar_out_mel_len]).to(device))
                     cat_condition = torch.cat([prompt_condition, chunk_cond], dim=1)
-                    original_len = cat_condition.size(1)
-                    # pad cat_condition to compile_len
-                    if self.dit_compiled:
-                        cat_condition = torch.nn.functional.pad(cat_condition,
-                                                                (0, 0, 0, self.compile_len - cat_condition.size(1),),
-                                                                value=0)
-                    # Voice Conversion
-                    vc_mel = self.cfm.inference(
-                        cat_condition,
-                        torch.LongTensor([original_len]).to(device),
-                        target_mel, target_style, diffusion_steps,
-                        inference_cfg_rate=[intelligebility_cfg_rate, similarity_cfg_rate],
-                        random_voice=anonymization_only,
-                    )
-                    vc_mel = vc_mel[:, :, target_mel_len:original_len]
-                vc_wave = self.vocoder(vc_mel).squeeze()[None]
-                processed_frames, previous_chunk, should_break, mp3_bytes, full_audio = self._stream_wave_chunks(
-                    vc_wave, processed_frames, vc_mel, overlap_wave_len,
-                    generated_wave_chunks, previous_chunk, is_last_chunk, stream_output
-                )
+                yield cat_condition, is_last_chunk, dtype
 
-                if stream_output and mp3_bytes is not None:
-                    yield mp3_bytes, full_audio
-                if should_break:
-                    break
-        else:
+        def plain_chunk_conditions():
+            """Yields (cat_condition, is_last_chunk, CFM autocast dtype) for each window of the source content"""
             cond, _ = self.cfm_length_regulator(source_content_indices, ylens=torch.LongTensor([source_mel_len]).to(device))
 
             # Process in chunks for streaming
             max_source_window = max_context_window - target_mel.size(2)
+            chunk_starts = self.source_window_starts(cond.size(1), max_source_window, self.overlap_frame_len)
+            for chunk_idx, chunk_start in enumerate(chunk_starts):
+                chunk_cond = cond[:, chunk_start:chunk_start + max_source_window]
+                is_last_chunk = chunk_idx == len(chunk_starts) - 1
+                # force CFM to use float32
+                yield torch.cat([prompt_condition, chunk_cond], dim=1), is_last_chunk, torch.float32
 
-            # Generate chunk by chunk and stream the output
-            while processed_frames < cond.size(1):
-                chunk_cond = cond[:, processed_frames:processed_frames + max_source_window]
-                is_last_chunk = processed_frames + max_source_window >= cond.size(1)
-                cat_condition = torch.cat([prompt_condition, chunk_cond], dim=1)
-                original_len = cat_condition.size(1)
-                # pad cat_condition to compile_len
-                if self.dit_compiled:
-                    cat_condition = torch.nn.functional.pad(cat_condition,
-                                                            (0, 0, 0, self.compile_len - cat_condition.size(1),), value=0)
-                with torch.autocast(device_type=device.type, dtype=torch.float32):  # force CFM to use float32
-                    # Voice Conversion
-                    vc_mel = self.cfm.inference(
-                        cat_condition,
-                        torch.LongTensor([original_len]).to(device),
-                        target_mel, target_style, diffusion_steps,
-                        inference_cfg_rate=[intelligebility_cfg_rate, similarity_cfg_rate],
-                        random_voice=anonymization_only,
-                    )
-                vc_mel = vc_mel[:, :, target_mel_len:original_len]
+        def cfm_stage(item):
+            cat_condition, is_last_chunk, cfm_dtype = item
+            original_len = cat_condition.size(1)
+            # pad cat_condition to its compile bucket
+            if self.dit_compiled:
+                cat_condition = torch.nn.functional.pad(cat_condition,
+                                                        (0, 0, 0, self.compile_pad_len(original_len) - original_len,), value=0)
+            with torch.autocast(device_type=device.type, dtype=cfm_dtype):
+                # Voice Conversion
+                vc_mel = self.cfm.inference(
+                    cat_condition,
+                    torch.LongTensor([original_len]).to(device),
+                    target_mel, target_style, diffusion_steps,
+                    inference_cfg_rate=[intelligebility_cfg_rate, similarity_cfg_rate],
+                    random_voice=anonymization_only,
+                    solver=cfm_solver,
+                    step_cache=cfm_step_cache,
+                )
+            return vc_mel[:, :, target_mel_len:original_len], is_last_chunk
+
+        def vocoder_stage(item):
+            vc_mel, is_last_chunk = item
+            with metrics.stage("vocoder"):
                 vc_wave = self.vocoder(vc_mel).squeeze()[None]
+            return vc_wave, vc_mel, is_last_chunk
 
-                processed_frames, previous_chunk, should_break, mp3_bytes, full_audio = self._stream_wave_chunks(
+        chunk_conditions = style_chunk_conditions() if convert_style else plain_chunk_conditions()
+        if pipelined:
+            # AR / conditioning, CFM and vocoder of consecutive chunks run concurrently
+            chunks = StagePipeline(chunk_conditions, [cfm_stage, vocoder_stage])
+        else:
+            chunks = (vocoder_stage(cfm_stage(item)) for item in chunk_conditions)
+
+        # prepare for streaming
+        generated_wave_chunks = []
+        processed_frames = 0
+        previous_chunk = None
+        try:
+            for vc_wave, vc_mel, is_last_chunk in chunks:
+                processed_frames, previous_chunk, should_break, output_chunk, full_audio = self._stream_wave_chunks(
                     vc_wave, processed_frames, vc_mel, overlap_wave_len,
                     generated_wave_chunks, previous_chunk, is_last_chunk, stream_output
                 )
-                
-                if stream_output and mp3_bytes is not None:
-                    yield mp3_bytes, full_audio
+
+                if stream_output and output_chunk is not None:
+                    yield output_chunk, full_audio
                 if should_break:
                     break
+        finally:
+            if pipelined:
+                chunks.close()
+
+    def convert_voice_from_arrays(
+            self,
+            source_audio: Union[bytes, np.ndarray],
+            source_sr: int = None,
+            target_audio: Union[bytes, np.ndarray] = None,
+            target_sr: int = None,
+            **kwargs,
+    ):
+        """
+        In-memory variant of convert_voice_with_streaming, nothing touches the filesystem.
+
+        Args:
+            source_audio: Encoded audio bytes (WAV, FLAC, MP3, ...) or a float waveform sampled at source_sr
+            source_sr: Sample rate of source_audio if it is a waveform
+            target_audio: Same as source_audio for the target voice, may be None if `reference` is given
+            target_sr: Sample rate of target_audio if it is a waveform
+            **kwargs: Forwarded to convert_voice_with_streaming
+
+        Returns:
+            Same as convert_voice_with_streaming
+        """
+        if isinstance(source_audio, np.ndarray):
+            source_audio = (source_sr, source_audio)
+        if isinstance(target_audio, np.ndarray):
+            target_audio = (target_sr, target_audio)
+        return self.convert_voice_with_streaming(source_audio, target_audio, **kwargs)
+
+    def _prepare_source_condition(self, source_audio_path: Union[str, bytes, tuple], device: torch.device, dtype: torch.dtype):
+        """Length-regulated wide content condition of a source file, shape (1, T_mel, D)"""
+        source_wave_16k_tensor, source_mel_len = self._load_source(source_audio_path, device)
+        with torch.autocast(device_type=device.type, dtype=dtype):
+            source_content_indices = self._process_content_features(source_wave_16k_tensor, is_narrow=False)
+        cond, _ = self.cfm_length_regulator(source_content_indices, ylens=torch.LongTensor([source_mel_len]).to(device))
+        return cond
+
+    @torch.no_grad()
+    @torch.inference_mode()
+    def convert_voice_batch(
+            self,
+            source_audio_paths: list,
+            references: list,
+            diffusion_steps: int = 30,
+            intelligebility_cfg_rate: float = 0.7,
+            similarity_cfg_rate: float = 0.7,
+            anonymization_only: bool = False,
+            device: torch.device = torch.device("cuda"),
+            dtype: torch.dtype = torch.float16,
+            cfm_solver: str = "euler",
+            cfm_step_cache: Optional[StepCacheConfig] = None,
+    ):
+        """
+        Timbre-convert several independent (source, reference) pairs together.
+
+        Sources are processed in the same 30 s windows as convert_voice_with_streaming, but the i-th window
+        of every pair goes through one padded, length-masked CFM batch and one vocoder batch.
+        Style conversion is not supported here as AR decoding runs one sequence at a time.
+
+        Args:
+            source_audio_paths: Source audio files, as paths, encoded bytes or (sample_rate, waveform) tuples
+            references: ReferenceFeatures for each source, see prepare_reference
+            diffusion_steps: Number of diffusion steps (default: 30)
+            intelligebility_cfg_rate: CFG rate for intelligibility (default: 0.7)
+            similarity_cfg_rate: CFG rate for similarity (default: 0.7)
+            anonymization_only: Anonymization only mode (default: False)
+            device: Device to use (default: cuda)
+            dtype: Data type to use (default: float16)
+            cfm_solver: ODE solver of the flow-matching sampler, one of CFM.SOLVERS (default: euler)
+            cfm_step_cache: Reuse deep DiT features across diffusion steps, see StepCacheConfig (default: None)
+
+        Returns:
+            List of (sample_rate, audio_array) tuples, in the order of source_audio_paths
+        """
+        assert len(source_audio_paths) == len(references)
+        conds = [self._prepare_source_condition(path, device, dtype) for path in source_audio_paths]
+        return self._convert_conditions_batch(conds, references, diffusion_steps, intelligebility_cfg_rate,
+                                              similarity_cfg_rate, anonymization_only, device, cfm_solver,
+                                              cfm_step_cache)
+
+    @torch.no_grad()
+    @torch.inference_mode()
+    def convert_voice_fan_out(
+            self,
+            source_audio_path: str,
+            references: list,
+            diffusion_steps: int = 30,
+            intelligebility_cfg_rate: float = 0.7,
+            similarity_cfg_rate: float = 0.7,
+            device: torch.device = torch.device("cuda"),
+            dtype: torch.dtype = torch.float16,
+            max_batch_size: int = 8,
+            cfm_solver: str = "euler",
+            cfm_step_cache: Optional[StepCacheConfig] = None,
+    ):
+        """
+        Timbre-convert one source into several target voices.
+
+        The source is loaded and its content features and length-regulated condition are computed once,
+        then shared by every target, whose prompts, mels and styles are stacked along the batch axis.
+
+        Args:
+            source_audio_path: Path to source audio file, its encoded bytes or a (sample_rate, waveform) tuple
+            references: ReferenceFeatures of each target voice, see prepare_reference
+            max_batch_size: Number of targets per CFM/vocoder batch (default: 8)
+            ... (other parameters same as convert_voice_batch)
+
+        Returns:
+            List of (sample_rate, audio_array) tuples, in the order of references
+        """
+        cond = self._prepare_source_condition(source_audio_path, device, dtype)
+        outputs = []
+        for i in range(0, len(references), max_batch_size):
+            group = references[i:i + max_batch_size]
+            outputs += self._convert_conditions_batch([cond] * len(group), group, diffusion_steps,
+                                                      intelligebility_cfg_rate, similarity_cfg_rate, False, device,
+                                                      cfm_solver, cfm_step_cache)
+        return outputs
+
+    def _convert_conditions_batch(self, conds, references, diffusion_steps, intelligebility_cfg_rate,
+                                  similarity_cfg_rate, anonymization_only, device, cfm_solver="euler",
+                                  cfm_step_cache=None):
+        """Shared batched CFM/vocoder loop of convert_voice_batch and convert_voice_fan_out"""
+        max_context_window = self.sr // self.hop_size * self.dit_max_context_len
+        overlap_wave_len = self.overlap_frame_len * self.hop_size
+
+        # per-pair streaming state, same bookkeeping as convert_voice_with_streaming
+        processed_frames = [0] * len(conds)
+        previous_chunks = [None] * len(conds)
+        generated_wave_chunks = [[] for _ in conds]
+        outputs = [None] * len(conds)
+        while any(output is None for output in outputs):
+            active = [i for i, output in enumerate(outputs) if output is None]
+            cat_conditions, prompt_lens, is_last_chunks = [], [], []
+            for i in active:
+                prompt_len = references[i].target_mel.size(2)
+                max_source_window = max_context_window - prompt_len
+                chunk_cond = conds[i][:, processed_frames[i]:processed_frames[i] + max_source_window]
+                cat_conditions.append(torch.cat([references[i].prompt_condition, chunk_cond], dim=1)[0])
+                prompt_lens.append(prompt_len)
+                is_last_chunks.append(processed_frames[i] + max_source_window >= conds[i].size(1))
+
+            x_lens = torch.LongTensor([c.size(0) for c in cat_conditions]).to(device)
+            cat_condition = torch.nn.utils.rnn.pad_sequence(cat_conditions, batch_first=True, padding_value=0)
+            if self.dit_compiled:
+                cat_condition = torch.nn.functional.pad(
+                    cat_condition, (0, 0, 0, self.compile_pad_len(cat_condition.size(1)) - cat_condition.size(1),), value=0
+                )
+            prompt = torch.nn.utils.rnn.pad_sequence(
+                [references[i].target_mel[0].transpose(0, 1) for i in active], batch_first=True, padding_value=0
+            ).transpose(1, 2)
+            style = torch.cat([references[i].target_style for i in active], dim=0)
+            with torch.autocast(device_type=device.type, dtype=torch.float32):  # force CFM to use float32
+                vc_mel = self.cfm.inference(
+                    cat_condition,
+                    x_lens,
+                    prompt, style, diffusion_steps,
+                    inference_cfg_rate=[intelligebility_cfg_rate, similarity_cfg_rate],
+                    random_voice=anonymization_only,
+                    prompt_lens=torch.LongTensor(prompt_lens).to(device),
+                    solver=cfm_solver,
+                    step_cache=cfm_step_cache,
+                )
+
+            # cut each generated segment out of its prompt/padding and left-align them for the vocoder
+            vc_mels = [vc_mel[b, :, prompt_lens[b]:x_lens[b]] for b in range(len(active))]
+            mel_lens = [m.size(-1) for m in vc_mels]
+            padded_mel = torch.full([len(active), vc_mel.size(1), max(mel_lens)], float(np.log(1e-5)),
+                                    dtype=vc_mel.dtype, device=device)
+            for b, m in enumerate(vc_mels):
+                padded_mel[b, :, :m.size(-1)] = m
+            with metrics.stage("vocoder"):
+                vc_waves = self.vocoder(padded_mel)
+
+            for b, i in enumerate(active):
+                vc_wave = vc_waves[b].reshape(1, -1)[:, :mel_lens[b] * self.hop_size]
+                processed_frames[i], previous_chunks[i], should_break, _, full_audio = self._stream_wave_chunks(
+                    vc_wave, processed_frames[i], vc_mels[b][None], overlap_wave_len,
+                    generated_wave_chunks[i], previous_chunks[i], is_last_chunks[b], False
+                )
+                if should_break:
+                    outputs[i] = (self.sr, full_audio)
+        return outputs
@@ -0,0 +1,802 @@
+import math
+import queue
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torchaudio
+import torchaudio.transforms as tat
+import yaml
+
+from hf_utils import load_custom_model_from_hf
+from modules.commons import build_model, load_checkpoint, recursive_munch
+
+
+def synchronize(device):
+    """Wait for the queued kernels of `device`, so wall clock timings cover the actual work."""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+def load_models(args, device):
+    """
+    Load the v1 DiT and its companion models for real-time conversion.
+    Returns the model set consumed by RealtimeVCEngine:
+    (model, semantic_fn, vocoder_fn, campplus_model, to_mel, mel_fn_args)
+    """
+    if args.checkpoint_path is None or args.checkpoint_path == "":
+        dit_checkpoint_path, dit_config_path = load_custom_model_from_hf("Plachta/Seed-VC",
+                                                                         "DiT_uvit_tat_xlsr_ema.pth",
+                                                                         "config_dit_mel_seed_uvit_xlsr_tiny.yml")
+    else:
+        dit_checkpoint_path = args.checkpoint_path
+        dit_config_path = args.config_path
+    config = yaml.safe_load(open(dit_config_path, "r"))
+    model_params = recursive_munch(config["model_params"])
+    model_params.dit_type = 'DiT'
+    model = build_model(model_params, stage="DiT")
+    sr = config["preprocess_params"]["sr"]
+
+    # Load checkpoints
+    model, _, _, _ = load_checkpoint(
+        model,
+        None,
+        dit_checkpoint_path,
+        load_only_params=True,
+        ignore_modules=[],
+        is_distributed=False,
+    )
+    for key in model:
+        model[key].eval()
+        model[key].to(device)
+    model.cfm.estimator.setup_caches(max_batch_size=1, max_seq_length=8192)
+
+    # Load additional modules
+    from modules.campplus.DTDNN import CAMPPlus
+
+    campplus_ckpt_path = load_custom_model_from_hf(
+        "funasr/campplus", "campplus_cn_common.bin", config_filename=None
+    )
+    campplus_model = CAMPPlus(feat_dim=80, embedding_size=192)
+    campplus_model.load_state_dict(torch.load(campplus_ckpt_path, map_location="cpu"))
+    campplus_model.eval()
+    campplus_model.to(device)
+
+    vocoder_type = model_params.vocoder.type
+
+    if vocoder_type == 'bigvgan':
+        from modules.bigvgan import bigvgan
+        bigvgan_name = model_params.vocoder.name
+        bigvgan_model = bigvgan.BigVGAN.from_pretrained(bigvgan_name, use_cuda_kernel=False)
+        # remove weight norm in the model and set to eval mode
+        bigvgan_model.remove_weight_norm()
+        bigvgan_model = bigvgan_model.eval().to(device)
+        vocoder_fn = bigvgan_model
+    elif vocoder_type == 'hifigan':
+        from modules.hifigan.generator import HiFTGenerator
+        from modules.hifigan.f0_predictor import ConvRNNF0Predictor
+        hift_config = yaml.safe_load(open('configs/hifigan.yml', 'r'))
+        hift_gen = HiFTGenerator(**hift_config['hift'], f0_predictor=ConvRNNF0Predictor(**hift_config['f0_predictor']))
+        hift_path = load_custom_model_from_hf("FunAudioLLM/CosyVoice-300M", 'hift.pt', None)
+        hift_gen.load_state_dict(torch.load(hift_path, map_location='cpu'))
+        hift_gen.eval()
+        hift_gen.to(device)
+        vocoder_fn = hift_gen
+    elif vocoder_type == "vocos":
+        vocos_config = yaml.safe_load(open(model_params.vocoder.vocos.config, 'r'))
+        vocos_path = model_params.vocoder.vocos.path
+        vocos_model_params = recursive_munch(vocos_config['model_params'])
+        vocos = build_model(vocos_model_params, stage='mel_vocos')
+        vocos_checkpoint_path = vocos_path
+        vocos, _, _, _ = load_checkpoint(vocos, None, vocos_checkpoint_path,
+                                         load_only_params=True, ignore_modules=[], is_distributed=False)
+        _ = [vocos[key].eval().to(device) for key in vocos]
+        _ = [vocos[key].to(device) for key in vocos]
+        total_params = sum(sum(p.numel() for p in vocos[key].parameters() if p.requires_grad) for key in vocos.keys())
+        print(f"Vocoder model total parameters: {total_params / 1_000_000:.2f}M")
+        vocoder_fn = vocos.decoder
+    else:
+        raise ValueError(f"Unknown vocoder type: {vocoder_type}")
+
+    speech_tokenizer_type = model_params.speech_tokenizer.type
+    if speech_tokenizer_type == 'whisper':
+        # whisper
+        from transformers import AutoFeatureExtractor, WhisperModel
+        whisper_name = model_params.speech_tokenizer.name
+        whisper_model = WhisperModel.from_pretrained(whisper_name, torch_dtype=torch.float16).to(device)
+        del whisper_model.decoder
+        whisper_feature_extractor = AutoFeatureExtractor.from_pretrained(whisper_name)
+
+        def semantic_fn(waves_16k):
+            ori_inputs = whisper_feature_extractor([waves_16k.squeeze(0).cpu().numpy()],
+                                                   return_tensors="pt",
+                                                   return_attention_mask=True)
+            ori_input_features = whisper_model._mask_input_features(
+                ori_inputs.input_features, attention_mask=ori_inputs.attention_mask).to(device)
+            with torch.no_grad():
+                ori_outputs = whisper_model.encoder(
+                    ori_input_features.to(whisper_model.encoder.dtype),
+                    head_mask=None,
+                    output_attentions=False,
+                    output_hidden_states=False,
+                    return_dict=True,
+                )
+            S_ori = ori_outputs.last_hidden_state.to(torch.float32)
+            S_ori = S_ori[:, :waves_16k.size(-1) // 320 + 1]
+            return S_ori
+    elif speech_tokenizer_type == 'cnhubert':
+        from transformers import (
+            Wav2Vec2FeatureExtractor,
+            HubertModel,
+        )
+        hubert_model_name = config['model_params']['speech_tokenizer']['name']
+        hubert_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(hubert_model_name)
+        hubert_model = HubertModel.from_pretrained(hubert_model_name)
+        hubert_model = hubert_model.to(device)
+        hubert_model = hubert_model.eval()
+        hubert_model = hubert_model.half()
+
+        def semantic_fn(waves_16k):
+            ori_waves_16k_input_list = [
+                waves_16k[bib].cpu().numpy()
+                for bib in range(len(waves_16k))
+            ]
+            ori_inputs = hubert_feature_extractor(ori_waves_16k_input_list,
+                                                  return_tensors="pt",
+                                                  return_attention_mask=True,
+                                                  padding=True,
+                                                  sampling_rate=16000).to(device)
+            with torch.no_grad():
+                ori_outputs = hubert_model(
+                    ori_inputs.input_values.half(),
+                )
+            S_ori = ori_outputs.last_hidden_state.float()
+            return S_ori
+    elif speech_tokenizer_type == 'xlsr':
+        from transformers import (
+            Wav2Vec2FeatureExtractor,
+            Wav2Vec2Model,
+        )
+        model_name = config['model_params']['speech_tokenizer']['name']
+        output_layer = config['model_params']['speech_tokenizer']['output_layer']
+        wav2vec_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(model_name)
+        wav2vec_model = Wav2Vec2Model.from_pretrained(model_name)
+        wav2vec_model.encoder.layers = wav2vec_model.encoder.layers[:output_layer]
+        wav2vec_model = wav2vec_model.to(device)
+        wav2vec_model = wav2vec_model.eval()
+        wav2vec_model = wav2vec_model.half()
+
+        def semantic_fn(waves_16k):
+            ori_waves_16k_input_list = [
+                waves_16k[bib].cpu().numpy()
+                for bib in range(len(waves_16k))
+            ]
+            ori_inputs = wav2vec_feature_extractor(ori_waves_16k_input_list,
+                                                   return_tensors="pt",
+                                                   return_attention_mask=True,
+                                                   padding=True,
+                                                   sampling_rate=16000).to(device)
+            with torch.no_grad():
+                ori_outputs = wav2vec_model(
+                    ori_inputs.input_values.half(),
+                )
+            S_ori = ori_outputs.last_hidden_state.float()
+            return S_ori
+    else:
+        raise ValueError(f"Unknown speech tokenizer type: {speech_tokenizer_type}")
+    # Generate mel spectrograms
+    mel_fn_args = {
+        "n_fft": config['preprocess_params']['spect_params']['n_fft'],
+        "win_size": config['preprocess_params']['spect_params']['win_length'],
+        "hop_size": config['preprocess_params']['spect_params']['hop_length'],
+        "num_mels": config['preprocess_params']['spect_params']['n_mels'],
+        "sampling_rate": sr,
+        "fmin": config['preprocess_params']['spect_params'].get('fmin', 0),
+        "fmax": None if config['preprocess_params']['spect_params'].get('fmax', "None") == "None" else 8000,
+        "center": False
+    }
+    from modules.audio import mel_spectrogram
+
+    to_mel = lambda x: mel_spectrogram(x, **mel_fn_args)
+
+    return (
+        model,
+        semantic_fn,
+        vocoder_fn,
+        campplus_model,
+        to_mel,
+        mel_fn_args,
+    )
+
+
+class RingBuffer:
+    """
+    The latest `length` samples of a stream, in a preallocated buffer of twice that length where every sample is
+    written at both i and i + length. The window is then always one contiguous slice: write() costs O(block) and
+    view() copies nothing. Views alias the buffer and change with the next write(), clone what has to outlive it.
+    """
+
+    def __init__(self, length: int, device: torch.device, dtype=torch.float32):
+        self.length = length
+        self.buffer = torch.zeros(2 * length, device=device, dtype=dtype)
+        # position of the oldest sample of the window
+        self.start = 0
+
+    def write(self, block: torch.Tensor):
+        """Append `block` (at most `length` samples), dropping as many of the oldest samples."""
+        head = min(block.size(0), self.length - self.start)
+        for offset in (self.start, self.start + self.length):
+            self.buffer[offset:offset + head] = block[:head]
+        tail = block.size(0) - head
+        if tail > 0:
+            for offset in (0, self.length):
+                self.buffer[offset:offset + tail] = block[head:]
+        self.start = (self.start + block.size(0)) % self.length
+
+    def view(self) -> torch.Tensor:
+        """The window, oldest sample first."""
+        return self.buffer[self.start:self.start + self.length]
+
+
+class StreamingResampler:
+    """
+    Block-wise torchaudio sinc resampling that keeps the filter history between calls, so consecutive blocks are
+    resampled as one continuous signal instead of re-resampling an overlapping slice every block.
+
+    Blocks must be whole multiples of orig_freq / gcd(orig_freq, new_freq) samples, which every 20 ms frame is for
+    the rates used here. Each call then returns exactly len(block) * new_freq / orig_freq samples, delayed by the
+    filter half-width (`delay` input samples, under a millisecond).
+    """
+
+    def __init__(self, orig_freq: int, new_freq: int, device: torch.device):
+        gcd = math.gcd(orig_freq, new_freq)
+        self.orig_freq = orig_freq // gcd
+        self.new_freq = new_freq // gcd
+        if self.orig_freq == self.new_freq:
+            self.kernel, self.delay = None, 0
+        else:
+            resample = tat.Resample(orig_freq=orig_freq, new_freq=new_freq, dtype=torch.float32)
+            self.kernel = resample.kernel.to(device)
+            self.delay = resample.width
+        self.history = torch.zeros(2 * self.delay, device=device, dtype=torch.float32)
+
+    def __call__(self, block: torch.Tensor) -> torch.Tensor:
+        if self.kernel is None:
+            return block
+        if block.size(0) % self.orig_freq != 0:
+            raise ValueError(f"Block of {block.size(0)} samples is not a multiple of {self.orig_freq}")
+        waveform = torch.cat([self.history, block])
+        # the kernel spans 2 * delay + orig_freq input samples, one output frame of new_freq samples per orig_freq
+        resampled = F.conv1d(waveform[None, None], self.kernel, stride=self.orig_freq)
+        self.history = waveform[waveform.size(0) - 2 * self.delay:]
+        return resampled[0].t().reshape(-1)
+
+
+class IncrementalContentEncoder:
+    """
+    Content encoder for a window that slides left by whole blocks, reusing the features of the previous call.
+
+    Only the last `recompute_frames` 20 ms frames are recomputed, from the end of the window plus
+    `margin_frames` of left context that is encoded and discarded. The features of the rest of the window are
+    taken over from the previous call. The content encoders attend over their whole input, so the reused frames
+    are those of an earlier, shorter right context; the error stays small once the margin covers the context that
+    matters in practice, and it is recorded per call in `divergences` when `measure_divergence` is set (which runs
+    the full encoder as well and so costs more than it saves). Frames are aligned at the right end of the window,
+    which holds for every encoder in load_models since windows are whole 320 sample frames. Whisper pads every
+    input to 30 s, it gains nothing from this.
+    """
+
+    def __init__(self, semantic_fn, recompute_frames: int, margin_frames: int, measure_divergence: bool = False):
+        if margin_frames < 1:
+            raise ValueError("The recomputed segment needs at least one frame of left context")
+        self.semantic_fn = semantic_fn
+        self.recompute_frames = recompute_frames
+        self.margin_frames = margin_frames
+        self.measure_divergence = measure_divergence
+        self.reset()
+
+    def reset(self):
+        self.features = None
+        self.pending_frames = 0
+        self.divergences = []
+
+    def advance(self, num_samples: int):
+        """Record that the window slid left by `num_samples` 16 kHz samples, a multiple of 320."""
+        self.pending_frames += num_samples // 320
+
+    def __call__(self, waves_16k: torch.Tensor) -> torch.Tensor:
+        segment_samples = (self.recompute_frames + self.margin_frames) * 320
+        if (
+            self.features is None
+            or self.pending_frames > self.recompute_frames
+            or segment_samples >= waves_16k.size(-1)
+        ):
+            features = self.semantic_fn(waves_16k)
+        else:
+            num_frames = self.features.size(1)
+            fresh = self.semantic_fn(waves_16k[:, -segment_samples:])[:, -self.recompute_frames:]
+            features = torch.cat([
+                self.features[:, self.pending_frames:self.pending_frames + num_frames - self.recompute_frames],
+                fresh,
+            ], dim=1)
+            if self.measure_divergence:
+                full = self.semantic_fn(waves_16k)
+                self.divergences.append({
+                    "relative_l1": ((features - full).abs().mean() / full.abs().mean()).item(),
+                    "min_cosine": F.cosine_similarity(features, full, dim=-1).min().item(),
+                })
+        self.features = features
+        self.pending_frames = 0
+        return features
+
+
+class RealtimeVCEngine:
+    """
+    Block-by-block voice conversion with the v1 DiT, free of any audio device or GUI state.
+
+    Every process_block() call takes exactly `block_frame` mono float32 samples at `samplerate` and returns
+    as many converted samples. Each block is converted together with `extra_time_ce` seconds of left context
+    for the content encoder (`extra_time` of which reach the DiT) and `extra_time_right` seconds of right
+    context, consecutive outputs are stitched with SOLA, so the output lags the input by roughly
+    block_time + crossfade_time + extra_time_right.
+    """
+
+    def __init__(
+        self,
+        model_set,
+        reference_wav: np.ndarray,
+        device: torch.device,
+        samplerate: int = None,
+        block_time: float = 0.25,
+        crossfade_time: float = 0.05,
+        extra_time_ce: float = 2.5,
+        extra_time: float = 0.5,
+        extra_time_right: float = 2.0,
+        diffusion_steps: int = 10,
+        inference_cfg_rate: float = 0.7,
+        max_prompt_length: float = 3.0,
+        fp16: bool = False,
+        vad_model=None,
+        silence_threshold_db: float = None,
+        content_recompute_time: float = None,
+        content_margin_time: float = 1.0,
+        measure_content_divergence: bool = False,
+    ):
+        """
+        Args:
+            model_set: the tuple returned by load_models
+            reference_wav: reference voice at the model sampling rate
+            samplerate: sampling rate of the input and output blocks, defaults to the model's
+            vad_model: optional FunASR streaming VAD, blocks outside detected speech are output as silence
+                without running inference
+            silence_threshold_db: optional energy gate, blocks are treated as silence as well when every 20 ms frame
+                of the audio they are converted from stays below this level (dBFS)
+            content_recompute_time: when set, the content encoder only recomputes this many seconds at the end of
+                the window (at least one block) from `content_margin_time` seconds of extra left context, see
+                IncrementalContentEncoder; by default the whole window is encoded every block
+            measure_content_divergence: also run the full content encoder and record the difference
+        """
+        if extra_time_ce - extra_time < 0:
+            raise ValueError("Content encoder extra context must be greater than DiT extra context!")
+        self.model_set = model_set
+        self.device = device
+        self.model_sr = model_set[-1]["sampling_rate"]
+        self.samplerate = samplerate or self.model_sr
+        self.block_time = block_time
+        self.extra_time_ce = extra_time_ce
+        self.extra_time = extra_time
+        self.diffusion_steps = diffusion_steps
+        self.inference_cfg_rate = inference_cfg_rate
+        self.fp16 = fp16
+        self.vad_model = vad_model
+        self.silence_threshold_db = silence_threshold_db
+        # when set, blocks are passed through unconverted (input monitoring)
+        self.passthrough = False
+        # per-stage wall time of the last block in ms
+        self.timings = {}
+
+        self.zc = self.samplerate // 50  # 44100 // 100 = 441
+        self.block_frame = self._frames(block_time)
+        self.block_frame_16k = 320 * self.block_frame // self.zc
+        self.crossfade_frame = self._frames(crossfade_time)
+        self.sola_buffer_frame = min(self.crossfade_frame, 4 * self.zc)
+        self.sola_search_frame = self.zc
+        self.extra_frame = self._frames(extra_time_ce)
+        self.extra_frame_right = self._frames(extra_time_right)
+        if content_recompute_time is None:
+            self.content_encoder = None
+        else:
+            self.content_encoder = IncrementalContentEncoder(
+                model_set[1],
+                max(int(np.round(content_recompute_time * 50)), self.block_frame_16k // 320),
+                int(np.round(content_margin_time * 50)),
+                measure_content_divergence,
+            )
+        self.skip_head = self.extra_frame // self.zc
+        self.skip_tail = self.extra_frame_right // self.zc
+        self.return_length = (
+            self.block_frame + self.sola_buffer_frame + self.sola_search_frame
+        ) // self.zc
+
+        self.fade_in_window: torch.Tensor = (
+            torch.sin(
+                0.5
+                * np.pi
+                * torch.linspace(
+                    0.0,
+                    1.0,
+                    steps=self.sola_buffer_frame,
+                    device=self.device,
+                    dtype=torch.float32,
+                )
+            )
+            ** 2
+        )
+        self.fade_out_window: torch.Tensor = 1 - self.fade_in_window
+        self.sola_ones = torch.ones(1, 1, self.sola_buffer_frame, device=self.device)
+        if self.model_sr != self.samplerate:
+            self.resampler2 = tat.Resample(
+                orig_freq=self.model_sr,
+                new_freq=self.samplerate,
+                dtype=torch.float32,
+            ).to(self.device)
+        else:
+            self.resampler2 = None
+
+        self.set_reference(reference_wav, max_prompt_length)
+        self.reset()
+
+    def _frames(self, seconds: float) -> int:
+        """Duration in samples, rounded to whole 20 ms frames."""
+        return int(np.round(seconds * self.samplerate / self.zc)) * self.zc
+
+    @property
+    def latency(self) -> float:
+        """Algorithmic delay in seconds between a sample entering and leaving the engine."""
+        return (self.block_frame + self.crossfade_frame + self.extra_frame_right) / self.samplerate + 0.01
+
+    def reset(self):
+        """Forget all audio seen so far, as if the stream had just started."""
+        self.input_wav = RingBuffer(
+            self.extra_frame
+            + self.crossfade_frame
+            + self.sola_search_frame
+            + self.block_frame
+            + self.extra_frame_right,
+            self.device,
+        )
+        self.input_wav_res = RingBuffer(
+            320 * self.input_wav.length // self.zc, self.device
+        )  # input wave 44100 -> 16000
+        self.resampler = StreamingResampler(self.samplerate, 16000, self.device)
+        self.sola_buffer: torch.Tensor = torch.zeros(
+            self.sola_buffer_frame, device=self.device, dtype=torch.float32
+        )
+        self.vad_cache = {}
+        self.vad_chunk_size = min(500, 1000 * self.block_time)
+        self.vad_speech_detected = self.vad_model is None
+        self.set_speech_detected_false_at_end_flag = False
+        # number of blocks output as silence without running inference
+        self.silent_blocks = 0
+        if self.content_encoder is not None:
+            self.content_encoder.reset()
+
+    @torch.no_grad()
+    def set_reference(self, reference_wav: np.ndarray, max_prompt_length: float = 3.0):
+        """Compute the prompt condition, mel and style of a new reference voice."""
+        model, semantic_fn, _, campplus_model, to_mel, _ = self.model_set
+        self.max_prompt_length = max_prompt_length
+        reference_wav = reference_wav[:int(self.model_sr * max_prompt_length)]
+        reference_wav_tensor = torch.from_numpy(reference_wav).to(self.device)
+
+        ori_waves_16k = torchaudio.functional.resample(reference_wav_tensor, self.model_sr, 16000)
+        S_ori = semantic_fn(ori_waves_16k.unsqueeze(0))
+        feat2 = torchaudio.compliance.kaldi.fbank(
+            ori_waves_16k.unsqueeze(0), num_mel_bins=80, dither=0, sample_frequency=16000
+        )
+        feat2 = feat2 - feat2.mean(dim=0, keepdim=True)
+        self.style2 = campplus_model(feat2.unsqueeze(0))
+
+        self.mel2 = to_mel(reference_wav_tensor.unsqueeze(0))
+        target2_lengths = torch.LongTensor([self.mel2.size(2)]).to(self.mel2.device)
+        self.prompt_condition = model.length_regulator(
+            S_ori, ylens=target2_lengths, n_quantizers=3, f0=None
+        )[0]
+
+    def _detect_speech(self, indata_16k: torch.Tensor):
+        """Advance the streaming VAD by one 16 kHz block and update vad_speech_detected."""
+        res = self.vad_model.generate(input=indata_16k.cpu().numpy(), cache=self.vad_cache, is_final=False,
+                                      chunk_size=self.vad_chunk_size)
+        res_value = res[0]["value"]
+        if len(res_value) % 2 == 1 and not self.vad_speech_detected:
+            self.vad_speech_detected = True
+        elif len(res_value) % 2 == 1 and self.vad_speech_detected:
+            self.set_speech_detected_false_at_end_flag = True
+
+    def _push_input(self, indata: np.ndarray) -> torch.Tensor:
+        """Append a new block to the rolling input windows at the stream and 16 kHz rates, returns the 16 kHz block."""
+        indata = torch.from_numpy(indata).to(self.device)
+        self.input_wav.write(indata)
+        indata_16k = self.resampler(indata)
+        self.input_wav_res.write(indata_16k)
+        if self.content_encoder is not None:
+            self.content_encoder.advance(self.block_frame_16k)
+        return indata_16k
+
+    def _infer(self) -> torch.Tensor:
+        """Convert the current window, returns the block plus SOLA margins at the stream rate."""
+        model, semantic_fn, vocoder_fn, _, _, mel_fn_args = self.model_set
+        sr = mel_fn_args["sampling_rate"]
+        hop_length = mel_fn_args["hop_size"]
+
+        if self.content_encoder is not None:
+            semantic_fn = self.content_encoder
+        S_alt = semantic_fn(self.input_wav_res.view().unsqueeze(0))
+        ce_dit_frame_difference = int((self.extra_time_ce - self.extra_time) * 50)
+        S_alt = S_alt[:, ce_dit_frame_difference:]
+        target_lengths = torch.LongTensor([
+            (self.skip_head + self.return_length + self.skip_tail - ce_dit_frame_difference) / 50 * sr // hop_length
+        ]).to(S_alt.device)
+        cond = model.length_regulator(
+            S_alt, ylens=target_lengths, n_quantizers=3, f0=None
+        )[0]
+        cat_condition = torch.cat([self.prompt_condition, cond], dim=1)
+        with torch.autocast(device_type=self.device.type, dtype=torch.float16 if self.fp16 else torch.float32):
+            vc_target = model.cfm.inference(
+                cat_condition,
+                torch.LongTensor([cat_condition.size(1)]).to(self.mel2.device),
+                self.mel2,
+                self.style2,
+                None,
+                n_timesteps=self.diffusion_steps,
+                inference_cfg_rate=self.inference_cfg_rate,
+            )
+            vc_target = vc_target[:, :, self.mel2.size(-1) :]
+            vc_wave = vocoder_fn(vc_target).squeeze()
+        output_len = self.return_length * sr // 50
+        tail_len = self.skip_tail * sr // 50
+        infer_wav = vc_wave[-output_len - tail_len: -tail_len].float()
+        if self.resampler2 is not None:
+            infer_wav = self.resampler2(infer_wav)
+        return infer_wav
+
+    def _sola(self, infer_wav: torch.Tensor) -> torch.Tensor:
+        """Align infer_wav to the previous output and crossfade them, returns the next block_frame samples."""
+        # SOLA algorithm from https://github.com/yxlllc/DDSP-SVC
+        conv_input = infer_wav[
+            None, None, : self.sola_buffer_frame + self.sola_search_frame
+        ]
+
+        cor_nom = F.conv1d(conv_input, self.sola_buffer[None, None, :])
+        cor_den = torch.sqrt(
+            F.conv1d(
+                conv_input**2,
+                self.sola_ones,
+            )
+            + 1e-8
+        )
+
+        tensor = cor_nom[0, 0] / cor_den[0, 0]
+        if tensor.numel() > 1:  # If tensor has multiple elements
+            if sys.platform == "darwin":
+                _, sola_offset = torch.max(tensor, dim=0)
+                sola_offset = sola_offset.item()
+            else:
+                sola_offset = torch.argmax(tensor, dim=0).item()
+        else:
+            sola_offset = tensor.item()
+
+        infer_wav = infer_wav[int(sola_offset):]
+        infer_wav[: self.sola_buffer_frame] *= self.fade_in_window
+        infer_wav[: self.sola_buffer_frame] += (
+            self.sola_buffer * self.fade_out_window
+        )
+        self.sola_buffer[:] = infer_wav[
+            self.block_frame : self.block_frame + self.sola_buffer_frame
+        ]
+        return infer_wav[: self.block_frame]
+
+    def _is_silent(self) -> bool:
+        """Whether the current block can be output as silence without running inference."""
+        if not self.vad_speech_detected:
+            return True
+        if self.silence_threshold_db is None:
+            return False
+        # the audio that ends up in this block's output, block and SOLA margins plus the right context
+        frames = self.input_wav.view()[self.extra_frame :].view(-1, self.zc)
+        peak_rms = frames.pow(2).mean(dim=1).max().sqrt().item()
+        return 20 * np.log10(peak_rms + 1e-8) < self.silence_threshold_db
+
+    def _fade_to_silence(self) -> torch.Tensor:
+        """
+        The SOLA output of an all-zero inference window, computed directly: the correlation with silence is flat so
+        the offset is 0, the previous output fades out over the crossfade and the SOLA buffer becomes silence, from
+        which the next speech block fades in.
+        """
+        infer_wav = torch.zeros(self.block_frame + self.sola_buffer_frame, device=self.device, dtype=torch.float32)
+        infer_wav[: self.sola_buffer_frame] = self.sola_buffer * self.fade_out_window
+        self.sola_buffer[:] = infer_wav[self.block_frame :]
+        return infer_wav[: self.block_frame]
+
+    @torch.no_grad()
+    def process_block(self, pcm: np.ndarray) -> np.ndarray:
+        """Convert one block of `block_frame` mono samples, returns `block_frame` output samples."""
+        start_time = time.perf_counter()
+        pcm = np.ascontiguousarray(pcm, dtype=np.float32)
+        if pcm.shape != (self.block_frame,):
+            raise ValueError(f"Expected a mono block of {self.block_frame} samples, got shape {pcm.shape}")
+
+        indata_16k = self._push_input(pcm)
+        preprocess_time = time.perf_counter()
+        if self.vad_model is not None:
+            self._detect_speech(indata_16k)
+        vad_time = time.perf_counter()
+
+        # the rolling windows above are updated for every block, silent or not, so the context of the first
+        # speech block after a pause is complete
+        if self.passthrough:
+            output = self._sola(self.input_wav.view()[self.extra_frame :].clone())
+        elif self._is_silent():
+            output = self._fade_to_silence()
+            self.silent_blocks += 1
+        else:
+            output = self._sola(self._infer())
+        synchronize(self.device)
+        infer_time = time.perf_counter()
+
+        output = output.cpu().numpy()
+
+        if self.set_speech_detected_false_at_end_flag:
+            self.vad_speech_detected = False
+            self.set_speech_detected_false_at_end_flag = False
+
+        end_time = time.perf_counter()
+        self.timings = {
+            "preprocess": (preprocess_time - start_time) * 1000,
+            "vad": (vad_time - preprocess_time) * 1000,
+            "infer": (infer_time - vad_time) * 1000,
+            "total": (end_time - start_time) * 1000,
+        }
+        return output
+
+
+class JitterBuffer:
+    """
+    Adaptive playout buffer between the inference thread and the audio callback.
+
+    Playback (re)starts only once `target_depth` converted blocks are queued. Every underrun (the callback asks for
+    a block that is not there yet) raises the target by one block, up to `max_depth`; after `relax_blocks`
+    consecutive blocks played without underrun the target is lowered again by one, dropping a queued block if
+    that is needed to actually shorten the delay. Blocks arriving while `max_depth` are already queued are
+    overruns and replace the oldest queued block.
+    """
+
+    def __init__(self, block_frame: int, min_depth: int = 1, max_depth: int = 8, relax_blocks: int = 200):
+        self.block_frame = block_frame
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.relax_blocks = relax_blocks
+        self.target_depth = min_depth
+        self.underruns = 0
+        self.overruns = 0
+        self._blocks = deque()
+        self._lock = threading.Lock()
+        self._buffering = True
+        self._stable_blocks = 0
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def put(self, block: np.ndarray):
+        with self._lock:
+            if len(self._blocks) >= self.max_depth:
+                self._blocks.popleft()
+                self.overruns += 1
+            self._blocks.append(block)
+
+    def get(self) -> np.ndarray:
+        """Next block to play, silence while prefilling or on underrun; never blocks."""
+        with self._lock:
+            if self._buffering:
+                if len(self._blocks) < self.target_depth:
+                    return np.zeros(self.block_frame, dtype=np.float32)
+                self._buffering = False
+            if not self._blocks:
+                self.underruns += 1
+                self.target_depth = min(self.target_depth + 1, self.max_depth)
+                self._buffering = True
+                self._stable_blocks = 0
+                return np.zeros(self.block_frame, dtype=np.float32)
+            block = self._blocks.popleft()
+            self._stable_blocks += 1
+            if self._stable_blocks >= self.relax_blocks and self.target_depth > self.min_depth:
+                self.target_depth -= 1
+                self._stable_blocks = 0
+                if len(self._blocks) > self.target_depth:
+                    self._blocks.popleft()
+            return block
+
+
+class ThreadedRealtimeVC:
+    """
+    Runs a RealtimeVCEngine on a dedicated inference thread, so a slow block never stalls the audio callback.
+
+    The callback side only calls push() with the captured block and pull() for the block to play, both return
+    immediately. Input blocks wait in a bounded queue, when the inference thread falls `max_pending` blocks
+    behind the oldest is discarded and counted as an overrun. Converted blocks go through a JitterBuffer, whose
+    depth adapts to the variance of the per-block compute time.
+    """
+
+    def __init__(self, engine: RealtimeVCEngine, max_pending: int = 4, min_depth: int = 1, max_depth: int = 8,
+                 relax_blocks: int = 200):
+        self.engine = engine
+        self.jitter_buffer = JitterBuffer(engine.block_frame, min_depth, max_depth, relax_blocks)
+        self.input_overruns = 0
+        self.blocks_processed = 0
+        self._inputs = queue.Queue(maxsize=max_pending)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def latency(self) -> float:
+        """Algorithmic delay of the engine plus the current playout buffer depth, in seconds."""
+        block_duration = self.engine.block_frame / self.engine.samplerate
+        return self.engine.latency + self.jitter_buffer.target_depth * block_duration
+
+    def stats(self) -> dict:
+        return {
+            "underruns": self.jitter_buffer.underruns,
+            "overruns": self.jitter_buffer.overruns + self.input_overruns,
+            "input_overruns": self.input_overruns,
+            "output_overruns": self.jitter_buffer.overruns,
+            "buffer_depth": len(self.jitter_buffer),
+            "target_depth": self.jitter_buffer.target_depth,
+            "blocks_processed": self.blocks_processed,
+            "silent_blocks": self.engine.silent_blocks,
+        }
+
+    def push(self, pcm: np.ndarray):
+        """Hand a captured block to the inference thread."""
+        block = np.array(pcm, dtype=np.float32)
+        while True:
+            try:
+                self._inputs.put_nowait(block)
+                return
+            except queue.Full:
+                try:
+                    self._inputs.get_nowait()
+                    self.input_overruns += 1
+                except queue.Empty:
+                    pass
+
+    def pull(self) -> np.ndarray:
+        """Next converted block to play, silence if none is ready."""
+        return self.jitter_buffer.get()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                block = self._inputs.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                output = self.engine.process_block(block)
+            except Exception:
+                # keep the stream alive, the block is lost and will surface as an underrun
+                traceback.print_exc()
+                continue
+            self.jitter_buffer.put(output)
+            self.blocks_processed += 1
+
+    def close(self):
+        """Stop the inference thread, blocks still queued are dropped."""
+        self._stop.set()
+        self._thread.join()
@@ -1,15 +1,29 @@
 import os
 import io
-import tempfile
+import asyncio
+import base64
+import hashlib
+import multiprocessing
+import queue
+import threading
 import torch
 import yaml
 import soundfile as sf
 import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import partial
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, Union
 from modules.commons import str2bool
+from modules.v2.vc_wrapper import ReferenceFeatures
+from modules.v2.ar import KVCache, PagedKVCache
+from modules.v2.cfm import CFM
+from modules.v2.dit_wrapper import StepCacheConfig
+from modules.v2.audio_encoders import STREAM_ENCODERS, get_stream_encoder
+from modules.v2 import metrics
 
 if torch.cuda.is_available():
     device = torch.device("cuda")
@@ -22,6 +36,41 @@ dtype = torch.float16
 
 vc_wrapper_v2 = None
 
+# Reference-voice feature cache, see ReferenceCache
+REFERENCE_CACHE_SIZE = int(os.environ.get("SEED_VC_REFERENCE_CACHE_SIZE", 64))
+REFERENCE_CACHE_DIR = os.environ.get("SEED_VC_REFERENCE_CACHE_DIR") or None
+
+# Inference thread, micro-batching and admission control, see InferenceExecutor
+BATCH_WINDOW_MS = float(os.environ.get("SEED_VC_BATCH_WINDOW_MS", 20))
+MAX_BATCH_SIZE = int(os.environ.get("SEED_VC_MAX_BATCH_SIZE", 8))
+MAX_QUEUE_DEPTH = int(os.environ.get("SEED_VC_MAX_QUEUE_DEPTH", 32))
+REQUEST_TIMEOUT_S = float(os.environ.get("SEED_VC_REQUEST_TIMEOUT_S", 300))
+# AR chunks of a convert_style request decoded together, sizes the AR KV cache
+AR_BATCH_SIZE = int(os.environ.get("SEED_VC_AR_BATCH_SIZE", 4))
+# Speculative AR decoding draft length, 0 disables it; mostly pays off on CPU
+AR_DRAFT_TOKENS = int(os.environ.get("SEED_VC_AR_DRAFT_TOKENS", 0))
+# Paged AR KV cache: positions per page (0 keeps the dense cache) and pages in the shared pool
+AR_KV_PAGE_SIZE = int(os.environ.get("SEED_VC_AR_KV_PAGE_SIZE", 0)) or None
+AR_KV_PAGES = int(os.environ.get("SEED_VC_AR_KV_PAGES", 512))
+# Overlap AR, CFM and vocoder of consecutive chunks of long inputs on worker threads
+PIPELINE_STAGES = str2bool(os.environ.get("SEED_VC_PIPELINE", "false"))
+
+# Model replicas in separate processes for CPU serving, see ReplicaPool; 1 keeps inference in this process
+NUM_REPLICAS = int(os.environ.get("SEED_VC_REPLICAS", 1))
+THREADS_PER_REPLICA = int(os.environ.get("SEED_VC_THREADS_PER_REPLICA", 0)) or None
+
+# Per-stage timing exposed on /metrics, see modules/v2/metrics.py
+metrics.enabled = str2bool(os.environ.get("SEED_VC_METRICS", "true"))
+metrics.REGISTRY.describe("seed_vc_queue_wait_seconds", "Time a job waited in the inference queue")
+metrics.REGISTRY.describe("seed_vc_request_seconds", "Inference wall time of one batch or streamed request")
+metrics.REGISTRY.describe("seed_vc_request_stage_seconds", "Per-request total time spent in each stage, by input length")
+metrics.REGISTRY.describe("seed_vc_request_rtf", "Real-time factor, inference seconds per second of audio produced")
+metrics.REGISTRY.describe("seed_vc_real_time_factor", "Real-time factor of the last request")
+metrics.REGISTRY.describe("seed_vc_stage_real_time_factor", "Real-time factor of each stage in the last request")
+
+# input-length labels for the per-request stage breakdown, in seconds of output audio
+INPUT_LENGTH_BUCKETS = (5, 15, 30, 60)
+
 app = FastAPI(
     title="Seed-VC Voice Conversion API",
     description="Real-time voice conversion using Seed-VC V2 model",
@@ -32,6 +81,8 @@ app = FastAPI(
 class ConversionParams(BaseModel):
     """Request parameters for voice conversion"""
     diffusion_steps: int = 30
+    cfm_solver: str = "euler"
+    step_cache_interval: int = 0
     length_adjust: float = 1.0
     intelligibility_cfg_rate: float = 0.7
     similarity_cfg_rate: float = 0.7
@@ -50,6 +101,90 @@ class ConversionRequest:
             setattr(self, key, value)
 
 
+class ReferenceCache:
+    """
+    LRU cache of precomputed reference-voice features keyed by the content hash of the target file.
+
+    Traffic uses a small set of fixed target voices, so the target mel, content indices, style vector
+    and prompt condition are computed once per voice instead of once per request. When `cache_dir` is
+    set, every bundle is also written to disk so a restarted service comes back warm. Bundles are stored
+    under a subdirectory per model identity, so swapping checkpoints or dtype never serves stale features.
+    """
+    def __init__(self, max_entries: int = 64, cache_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def model_identity(vc_wrapper) -> str:
+        """Hash of the checkpoints the wrapper loaded (paths and modification times) and the inference dtype"""
+        digest = hashlib.sha256(str(dtype).encode())
+        for name, path in sorted(vc_wrapper.checkpoint_paths.items()):
+            path = os.path.abspath(path)
+            digest.update(f"{name}={path}@{os.path.getmtime(path)}".encode())
+        return digest.hexdigest()[:16]
+
+    def get(self, target_audio_path: str, vc_wrapper) -> ReferenceFeatures:
+        """Return the reference bundle for a target file, computing and storing it on a miss"""
+        key = os.path.join(self.model_identity(vc_wrapper), self.hash_file(target_audio_path))
+        with self._lock:
+            reference = self._entries.get(key)
+            if reference is not None:
+                self._entries.move_to_end(key)
+                return reference
+
+        reference = self._load_from_disk(key)
+        if reference is None:
+            reference = vc_wrapper.prepare_reference(target_audio_path, device=device, dtype=dtype)
+            self._save_to_disk(key, reference)
+
+        with self._lock:
+            self._entries[key] = reference
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return reference
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def _load_from_disk(self, key: str) -> Optional[ReferenceFeatures]:
+        if self.cache_dir is None or not os.path.exists(self._disk_path(key)):
+            return None
+        try:
+            state = torch.load(self._disk_path(key), map_location=device)
+            return ReferenceFeatures(**state)
+        except Exception as e:
+            print(f"Ignoring unreadable reference cache entry {key}: {e}")
+            return None
+
+    def _save_to_disk(self, key: str, reference: ReferenceFeatures):
+        if self.cache_dir is None:
+            return
+        # write to a temporary file first so a crash never leaves a truncated entry behind
+        os.makedirs(os.path.dirname(self._disk_path(key)), exist_ok=True)
+        tmp_path = self._disk_path(key) + ".tmp"
+        torch.save(reference.to("cpu").state_dict(), tmp_path)
+        os.replace(tmp_path, self._disk_path(key))
+
+
+reference_cache = ReferenceCache(max_entries=REFERENCE_CACHE_SIZE, cache_dir=REFERENCE_CACHE_DIR)
+
+
 def load_v2_models(args):
     """Load V2 models using the wrapper"""
     from hydra.utils import instantiate
@@ -64,7 +199,9 @@ def load_v2_models(args):
     vc_wrapper.to(device)
     vc_wrapper.eval()
 
-    vc_wrapper.setup_ar_caches(max_batch_size=1, max_seq_len=4096, dtype=dtype, device=device)
+    vc_wrapper.setup_ar_caches(max_batch_size=AR_BATCH_SIZE, max_seq_len=4096, dtype=dtype, device=device,
+                               page_size=AR_KV_PAGE_SIZE, num_pages=AR_KV_PAGES)
+    vc_wrapper.ar_draft_tokens = AR_DRAFT_TOKENS
 
     if args.compile:
         torch._inductor.config.coordinate_descent_tuning = True
@@ -72,28 +209,39 @@ def load_v2_models(args):
 
         if hasattr(torch._inductor.config, "fx_graph_cache"):
             torch._inductor.config.fx_graph_cache = True
-        vc_wrapper.compile_ar()
+        # compiles and warms the AR decode step per batch size and one DiT graph per length bucket
+        # before the first request is served
+        vc_wrapper.compile_ar(warmup_device=device)
+        vc_wrapper.compile_cfm(warmup_device=device, max_batch_size=MAX_BATCH_SIZE)
 
     return vc_wrapper
 
 
-def convert_voice_v2(source_audio_path: str, target_audio_path: str, args) -> tuple:
+def step_cache_config(args) -> Optional[StepCacheConfig]:
+    return StepCacheConfig(interval=args.step_cache_interval) if args.step_cache_interval > 1 else None
+
+
+def stream_voice_v2(source_audio_path: Union[str, bytes], target_audio_path: str, args, output_format: str = "numpy"):
     """
-    Convert voice using V2 model
+    Convert voice using V2 model, yielding each crossfaded chunk as soon as it is generated
     
     Returns:
-        Tuple of (sample_rate, audio_array)
+        Generator of (chunk, full_audio) tuples, full_audio is only set on the last one
     """
     global vc_wrapper_v2
     if vc_wrapper_v2 is None:
         vc_wrapper_v2 = load_v2_models(args)
 
-    generator = vc_wrapper_v2.convert_voice_with_streaming(
+    reference = reference_cache.get(target_audio_path, vc_wrapper_v2)
+
+    return vc_wrapper_v2.convert_voice_with_streaming(
         source_audio_path=source_audio_path,
         target_audio_path=target_audio_path,
         diffusion_steps=args.diffusion_steps,
+        cfm_solver=args.cfm_solver,
+        cfm_step_cache=step_cache_config(args),
         length_adjust=args.length_adjust,
-        intelligibility_cfg_rate=args.intelligibility_cfg_rate,
+        intelligebility_cfg_rate=args.intelligibility_cfg_rate,
         similarity_cfg_rate=args.similarity_cfg_rate,
         top_p=args.top_p,
         temperature=args.temperature,
@@ -102,31 +250,572 @@ def convert_voice_v2(source_audio_path: str, target_audio_path: str, args) -> tu
         anonymization_only=args.anonymization_only,
         device=device,
         dtype=dtype,
-        stream_output=True
+        stream_output=True,
+        reference=reference,
+        output_format=output_format,
+        pipelined=PIPELINE_STAGES,
     )
 
+
+def convert_voice_v2(source_audio_path: Union[str, bytes], target_audio_path: str, args) -> tuple:
+    """
+    Convert voice using V2 model
+    
+    Returns:
+        Tuple of (sample_rate, audio_array)
+    """
     full_audio = None
-    for output in generator:
-        _, full_audio = output
+    for _, full_audio in stream_voice_v2(source_audio_path, target_audio_path, args, output_format="none"):
+        pass
     
     return full_audio
 
 
+def convert_voice_v2_batch(source_audio_paths: list, target_audio_paths: list, args) -> list:
+    """
+    Timbre-convert several (source, target) pairs in one padded CFM/vocoder batch
+
+    Returns:
+        List of (sample_rate, audio_array) tuples
+    """
+    global vc_wrapper_v2
+    if vc_wrapper_v2 is None:
+        vc_wrapper_v2 = load_v2_models(args)
+
+    references = [reference_cache.get(path, vc_wrapper_v2) for path in target_audio_paths]
+    return vc_wrapper_v2.convert_voice_batch(
+        source_audio_paths=source_audio_paths,
+        references=references,
+        diffusion_steps=args.diffusion_steps,
+        cfm_solver=args.cfm_solver,
+        cfm_step_cache=step_cache_config(args),
+        intelligebility_cfg_rate=args.intelligibility_cfg_rate,
+        similarity_cfg_rate=args.similarity_cfg_rate,
+        anonymization_only=args.anonymization_only,
+        device=device,
+        dtype=dtype,
+    )
+
+
+def convert_voice_v2_fan_out(source_audio_path: Union[str, bytes], target_audio_paths: list, args) -> list:
+    """
+    Timbre-convert one source into several target voices, sharing the source features across the batch
+
+    Returns:
+        List of (sample_rate, audio_array) tuples, in the order of target_audio_paths
+    """
+    global vc_wrapper_v2
+    if vc_wrapper_v2 is None:
+        vc_wrapper_v2 = load_v2_models(args)
+
+    references = [reference_cache.get(path, vc_wrapper_v2) for path in target_audio_paths]
+    return vc_wrapper_v2.convert_voice_fan_out(
+        source_audio_path=source_audio_path,
+        references=references,
+        diffusion_steps=args.diffusion_steps,
+        cfm_solver=args.cfm_solver,
+        cfm_step_cache=step_cache_config(args),
+        intelligebility_cfg_rate=args.intelligibility_cfg_rate,
+        similarity_cfg_rate=args.similarity_cfg_rate,
+        device=device,
+        dtype=dtype,
+        max_batch_size=MAX_BATCH_SIZE,
+    )
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue is at capacity and a request has to be turned away"""
+
+
+class ConversionJob:
+    """One unit of work queued for the inference thread, the source is a path or the uploaded bytes"""
+    def __init__(self, source_audio_path=None, target_audio_path=None, args=None, stream=False, fn=None):
+        self.source_audio_path = source_audio_path
+        self.target_audio_path = target_audio_path
+        self.args = args
+        # generic jobs run this callable instead of a single conversion
+        self.fn = fn
+        self.future = Future()
+        # streaming jobs receive float32 chunks followed by None
+        self.chunk_queue = queue.Queue() if stream else None
+        # set by the consumer when the client went away, lets a running stream stop early
+        self.abandoned = threading.Event()
+        self.enqueued_at = time.monotonic()
+        # seconds per stage spent on this job, shared by the jobs of one micro-batch
+        self.stage_seconds = {}
+
+
+def server_timing(stage_seconds: dict) -> str:
+    """Stage breakdown of one request as a Server-Timing header value, durations in milliseconds"""
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in stage_seconds.items())
+
+
+def input_length_label(audio_seconds: float) -> str:
+    lower = 0
+    for upper in INPUT_LENGTH_BUCKETS:
+        if audio_seconds < upper:
+            return f"{lower}-{upper}s"
+        lower = upper
+    return f"{lower}s+"
+
+
+def record_request(mode: str, stage_seconds: dict, elapsed: float, audio_seconds: float):
+    """Fold one request's (or micro-batch's) stage trace into the service metrics"""
+    if not metrics.enabled:
+        return
+    metrics.REGISTRY.observe("seed_vc_request_seconds", elapsed, mode=mode)
+    length_label = input_length_label(audio_seconds)
+    for stage, seconds in stage_seconds.items():
+        metrics.REGISTRY.observe("seed_vc_request_stage_seconds", seconds, stage=stage, input_length=length_label)
+    if audio_seconds > 0:
+        rtf = elapsed / audio_seconds
+        metrics.REGISTRY.observe("seed_vc_request_rtf", rtf, buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0), mode=mode)
+        metrics.REGISTRY.set_gauge("seed_vc_real_time_factor", rtf, mode=mode)
+        for stage, seconds in stage_seconds.items():
+            metrics.REGISTRY.set_gauge("seed_vc_stage_real_time_factor", seconds / audio_seconds, stage=stage)
+
+
+def audio_seconds_of(result) -> float:
+    """Duration of a (sample_rate, audio) result or a list of them"""
+    if isinstance(result, list):
+        return sum(audio_seconds_of(r) for r in result if r is not None)
+    save_sr, audio_data = result
+    return len(audio_data) / save_sr
+
+
+class InferenceExecutor:
+    """
+    Owns the model on a dedicated thread so inference never blocks the event loop.
+
+    Admission is bounded: at most `max_queue_depth` jobs wait at a time and submit raises QueueFullError
+    beyond that, so overload is answered immediately instead of piling up.
+    Requests arriving within `window_ms` of each other are micro-batched: those whose sampling parameters
+    match are converted together through one padded, length-masked CFM batch and one vocoder batch.
+    Style conversion, streaming and generic jobs always run alone, the first because AR decoding is not
+    batched, the second because their chunks have to reach the client as soon as they exist.
+    """
+    def __init__(self, window_ms: float = 20.0, max_batch_size: int = 8, max_queue_depth: int = 32,
+                 on_request=record_request):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        # called with (mode, stage_seconds, elapsed, audio_seconds) after every batch or stream
+        self.on_request = on_request
+        self._queue = queue.Queue(maxsize=max_queue_depth)
+        self.busy = False
+        self._thread = threading.Thread(target=self._run, name="vc-inference", daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def _put(self, job: ConversionJob) -> ConversionJob:
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFullError(f"Inference queue is full ({self._queue.maxsize} pending requests)")
+        return job
+
+    def submit(self, source_audio_path: Union[str, bytes], target_audio_path: str, args) -> ConversionJob:
+        """Queue a conversion, job.future resolves to (sample_rate, audio_array)"""
+        return self._put(ConversionJob(source_audio_path, target_audio_path, args))
+
+    def submit_stream(self, source_audio_path: Union[str, bytes], target_audio_path: str, args) -> ConversionJob:
+        """
+        Queue a streaming conversion, chunks arrive on job.chunk_queue and
+        job.future resolves once conversion has finished or failed
+        """
+        return self._put(ConversionJob(source_audio_path, target_audio_path, args, stream=True))
+
+    def submit_call(self, fn, *args) -> ConversionJob:
+        """Queue an arbitrary callable that needs the model, job.future resolves to its return value"""
+        return self._put(ConversionJob(fn=partial(fn, *args)))
+
+    @staticmethod
+    def batch_key(job: ConversionJob):
+        if job.fn is not None or job.chunk_queue is not None or job.args.convert_style:
+            return None
+        args = job.args
+        return (args.diffusion_steps, args.cfm_solver, args.step_cache_interval, args.intelligibility_cfg_rate,
+                args.similarity_cfg_rate, args.anonymization_only)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self.busy = True
+            try:
+                self._process(batch)
+            finally:
+                self.busy = False
+
+    def _process(self, batch: list):
+        groups = OrderedDict()
+        for job in batch:
+            key = self.batch_key(job)
+            groups.setdefault(key if key is not None else id(job), []).append(job)
+
+        for jobs in groups.values():
+            # jobs whose caller timed out while queued were cancelled and are skipped here
+            jobs = [job for job in jobs if job.future.set_running_or_notify_cancel()]
+            if not jobs:
+                continue
+            if metrics.enabled:
+                started = time.monotonic()
+                for job in jobs:
+                    metrics.REGISTRY.observe("seed_vc_queue_wait_seconds", started - job.enqueued_at)
+            if jobs[0].chunk_queue is not None:
+                self._process_stream(jobs[0])
+                continue
+            start_time = time.perf_counter()
+            try:
+                with metrics.request_trace() as stage_seconds:
+                    if jobs[0].fn is not None:
+                        mode = "call"
+                        results = [jobs[0].fn()]
+                    elif len(jobs) == 1:
+                        mode = "single"
+                        results = [convert_voice_v2(jobs[0].source_audio_path, jobs[0].target_audio_path, jobs[0].args)]
+                    else:
+                        mode = "batch"
+                        results = convert_voice_v2_batch(
+                            [job.source_audio_path for job in jobs], [job.target_audio_path for job in jobs], jobs[0].args
+                        )
+            except Exception as e:
+                for job in jobs:
+                    job.future.set_exception(e)
+                continue
+            self.on_request(mode, stage_seconds, time.perf_counter() - start_time,
+                            sum(audio_seconds_of(result) for result in results if result is not None))
+            for job, result in zip(jobs, results):
+                job.stage_seconds = stage_seconds
+                job.future.set_result(result)
+
+    def _process_stream(self, job: ConversionJob):
+        start_time = time.perf_counter()
+        audio_samples = 0
+        try:
+            with metrics.request_trace() as stage_seconds:
+                for chunk, _ in stream_voice_v2(job.source_audio_path, job.target_audio_path, job.args):
+                    if job.abandoned.is_set():
+                        break
+                    audio_samples += len(chunk)
+                    job.chunk_queue.put(chunk)
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.stage_seconds = stage_seconds
+            self.on_request("stream", stage_seconds, time.perf_counter() - start_time, audio_samples / vc_wrapper_v2.sr)
+            job.future.set_result(None)
+        finally:
+            job.chunk_queue.put(None)
+
+
+class RemoteAbandon(threading.Event):
+    """abandoned flag of a job running in a replica, setting it also tells the replica to stop the job"""
+    def __init__(self, on_set):
+        super().__init__()
+        self._on_set = on_set
+
+    def set(self):
+        if not self.is_set():
+            super().set()
+            self._on_set()
+
+
+def share_weights(module: torch.nn.Module):
+    """
+    share_memory() for everything but the AR KV caches: those are written by every decode step, so each
+    forked replica has to keep a private copy instead of decoding into the same physical cache.
+    """
+    for submodule in module.modules():
+        if isinstance(submodule, (KVCache, PagedKVCache)):
+            continue
+        for tensor in [*submodule.parameters(recurse=False), *submodule.buffers(recurse=False)]:
+            tensor.share_memory_()
+
+
+def replica_main(index: int, cpus: list, num_threads: int, requests, responses, window_ms: float, max_batch_size: int,
+                 max_queue_depth: int):
+    """
+    Entry point of one model replica process, forked from the supervisor after the model was loaded.
+    Runs its own InferenceExecutor and forwards results, stream chunks and metrics over `responses`.
+    """
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    # stage timings, AR throughput and queue waits are replayed into the supervisor's registry, which /metrics renders
+    metrics.REGISTRY.forward = lambda *observation: responses.put(("observe", None, observation))
+    executor = InferenceExecutor(
+        window_ms=window_ms, max_batch_size=max_batch_size, max_queue_depth=max_queue_depth,
+        on_request=lambda *request: responses.put(("metrics", None, request)),
+    )
+    jobs = {}
+
+    def send_outcome(job_id, job):
+        jobs.pop(job_id, None)
+        if job.future.cancelled():
+            responses.put(("error", job_id, RuntimeError("Voice conversion was cancelled")))
+            return
+        error = job.future.exception()
+        if error is not None:
+            # the exception object itself may not pickle, its message always does
+            responses.put(("error", job_id, RuntimeError(f"{type(error).__name__}: {error}")))
+        else:
+            responses.put(("done", job_id, (job.future.result(), job.stage_seconds)))
+
+    def forward_stream(job_id, job):
+        while (chunk := job.chunk_queue.get()) is not None:
+            responses.put(("chunk", job_id, chunk))
+        job.future.exception()  # wait until the job has fully settled
+        responses.put(("chunk", job_id, None))
+        send_outcome(job_id, job)
+
+    while True:
+        kind, job_id, payload = requests.get()
+        if kind == "stop":
+            break
+        if kind == "cancel":
+            job = jobs.get(job_id)
+            if job is not None:
+                job.abandoned.set()
+                job.future.cancel()
+            continue
+        try:
+            job = executor._put(ConversionJob(**payload))
+        except QueueFullError as e:
+            responses.put(("error", job_id, e))
+            continue
+        jobs[job_id] = job
+        if job.chunk_queue is not None:
+            threading.Thread(target=forward_stream, args=(job_id, job), daemon=True).start()
+        else:
+            job.future.add_done_callback(lambda _, job_id=job_id, job=job: send_outcome(job_id, job))
+
+
+class ReplicaPool:
+    """
+    Supervisor for `num_replicas` model processes, a drop-in replacement for InferenceExecutor.
+
+    One process only gets the intra-op parallelism of a single batch-1 forward, which stops scaling
+    around 8 cores, so on large CPU boxes several narrower replicas give more throughput.
+    The model weights are loaded once here and moved to shared memory before the replicas are forked,
+    so every replica maps the same weights instead of holding a copy; the AR KV caches stay private. Replica i is pinned to its own
+    slice of `threads_per_replica` cores and runs that many intra-op threads.
+    Each job goes to the replica with the fewest jobs in flight, which micro-batches as usual.
+    """
+    def __init__(self, model_args, num_replicas: int, threads_per_replica: Optional[int] = None,
+                 window_ms: float = 20.0, max_batch_size: int = 8, max_queue_depth: int = 32):
+        global vc_wrapper_v2
+        if device.type != "cpu":
+            raise ValueError(f"Model replicas are for CPU serving, {device.type} cannot be shared with forked processes")
+        # the supervisor never runs inference; keeping it single-threaded means no OpenMP pool exists
+        # yet at fork time, which the replicas could otherwise inherit in a broken state
+        torch.set_num_threads(1)
+        if vc_wrapper_v2 is None:
+            vc_wrapper_v2 = load_v2_models(model_args)
+        share_weights(vc_wrapper_v2)
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        threads_per_replica = threads_per_replica or max(1, len(cpus) // num_replicas)
+        # only pin when the cores go around, overlapping pins would be worse than none
+        pin = threads_per_replica * num_replicas <= len(cpus)
+
+        self.max_queue_depth = max_queue_depth
+        self.busy = False
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._next_id = 0
+        self._in_flight = [0] * num_replicas
+        # fork shares the loaded weights, spawn would have to pickle and reload the model
+        context = multiprocessing.get_context("fork")
+        self._responses = context.Queue()
+        self._requests = []
+        self._processes = []
+        for index in range(num_replicas):
+            requests = context.Queue()
+            replica_cpus = cpus[index * threads_per_replica:(index + 1) * threads_per_replica] if pin else None
+            process = context.Process(
+                target=replica_main, name=f"vc-replica-{index}", daemon=True,
+                args=(index, replica_cpus, threads_per_replica, requests, self._responses, window_ms, max_batch_size,
+                      max_queue_depth),
+            )
+            process.start()
+            self._requests.append(requests)
+            self._processes.append(process)
+        # threads are only started once every replica has been forked
+        self._collector = threading.Thread(target=self._collect, name="vc-replica-collector", daemon=True)
+        self._collector.start()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self._in_flight)
+
+    def _put(self, job: ConversionJob, payload: dict) -> ConversionJob:
+        with self._lock:
+            if sum(self._in_flight) >= self.max_queue_depth + len(self._processes):
+                raise QueueFullError(f"Inference queue is full ({self.max_queue_depth} pending requests)")
+            replica = min(range(len(self._in_flight)), key=self._in_flight.__getitem__)
+            job_id = self._next_id
+            self._next_id += 1
+            self._in_flight[replica] += 1
+            self._jobs[job_id] = (job, replica)
+            self.busy = True
+        job.abandoned = RemoteAbandon(lambda: self._requests[replica].put(("cancel", job_id, None)))
+        self._requests[replica].put(("job", job_id, payload))
+        return job
+
+    def submit(self, source_audio_path: Union[str, bytes], target_audio_path: str, args) -> ConversionJob:
+        """Queue a conversion, job.future resolves to (sample_rate, audio_array)"""
+        payload = dict(source_audio_path=source_audio_path, target_audio_path=target_audio_path, args=args)
+        return self._put(ConversionJob(**payload), payload)
+
+    def submit_stream(self, source_audio_path: Union[str, bytes], target_audio_path: str, args) -> ConversionJob:
+        """Queue a streaming conversion, chunks arrive on job.chunk_queue like with InferenceExecutor"""
+        payload = dict(source_audio_path=source_audio_path, target_audio_path=target_audio_path, args=args, stream=True)
+        return self._put(ConversionJob(**payload), payload)
+
+    def submit_call(self, fn, *args) -> ConversionJob:
+        """Queue a module-level function to run in a replica, job.future resolves to its return value"""
+        payload = dict(fn=partial(fn, *args))
+        return self._put(ConversionJob(**payload), payload)
+
+    def _finish(self, job_id: int) -> Optional[ConversionJob]:
+        with self._lock:
+            job, replica = self._jobs.pop(job_id, (None, None))
+            if job is not None:
+                self._in_flight[replica] -= 1
+                self.busy = bool(self._jobs)
+        return job
+
+    def _collect(self):
+        while True:
+            kind, job_id, payload = self._responses.get()
+            if kind == "metrics":
+                record_request(*payload)
+            elif kind == "observe":
+                name, value, buckets, labels = payload
+                metrics.REGISTRY.observe(name, value, buckets, **labels)
+            elif kind == "chunk":
+                job, _ = self._jobs.get(job_id, (None, None))
+                if job is not None:
+                    job.chunk_queue.put(payload)
+            else:
+                job = self._finish(job_id)
+                # a job cancelled by its caller still reports back, there is no one left to tell
+                if job is None or not job.future.set_running_or_notify_cancel():
+                    continue
+                if kind == "done":
+                    result, job.stage_seconds = payload
+                    job.future.set_result(result)
+                else:
+                    job.future.set_exception(payload)
+
+
+if NUM_REPLICAS > 1:
+    inference_executor = ReplicaPool(
+        ConversionRequest(compile=False, ar_checkpoint_path=None, cfm_checkpoint_path=None),
+        num_replicas=NUM_REPLICAS, threads_per_replica=THREADS_PER_REPLICA,
+        window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE, max_queue_depth=MAX_QUEUE_DEPTH,
+    )
+else:
+    inference_executor = InferenceExecutor(
+        window_ms=BATCH_WINDOW_MS, max_batch_size=MAX_BATCH_SIZE, max_queue_depth=MAX_QUEUE_DEPTH
+    )
+
+
+async def run_job(job: ConversionJob):
+    """Wait for a queued job, giving up after REQUEST_TIMEOUT_S; a job that has not started yet is dropped"""
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(job.future), timeout=REQUEST_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        job.abandoned.set()
+        raise HTTPException(
+            status_code=504,
+            detail=f"Voice conversion timed out after {REQUEST_TIMEOUT_S:.0f}s"
+        )
+
+
+def check_cfm_solver(cfm_solver: str):
+    if cfm_solver not in CFM.SOLVERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown CFM solver: {cfm_solver}, expected one of {list(CFM.SOLVERS)}"
+        )
+
+
+def submit_or_reject(submit, *args) -> ConversionJob:
+    """Queue a job, answering with 503 right away if the inference queue is full"""
+    try:
+        return submit(*args)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+
+def iter_stream_response(job: ConversionJob, stream_format: str):
+    """Encode chunks from a streaming conversion as they arrive, runs in Starlette's threadpool"""
+    encoder = None
+    try:
+        while True:
+            try:
+                chunk = job.chunk_queue.get(timeout=REQUEST_TIMEOUT_S)
+            except queue.Empty:
+                print(f"Streaming conversion produced nothing for {REQUEST_TIMEOUT_S:.0f}s, closing the stream")
+                return
+            if chunk is None:
+                break
+            if encoder is None:
+                encoder = get_stream_encoder(stream_format, vc_wrapper_v2.sr)
+                yield encoder.header()
+            with metrics.stage("encode"):
+                data = encoder.encode(chunk)
+            yield data
+        # headers are long gone, a failed conversion can only end the stream early
+        job.future.result()
+        if encoder is not None:
+            yield encoder.close()
+    finally:
+        # stops the conversion early if the client disconnected or the stream timed out
+        job.abandoned.set()
+        job.future.cancel()
+        if encoder is not None:
+            encoder.close()
+
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {
         "status": "ok",
         "device": str(device),
-        "model_loaded": vc_wrapper_v2 is not None
+        "model_loaded": vc_wrapper_v2 is not None,
+        "cached_references": len(reference_cache),
+        "queue_depth": inference_executor.queue_depth,
+        "busy": inference_executor.busy,
     }
 
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus text exposition of per-stage latency histograms and real-time-factor gauges"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/convert")
 async def convert_voice(
     source_audio: UploadFile = File(..., description="Source audio file to convert"),
     target_voice: str = Form(..., description="Absolute path to target/reference voice audio"),
     diffusion_steps: int = Form(30),
+    cfm_solver: str = Form("euler"),
+    step_cache_interval: int = Form(0),
     length_adjust: float = Form(1.0),
     intelligibility_cfg_rate: float = Form(0.7),
     similarity_cfg_rate: float = Form(0.7),
@@ -136,6 +825,8 @@ async def convert_voice(
     convert_style: bool = Form(False),
     anonymization_only: bool = Form(False),
     compile: bool = Form(False),
+    stream: bool = Form(False),
+    stream_format: str = Form("wav"),
 ):
     """
     Convert voice from source audio to target voice style
@@ -144,6 +835,10 @@ async def convert_voice(
         source_audio: Source audio file (WAV, MP3, etc.)
         target_voice: Absolute path to target/reference voice audio file
         diffusion_steps: Number of diffusion steps (default: 30)
+        cfm_solver: Flow-matching ODE solver, "euler", "heun", "midpoint", "multistep" or "adaptive" (default: euler);
+            heun and midpoint cost two DiT calls per step, so pair them with fewer steps
+        step_cache_interval: Run the deep DiT blocks on one diffusion step out of this many and reuse their
+            output in between, trading a little quality for speed; 0 or 1 disables it (default: 0)
         length_adjust: Length adjustment factor (default: 1.0)
         intelligibility_cfg_rate: CFG rate for intelligibility (default: 0.7)
         similarity_cfg_rate: CFG rate for similarity (default: 0.7)
@@ -153,9 +848,11 @@ async def convert_voice(
         convert_style: Convert style/emotion/accent (default: False)
         anonymization_only: Anonymization only mode (default: False)
         compile: Compile model for faster inference (default: False)
+        stream: Send each converted chunk as soon as it is ready (default: False)
+        stream_format: Streamed encoding, one of "pcm"/"pcm_s16le" (16-bit mono), "pcm_f32le", "wav", "opus" or "mp3" (default: wav)
     
     Returns:
-        Audio binary (WAV format)
+        Audio binary (WAV format), or a chunked stream in `stream_format` if `stream` is set
     """
     
     if not os.path.exists(target_voice):
@@ -163,21 +860,23 @@ async def convert_voice(
             status_code=400,
             detail=f"Target voice file not found: {target_voice}"
         )
-    
-    temp_dir = tempfile.mkdtemp()
-    source_temp_path = None
+    check_cfm_solver(cfm_solver)
+    if stream and stream_format not in STREAM_ENCODERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown stream format: {stream_format}, expected one of {list(STREAM_ENCODERS)}"
+        )
     
     try:
-        
-        source_temp_path = os.path.join(temp_dir, "source_audio.wav")
-        contents = await source_audio.read()
-        with open(source_temp_path, "wb") as f:
-            f.write(contents)
+        # decoded straight from memory by the wrapper, the upload never touches the disk
+        source_bytes = await source_audio.read()
         
         conversion_args = ConversionRequest(
-            source=source_temp_path,
+            source=source_audio.filename,
             target=target_voice,
             diffusion_steps=diffusion_steps,
+            cfm_solver=cfm_solver,
+            step_cache_interval=step_cache_interval,
             length_adjust=length_adjust,
             intelligibility_cfg_rate=intelligibility_cfg_rate,
             similarity_cfg_rate=similarity_cfg_rate,
@@ -191,8 +890,16 @@ async def convert_voice(
             cfm_checkpoint_path=None,
         )
         
+        if stream:
+            job = submit_or_reject(inference_executor.submit_stream, source_bytes, target_voice, conversion_args)
+            return StreamingResponse(
+                content=iter_stream_response(job, stream_format),
+                media_type=STREAM_ENCODERS[stream_format].media_type,
+            )
+        
         start_time = time.time()
-        converted_audio = convert_voice_v2(source_temp_path, target_voice, conversion_args)
+        job = submit_or_reject(inference_executor.submit, source_bytes, target_voice, conversion_args)
+        converted_audio = await run_job(job)
         end_time = time.time()
         
         if converted_audio is None:
@@ -207,19 +914,19 @@ async def convert_voice(
         sf.write(audio_bytes, audio_data, save_sr, format='WAV')
         audio_bytes.seek(0)
         
-        return StreamingResponse(content=audio_bytes, media_type="audio/wav")
+        return StreamingResponse(content=audio_bytes, media_type="audio/wav", headers={
+            "X-Processing-Time": f"{end_time - start_time:.3f}",
+            "Server-Timing": server_timing(job.stage_seconds),
+        })
+    
+    except HTTPException:
+        raise
     
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Voice conversion error: {str(e)}"
         )
-    
-    finally:
-        if source_temp_path and os.path.exists(source_temp_path):
-            os.remove(source_temp_path)
-        if os.path.exists(temp_dir):
-            os.rmdir(temp_dir)
 
 
 @app.post("/batch-convert")
@@ -227,6 +934,8 @@ async def batch_convert(
     source_audio: UploadFile = File(...),
     target_voices: str = Form(..., description="Comma-separated absolute paths to target voice files"),
     diffusion_steps: int = Form(30),
+    cfm_solver: str = Form("euler"),
+    step_cache_interval: int = Form(0),
     length_adjust: float = Form(1.0),
     intelligibility_cfg_rate: float = Form(0.7),
     similarity_cfg_rate: float = Form(0.7),
@@ -243,9 +952,10 @@ async def batch_convert(
         ... (other parameters same as /convert)
     
     Returns:
-        JSON with results for each target voice
+        JSON with results for each target voice, converted audio is a base64 encoded WAV in `audio_base64`
     """
     
+    check_cfm_solver(cfm_solver)
     target_paths = [p.strip() for p in target_voices.split(",")]
     
  
@@ -257,67 +967,60 @@ async def batch_convert(
             )
     
     results = {}
-    temp_dir = tempfile.mkdtemp()
-    source_temp_path = None
+    source_bytes = await source_audio.read()
+    
+    conversion_args = ConversionRequest(
+        source=source_audio.filename,
+        target=target_paths,
+        diffusion_steps=diffusion_steps,
+        cfm_solver=cfm_solver,
+        step_cache_interval=step_cache_interval,
+        length_adjust=length_adjust,
+        intelligibility_cfg_rate=intelligibility_cfg_rate,
+        similarity_cfg_rate=similarity_cfg_rate,
+        top_p=top_p,
+        temperature=temperature,
+        repetition_penalty=repetition_penalty,
+        convert_style=False,
+        anonymization_only=False,
+        compile=False,
+        ar_checkpoint_path=None,
+        cfm_checkpoint_path=None,
+    )
     
+    start_time = time.time()
     try:
-        source_temp_path = os.path.join(temp_dir, "source_audio.wav")
-        contents = await source_audio.read()
-        with open(source_temp_path, "wb") as f:
-            f.write(contents)
-        
-        for target_path in target_paths:
-            try:
-                conversion_args = ConversionRequest(
-                    source=source_temp_path,
-                    target=target_path,
-                    diffusion_steps=diffusion_steps,
-                    length_adjust=length_adjust,
-                    intelligibility_cfg_rate=intelligibility_cfg_rate,
-                    similarity_cfg_rate=similarity_cfg_rate,
-                    top_p=top_p,
-                    temperature=temperature,
-                    repetition_penalty=repetition_penalty,
-                    convert_style=False,
-                    anonymization_only=False,
-                    compile=False,
-                    ar_checkpoint_path=None,
-                    cfm_checkpoint_path=None,
-                )
-                
-                start_time = time.time()
-                converted_audio = convert_voice_v2(source_temp_path, target_path, conversion_args)
-                end_time = time.time()
-                
-                if converted_audio is not None:
-                    save_sr, audio_data = converted_audio
-                    audio_bytes = io.BytesIO()
-                    sf.write(audio_bytes, audio_data, save_sr, format='WAV')
-                    results[target_path] = {
-                        "status": "success",
-                        "processing_time": f"{end_time - start_time:.2f}s",
-                        "sample_rate": save_sr,
-                        "audio_duration": len(audio_data) / save_sr
-                    }
-                else:
-                    results[target_path] = {
-                        "status": "failed",
-                        "error": "Conversion returned None"
-                    }
-            
-            except Exception as e:
-                results[target_path] = {
-                    "status": "failed",
-                    "error": str(e)
-                }
-        
-        return {"results": results}
+        converted_audios = await run_job(submit_or_reject(
+            inference_executor.submit_call, convert_voice_v2_fan_out, source_bytes, target_paths, conversion_args
+        ))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Voice conversion error: {str(e)}"
+        )
+    end_time = time.time()
     
-    finally:
-        if source_temp_path and os.path.exists(source_temp_path):
-            os.remove(source_temp_path)
-        if os.path.exists(temp_dir):
-            os.rmdir(temp_dir)
+    for target_path, converted_audio in zip(target_paths, converted_audios):
+        if converted_audio is not None:
+            save_sr, audio_data = converted_audio
+            audio_bytes = io.BytesIO()
+            sf.write(audio_bytes, audio_data, save_sr, format='WAV')
+            results[target_path] = {
+                "status": "success",
+                "processing_time": f"{end_time - start_time:.2f}s",
+                "sample_rate": save_sr,
+                "audio_duration": len(audio_data) / save_sr,
+                "audio_base64": base64.b64encode(audio_bytes.getvalue()).decode("ascii"),
+            }
+        else:
+            results[target_path] = {
+                "status": "failed",
+                "error": "Conversion returned None"
+            }
+    
+    return {"results": results}
 
 
 if __name__ == "__main__":
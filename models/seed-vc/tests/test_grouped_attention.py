@@ -0,0 +1,53 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("munch")
+
+from torch.nn import functional as F
+
+from modules import commons
+from modules.commons import grouped_scaled_dot_product_attention
+
+
+def repeated_kv_attention(q, k, v, attn_mask=None):
+    group = q.size(1) // k.size(1)
+    k = k.repeat_interleave(group, dim=1)
+    v = v.repeat_interleave(group, dim=1)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+
+
+def random_qkv(dtype=torch.float32, device="cpu"):
+    q = torch.randn(2, 12, 5, 16, dtype=dtype, device=device)
+    k = torch.randn(2, 2, 7, 16, dtype=dtype, device=device)
+    v = torch.randn(2, 2, 7, 16, dtype=dtype, device=device)
+    mask = torch.rand(2, 1, 5, 7, device=device) > 0.3
+    mask[..., 0] = True
+    return q, k, v, mask
+
+
+def test_matches_repeated_kv():
+    q, k, v, mask = random_qkv()
+    expected = repeated_kv_attention(q, k, v, mask)
+    torch.testing.assert_close(grouped_scaled_dot_product_attention(q, k, v, attn_mask=mask), expected)
+
+
+def test_non_contiguous_sdpa_output(monkeypatch):
+    # the fused backends may return the output in (B, L, H, D) memory layout
+    sdpa = F.scaled_dot_product_attention
+
+    def non_contiguous_sdpa(q, k, v, **kwargs):
+        y = sdpa(q, k, v, **kwargs)
+        return y.transpose(1, 2).contiguous().transpose(1, 2)
+
+    q, k, v, mask = random_qkv()
+    expected = repeated_kv_attention(q, k, v, mask)
+    monkeypatch.setattr(commons.F, "scaled_dot_product_attention", non_contiguous_sdpa)
+    torch.testing.assert_close(grouped_scaled_dot_product_attention(q, k, v, attn_mask=mask), expected)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="fused SDPA backends need CUDA")
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+def test_fused_backend_half_precision(dtype):
+    q, k, v, _ = random_qkv(dtype=dtype, device="cuda")
+    expected = repeated_kv_attention(q, k, v)
+    torch.testing.assert_close(grouped_scaled_dot_product_attention(q, k, v), expected, atol=2e-2, rtol=2e-2)
@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip("torch")
+from modules.v2.metrics import MetricsRegistry
+
+
+def test_forwarded_observations_replay_into_another_registry():
+    supervisor = MetricsRegistry()
+    replica = MetricsRegistry()
+    forwarded = []
+    replica.forward = lambda *observation: forwarded.append(observation)
+    replica.observe("seed_vc_stage_seconds", 0.2, stage="cfm")
+    replica.observe("seed_vc_ar_tokens_per_second", 120.0, buckets=(100, 1000))
+    assert "seed_vc_stage_seconds" not in replica.render()
+
+    for name, value, buckets, labels in forwarded:
+        supervisor.observe(name, value, buckets, **labels)
+    rendered = supervisor.render()
+    assert 'seed_vc_stage_seconds_count{stage="cfm"} 1' in rendered
+    assert 'seed_vc_ar_tokens_per_second_bucket{le="1000"} 1' in rendered
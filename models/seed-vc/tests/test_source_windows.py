@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip("torch")
+vc_wrapper_module = pytest.importorskip("modules.v2.vc_wrapper")
+source_window_starts = vc_wrapper_module.VoiceConversionWrapper.source_window_starts
+
+
+def test_short_source_is_a_single_window():
+    assert source_window_starts(100, 200, 16) == [0]
+    assert source_window_starts(200, 200, 16) == [0]
+
+
+def test_long_source_windows_stop_at_the_end():
+    starts = source_window_starts(300, 200, 16)
+    assert starts == [0, 184]
+    starts = source_window_starts(5000, 2000, 16)
+    assert starts == [0, 1984, 3968]
+    # consecutive windows overlap by overlap_frame_len and only the last one reaches the end
+    assert all(start + 2000 < 5000 for start in starts[:-1])
+    assert starts[-1] + 2000 >= 5000